@@ -0,0 +1,122 @@
+"""
+Author: iota
+Create: 2024.3.27 21:05
+Project: YuanShenTool
+Path: src/modules/arbiter.py
+IDE: PyCharm
+Description: 多开时在多个游戏窗口之间分配前台，点击、滚动、截图等依赖前台的动作同一时刻只有一个窗口在执行
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from src.utils.cancel import current_token
+from src.utils.support import logger
+
+
+class ForegroundArbiter:
+    """前台的仲裁者
+
+    每个窗口的Automize在执行依赖前台的动作前调用hold，拿到前台后再发送输入或截图；
+    识别、计算等不依赖前台的工作不需要持有，可以与其他窗口的输入重叠。
+    切换窗口需要等待界面响应，所以前台窗口释放后的grace秒内仍优先分配给它，
+    点击后的短暂等待不会引起切换，较长的识别才让给其他窗口；
+    连续执行quantum次后不再优先，避免某个窗口一直占用
+    """
+
+    def __init__(self, quantum=8, grace=0.0):
+        """
+        :param quantum: 其他窗口在排队时，当前前台窗口最多连续执行的动作次数
+        :param grace: 前台窗口释放后仍优先分配给它的秒数，略大于动作之间的等待时间即可
+        """
+        self.quantum = quantum
+        self.grace = grace
+        self.stats = {'grants': 0, 'switches': 0, 'wait_seconds': 0.0}
+
+        self.__cond = threading.Condition()
+        self.__queue = deque()
+        self.__owner = None
+        self.__depth = 0
+        self.__foreground = None
+        self.__streak = 0
+        self.__released_at = 0.0
+
+    @contextmanager
+    def hold(self, client):
+        """独占前台执行一组动作，可以嵌套
+
+        :param client: 请求前台的Automize，需要时调用其activate_window切换窗口
+        """
+        if self.__owner is client:
+            # 同一个窗口只在一个线程中操作，嵌套时直接执行
+            self.__depth += 1
+            try:
+                yield
+            finally:
+                self.__depth -= 1
+            return
+
+        self.__acquire(client)
+        try:
+            if self.__foreground is not client or not client.is_window_on_top():
+                self.__switch_to(client)
+            yield
+        finally:
+            self.__release()
+
+    def __acquire(self, client):
+        token = current_token()
+        start = time.perf_counter()
+        with self.__cond:
+            self.__queue.append(client)
+            try:
+                while not (self.__owner is None and self.__next() is client):
+                    token.raise_if_cancelled()
+                    # 取消令牌与优先期结束都不会唤醒条件变量，定时醒来检查
+                    self.__cond.wait(min(0.1, self.__grace_left()) or 0.1)
+                contended = len(self.__queue) > 1
+            finally:
+                self.__queue.remove(client)
+            self.__owner = client
+            self.__depth = 1
+            # 只有其他窗口在排队时才累计连续次数
+            if self.__foreground is not client:
+                self.__streak = 1
+            elif contended:
+                self.__streak += 1
+            self.stats['grants'] += 1
+            self.stats['wait_seconds'] += time.perf_counter() - start
+
+    def __grace_left(self) -> float:
+        return max(0.0, self.__released_at + self.grace - time.monotonic())
+
+    def __next(self):
+        """下一个获得前台的窗口，前台窗口的优先期内没有排队时返回None"""
+        favored = self.__streak < self.quantum
+        if self.__foreground in self.__queue and (favored or len(self.__queue) == 1):
+            return self.__foreground
+        if favored and self.__grace_left() > 0:
+            return None
+        for client in self.__queue:
+            if client is not self.__foreground:
+                return client
+        return self.__queue[0] if self.__queue else None
+
+    def __release(self):
+        with self.__cond:
+            self.__owner = None
+            self.__depth = 0
+            self.__released_at = time.monotonic()
+            self.__cond.notify_all()
+
+    def __switch_to(self, client):
+        if not client.activate_window():
+            raise RuntimeError(client.window_title + '窗口已关闭')
+        if self.__foreground is not client:
+            self.stats['switches'] += 1
+            logger.debug(f'前台切换到窗口{client.window_handle}')
+        self.__foreground = client
+
+    def format_stats(self) -> str:
+        return '前台分配%(grants)d次，切换窗口%(switches)d次，等待%(wait_seconds).2f秒' % self.stats
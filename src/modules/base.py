@@ -6,94 +6,182 @@ Path: src/modules/base.py
 IDE: PyCharm
 Description: 定义窗口基础动作
 """
-import time
+import threading
+from contextlib import nullcontext
 
-import mss
-import mss.tools
-import win32api
-import win32gui
 from PIL import Image
 
+from src.modules.inputs import InputBatch, InputScheduler, Win32Sink
+from src.modules.window import WindowWatcher
+from src.utils.cancel import current_token
+from src.utils.img import encode_png
 from src.utils.support import logger, pub_config
+from src.utils.trace import tracer
+
+
+class DesktopScreen:
+    """桌面上的真实窗口，窗口状态由WindowWatcher缓存，截图使用mss
+
+    Automize通过screen对象获取窗口状态和截图，模拟器等替身实现相同的 watcher / activate / grab 即可
+    """
+
+    # mss对象不能跨线程使用，多个窗口在各自的线程中截图时每个线程创建一个
+    __local = threading.local()
+
+    def __init__(self, window_title, window_classname=None, handle=None):
+        """
+        :param handle: 绑定到指定的窗口，多开时使用，默认按标题与类名查找
+        """
+        import win32gui
+
+        self.__win32gui = win32gui
+        # 窗口句柄、客户区位置与前台状态由watcher缓存，动作中不再逐次查询
+        self.watcher = WindowWatcher(window_title, window_classname, pub_config.get('window_poll_interval', 0.5),
+                                     handle=handle)
+        self.watcher.start()
+
+    @classmethod
+    def mss_sct(cls):
+        """当前线程的mss对象"""
+        sct = getattr(cls.__local, 'sct', None)
+        if sct is None:
+            import mss
+
+            sct = cls.__local.sct = mss.mss()
+        return sct
+
+    def activate(self):
+        self.__win32gui.ShowWindow(self.watcher.handle, 9)
+        self.__win32gui.SetForegroundWindow(self.watcher.handle)
+
+    def grab(self, rect):
+        """截取屏幕区域
+
+        :param rect: 屏幕坐标 (left, top, right, bottom)
+        :return: 带有size与rgb属性的截图对象
+        """
+        return self.mss_sct().grab(rect)
 
 
 class Automize:
-    def __init__(self, window_title, window_classname=None):
+    def __init__(self, window_title, window_classname=None, input_sink=None, screen=None, handle=None, arbiter=None):
         """初始化窗口动作对象
 
         :param window_title: 匹配窗口标题
         :param window_classname: 匹配窗口类名
+        :param input_sink: 输入事件的发送对象，默认使用Win32 API
+        :param screen: 提供窗口状态与截图的对象，默认使用DesktopScreen
+        :param handle: 绑定到指定的窗口，多开时使用
+        :param arbiter: 多开时共用的ForegroundArbiter，依赖前台的动作先获得前台再执行
         """
         self.window_title = window_title
         self.window_classname = window_classname
         logger.info('目标窗口标题=%s, 类名=%s' % (self.window_title, self.window_classname))
 
-        self.window_handle = None
-        self.refresh_window_handle()
+        self.screen = DesktopScreen(window_title, window_classname, handle) if screen is None else screen
+        self.watcher = self.screen.watcher
+        self.arbiter = arbiter
 
         self.ACTION_DELAY = pub_config['action_delay']
-
-        # 标准分辨率：1920x1080，代码中的 x/y 坐标数值是基于该分辨率下的
-        self.SCREEN_SIZE = win32api.GetSystemMetrics(0), win32api.GetSystemMetrics(1)
-        logger.info('屏幕尺寸：%dx%d' % self.SCREEN_SIZE)
-        self.__x_ratio = self.SCREEN_SIZE[0] / 1920
-        self.__y_ratio = self.SCREEN_SIZE[1] / 1080
+        # 连续点击同一位置时的间隔
+        self.BURST_INTERVAL = pub_config.get('burst_interval', 0.08)
+        self.input = InputScheduler(Win32Sink() if input_sink is None else input_sink)
+        # 运行中修改配置文件即可调整速度，下一个动作开始生效
+        pub_config.subscribe(self.__on_config_changed)
+
+    def __on_config_changed(self, changed: dict):
+        if 'action_delay' in changed:
+            self.ACTION_DELAY = changed['action_delay']
+            logger.info(f'动作延迟：{self.ACTION_DELAY}')
+        if 'burst_interval' in changed:
+            self.BURST_INTERVAL = changed['burst_interval']
+            logger.info(f'连续点击间隔：{self.BURST_INTERVAL}')
+
+    @property
+    def window_handle(self):
+        return self.watcher.handle
 
     def refresh_window_handle(self):
-        self.window_handle = win32gui.FindWindow(self.window_classname, self.window_title)
-        logger.info(f'句柄={self.window_handle}')
+        self.watcher.refresh()
 
     def activate_window(self) -> bool:
-        self.refresh_window_handle()
-        if self.window_handle:
-            win32gui.ShowWindow(self.window_handle, 9)
-            win32gui.SetForegroundWindow(self.window_handle)
-            self.waiting(1)
+        """将窗口置于前台，窗口已在前台时直接返回"""
+        if not self.watcher.handle:
+            self.watcher.refresh()
+        if not self.watcher.handle:
+            return False
+        if self.watcher.is_foreground:
             return True
-        return False
+        self.screen.activate()
+        self.waiting(1)
+        self.watcher.refresh()
+        return True
+
+    def exclusive(self):
+        """独占前台执行一组动作，例如先移动再滚动；没有多开时不做任何事"""
+        return nullcontext() if self.arbiter is None else self.arbiter.hold(self)
 
     def get_window_position(self) -> tuple | None:
-        # TODO: 返回的是窗口真实位置，直接使用结果调用截图方法是不准的
-        return win32gui.GetWindowRect(self.window_handle)
+        """窗口客户区在屏幕上的位置 (left, top, width, height)"""
+        return self.watcher.client_rect
 
     def is_window_on_top(self) -> bool:
-        return self.window_handle == win32gui.GetForegroundWindow()
+        return self.watcher.is_foreground
 
     def move_to(self, x: int, y: int):
-        win32api.SetCursorPos((x * self.__x_ratio, y * self.__y_ratio))
-
-    def click(self, x: int, y: int):
-        x *= self.__x_ratio
-        y *= self.__y_ratio
-        win32api.SetCursorPos((x, y))
-        win32api.mouse_event(2, x, y, 0, 0)
-        win32api.mouse_event(4, x, y, 0, 0)
+        with self.exclusive():
+            self.input.dispatch(InputBatch().move(*self.watcher.to_screen(x, y)))
+
+    @tracer.traced('auto.click')
+    def click(self, x: int, y: int, wait=True):
+        """
+        :param wait: 为False时只发送点击，不等待界面响应，调用方需要在发送后、等待前完成不能被取消打断的工作
+        """
+        current_token().raise_if_cancelled()
+        with self.exclusive():
+            self.input.dispatch(InputBatch().click(*self.watcher.to_screen(x, y)))
+        # 等待界面响应时不占用前台，其他窗口可以继续操作
+        if wait:
+            self.waiting(1)
+
+    @tracer.traced('auto.click_burst')
+    def click_burst(self, x: int, y: int, count: int, interval: float = None):
+        """在同一位置连续点击，点击之间只间隔interval秒，全部点击后再等待一次动作延迟"""
+        if count <= 0:
+            return
+        if interval is None:
+            interval = self.BURST_INTERVAL
+        current_token().raise_if_cancelled()
+        with self.exclusive():
+            self.input.dispatch(InputBatch().click_burst(*self.watcher.to_screen(x, y), count, interval))
         self.waiting(1)
 
+    @tracer.traced('auto.scroll')
     def scroll(self, count: int, duration: float = None):
         if duration is None:
             duration = self.ACTION_DELAY
         symbol = 1 if count > 0 else -1
-        count = abs(count)
-        delay = duration / count
-        for _ in range(count):
-            win32api.mouse_event(8, 0, 0, symbol)
-            time.sleep(delay)
+        current_token().raise_if_cancelled()
+        with self.exclusive():
+            self.input.dispatch(InputBatch().scroll_ramp(abs(count), duration, symbol))
         self.waiting(1)
 
+    @tracer.traced('auto.waiting')
     def waiting(self, multiple: int | float = 1):
-        time.sleep(self.ACTION_DELAY * multiple)
-
-    mss_sct = mss.mss()
+        """等待动作延迟的倍数时间，所在流程被取消时立即抛出OperationCancelled"""
+        current_token().sleep(self.ACTION_DELAY * multiple)
 
+    @tracer.traced('auto.screenshot')
     def __screenshot(self, x1, y1, x2, y2):
-        return self.mss_sct.grab((x1 * self.__x_ratio, y1 * self.__y_ratio,
-                                  x2 * self.__x_ratio, y2 * self.__y_ratio))
+        # 坐标基于客户区，窗口化运行时也只截取游戏画面
+        with self.exclusive():
+            return self.screen.grab(self.watcher.rect_to_screen(x1, y1, x2, y2))
 
+    @tracer.traced('auto.screenshot_png')
     def take_screenshot_as_png(self, x1, y1, x2, y2) -> bytes:
-        screenshot = self.__screenshot(x1, y1, x2, y2)
-        return mss.tools.to_png(screenshot.rgb, screenshot.size)
+        return encode_png(self.take_screenshot_as_image(x1, y1, x2, y2))
 
+    @tracer.traced('auto.screenshot_image')
     def take_screenshot_as_image(self, x1, y1, x2, y2) -> Image.Image:
         screenshot = self.__screenshot(x1, y1, x2, y2)
         return Image.frombytes('RGB', screenshot.size, screenshot.rgb)
@@ -103,9 +191,8 @@ if __name__ == '__main__':
     logger.info('start..')
     auto = Automize('计算器')
     if auto.activate_window():
-        p = auto.get_window_position()
-        print(p)
+        print(auto.get_window_position())
         with open('debug/screenshot.png', 'wb') as fp:
-            fp.write(auto.take_screenshot_as_png(*p))
+            fp.write(auto.take_screenshot_as_png(0, 0, 1920, 1080))
     else:
         logger.info(auto.window_title + '未启动！')
@@ -0,0 +1,274 @@
+"""
+Author: iota
+Create: 2024.3.6 20:12
+Project: YuanShenTool
+Path: src/modules/cli.py
+IDE: PyCharm
+Description: 无界面的命令行入口，只依赖清单模块，不需要tkinter和Windows环境
+"""
+import argparse
+import json
+import sys
+
+from src.modules.inv import FetchInv, HandleInv, get_inv_filelist
+from src.utils.support import log_to_stderr
+
+
+class Output:
+    """命令结果的输出，进度信息写到stderr，结果写到stdout"""
+
+    def __init__(self, as_json):
+        self.as_json = as_json
+        self.results = []
+
+    def progress(self, current, total, message):
+        print(f'[{current}/{total}] {message}', file=sys.stderr, flush=True)
+
+    def add(self, **result):
+        self.results.append(result)
+        if not self.as_json:
+            print('\t'.join(str(v) for v in result.values()))
+
+    def finish(self) -> int:
+        if self.as_json:
+            print(json.dumps(self.results, ensure_ascii=False, indent=2))
+        return 0 if all(r.get('ok', True) for r in self.results) else 1
+
+
+def cmd_fetch(args, out: Output):
+    fetcher = FetchInv(auto_open=False, insert_image=not args.no_image, incremental=not args.full)
+    if args.cookie:
+        fetcher.web.set_cookie(args.cookie)
+    if args.offline:
+        fetcher.web.offline = True
+    elif args.refresh:
+        fetcher.web.cache.ttl = 0
+
+    if args.merge:
+        symbol, message = fetcher.fetch_inventories(
+            args.share_codes, args.output,
+            progress=lambda done, total, message: out.progress(done, total, message))
+        if message == '<set_cookie>':
+            message = 'cookie无效，请使用 --cookie 设置'
+        out.add(share_code='+'.join(args.share_codes), ok=symbol, message=message)
+        return
+
+    for i, share_code in enumerate(args.share_codes, 1):
+        out.progress(i, len(args.share_codes), f'获取清单 {share_code}')
+        symbol, message = fetcher.fetch_inventory(share_code)
+        if message == '<set_cookie>':
+            message = 'cookie无效，请使用 --cookie 设置'
+        out.add(share_code=share_code, ok=symbol, message=message)
+
+
+def cmd_list(args, out: Output):
+    for filename in get_inv_filelist():
+        out.add(file=filename)
+
+
+def cmd_show(args, out: Output):
+    inventory = HandleInv(args.file)
+    for item in inventory.read_items():
+        out.add(**item)
+    inventory.close()
+
+
+def cmd_export(args, out: Output):
+    for i, filename in enumerate(args.files, 1):
+        out.progress(i, len(args.files), f'导出 {filename}')
+        target = '%s/%s.%s' % (args.output_dir, filename.rsplit('.', 1)[0], args.format)
+        inventory = HandleInv(filename)
+        inventory.export(target)
+        inventory.close()
+        out.add(file=filename, ok=True, message=target)
+
+
+def cmd_merge(args, out: Output):
+    fetcher = FetchInv(auto_open=False, insert_image=not args.no_image)
+    symbol, message = fetcher.merge_inventories(args.files, args.output)
+    out.add(ok=symbol, message=message)
+
+
+def cmd_sim(args, out: Output):
+    from src.modules.sim import generate_scenario, run_multi_simulation, run_shop_simulation
+    from src.utils.profiler import profiler
+
+    if args.profile:
+        profiler.configure({'enabled': True, 'mode': args.profile, 'top': profiler.top, 'interval': profiler.interval})
+
+    def scenario(seed_offset):
+        return generate_scenario(args.items, args.shelf, seed=None if args.seed is None else args.seed + seed_offset,
+                                 sold_out_ratio=args.sold_out, max_stock=args.max_stock, shuffle=not args.keep_order)
+
+    def progress(done, total, message, **_):
+        out.progress(done, total, message)
+
+    for run in range(args.runs):
+        if args.clients > 1:
+            scenarios = [scenario(run * args.clients + i) for i in range(args.clients)]
+            with profiler.session('sim'):
+                report = run_multi_simulation(scenarios, args.shelf, action_delay=args.action_delay,
+                                              font_path=args.font, ocr_latency=args.ocr_latency, progress=progress)
+        else:
+            items, inventory = scenario(run)
+            with profiler.session('sim'):
+                report = run_shop_simulation(items, inventory, args.shelf, action_delay=args.action_delay,
+                                             font_path=args.font, ocr_latency=args.ocr_latency, progress=progress)
+        out.add(run=run + 1, **report)
+
+
+def cmd_ocr_bench(args, out: Output):
+    from src.modules.ocr import choose_routes
+    from src.modules.ocrbench import benchmark, create_engines, generate_corpus, load_corpus, save_report
+    from src.utils.support import pub_config
+
+    if args.generate:
+        count = generate_corpus(args.corpus, args.generate, font_path=args.font, seed=args.seed)
+        out.add(ok=True, message=f'已生成{count}张截图：{args.corpus}')
+        return
+
+    engines = create_engines(args.engines)
+    if not engines:
+        out.add(ok=False, message='没有可用的OCR引擎')
+        return
+    report = benchmark(engines, load_corpus(args.corpus), repeat=args.repeat,
+                       progress=lambda done, total, message: out.progress(done, total, message))
+    auto_config = pub_config.get('auto_ocr') or {}
+    floor = auto_config.get('accuracy_floor', 0.95) if args.floor is None else args.floor
+    report['corpus'] = args.corpus
+    report['routes'] = choose_routes(report, floor)
+    output = args.output or auto_config.get('report', 'cache/ocr_bench.json')
+    save_report(output, report)
+
+    for name, types in report['engines'].items():
+        for crop_type, stats in types.items():
+            out.add(engine=name, crop_type=crop_type, **stats)
+    for crop_type, name in report['routes'].items():
+        out.add(route=crop_type, engine=name)
+
+
+def cmd_cook_tune(args, out: Output):
+    from src.modules.cooktune import TOLERANCES, generate_corpus, load_corpus, save_report, tune
+    from src.utils.support import pub_config
+
+    if args.generate:
+        count = generate_corpus(args.corpus, args.generate, seed=args.seed)
+        out.add(ok=True, message=f'已生成{count}个烹饪序列：{args.corpus}')
+        return
+
+    sequences = load_corpus(args.corpus)
+    if not sequences:
+        out.add(ok=False, message='没有已标注的烹饪序列')
+        return
+    report = tune(sequences, tolerances=args.tolerances or TOLERANCES, min_margin=args.min_margin,
+                  full_width=args.full_width, progress=lambda done, total, message: out.progress(done, total, message))
+    report['corpus'] = args.corpus
+    output = args.output or (pub_config.get('cooking') or {}).get('profile', 'cache/cooking_profile.json')
+    save_report(output, report)
+    for resolution, profile in report['profiles'].items():
+        out.add(resolution=resolution, **profile)
+
+
+def cmd_loadtest(args, out: Output):
+    from src.modules.standin import Faults, run_load_test
+
+    faults = Faults(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, qps=args.qps)
+    # 故障只注入到压测的接口，压测识别接口时令牌接口正常发放令牌
+    report = run_load_test(args.target, args.requests, args.concurrency, faults={args.target: faults},
+                           progress=lambda done, total, message: out.progress(done, total, message))
+    out.add(ok=True, **report)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='yuan_cli', description='尘歌壶清单的命令行工具，清单文件保存在 cache/ 目录')
+    parser.add_argument('--json', action='store_true', help='以JSON格式输出结果')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fetch = subparsers.add_parser('fetch', help='根据分享码获取清单')
+    fetch.add_argument('share_codes', nargs='+', metavar='SHARE_CODE')
+    fetch.add_argument('--cookie', help='更新并保存米游社cookie')
+    fetch.add_argument('--no-image', action='store_true', help='不插入物品图片')
+    fetch.add_argument('-m', '--merge', action='store_true', help='并发获取所有分享码，合并保存为一个清单')
+    fetch.add_argument('-o', '--output', help='合并后的文件名，默认由分享码拼接而成')
+    fetch.add_argument('--offline', action='store_true', help='只使用本地缓存的接口响应')
+    fetch.add_argument('--refresh', action='store_true', help='忽略缓存有效期，重新请求接口')
+    fetch.add_argument('--full', action='store_true', help='重新生成清单，不保留已有数量')
+    fetch.set_defaults(func=cmd_fetch)
+
+    subparsers.add_parser('list', help='列出本地清单').set_defaults(func=cmd_list)
+
+    show = subparsers.add_parser('show', help='显示清单内容')
+    show.add_argument('file')
+    show.set_defaults(func=cmd_show)
+
+    export = subparsers.add_parser('export', help='导出清单为json/csv')
+    export.add_argument('files', nargs='+', metavar='FILE')
+    export.add_argument('-f', '--format', choices=['json', 'csv'], default='json')
+    export.add_argument('-d', '--output-dir', default='cache')
+    export.set_defaults(func=cmd_export)
+
+    merge = subparsers.add_parser('merge', help='合并多个清单')
+    merge.add_argument('files', nargs='+', metavar='FILE')
+    merge.add_argument('-o', '--output', required=True, help='合并后的文件名，如 inventory_merged.xlsx')
+    merge.add_argument('--no-image', action='store_true', help='不插入物品图片')
+    merge.set_defaults(func=cmd_merge)
+
+    sim = subparsers.add_parser('sim', help='在模拟的商店界面上运行购买流程，统计吞吐与正确性')
+    sim.add_argument('-n', '--items', type=int, default=30, help='清单中的物品数量')
+    sim.add_argument('--shelf', choices=['stuff', 'blueprint'], default='stuff')
+    sim.add_argument('--seed', type=int, help='随机种子，多次运行时依次加1')
+    sim.add_argument('--runs', type=int, default=1, help='运行次数')
+    sim.add_argument('--sold-out', type=float, default=0.1, help='已售罄商品的比例')
+    sim.add_argument('--max-stock', type=int, default=6, help='每种摆设的最大可购买数量')
+    sim.add_argument('--keep-order', action='store_true', help='商品按清单顺序排列，不打乱')
+    sim.add_argument('--font', help='绘制界面使用的字体文件')
+    sim.add_argument('--action-delay', type=float, help='覆盖配置的动作延迟')
+    sim.add_argument('--clients', type=int, default=1, help='模拟多开的窗口数，共用一个OCR与前台')
+    sim.add_argument('--ocr-latency', type=float, default=0.0, help='OCR替身的响应延迟秒数')
+    sim.add_argument('--profile', choices=['sample', 'cprofile'], help='剖析每次运行，在日志中输出最耗时的函数')
+    sim.set_defaults(func=cmd_sim)
+
+    ocr_bench = subparsers.add_parser('ocr-bench', help='测评OCR引擎的延迟与准确率，生成auto平台使用的报告')
+    ocr_bench.add_argument('corpus', help='标注好的截图目录，见 src/modules/ocrbench.py 的 load_corpus')
+    ocr_bench.add_argument('-e', '--engines', nargs='+', help='参与测评的引擎，默认为所有已注册的引擎')
+    ocr_bench.add_argument('-r', '--repeat', type=int, default=3, help='每张截图识别的次数')
+    ocr_bench.add_argument('--floor', type=float, help='准确率下限，默认使用配置项auto_ocr.accuracy_floor')
+    ocr_bench.add_argument('-o', '--output', help='报告保存路径，默认使用配置项auto_ocr.report')
+    ocr_bench.add_argument('--generate', type=int, metavar='COUNT', help='用商店模拟器生成每类COUNT张截图到corpus目录')
+    ocr_bench.add_argument('--font', help='生成截图使用的字体文件，需要能显示中文')
+    ocr_bench.add_argument('--seed', type=int, help='生成截图的随机种子')
+    ocr_bench.set_defaults(func=cmd_ocr_bench)
+
+    cook_tune = subparsers.add_parser('cook-tune', help='在录制的烹饪截图上调优截图区域、颜色容差与阈值，生成cooking使用的参数')
+    cook_tune.add_argument('corpus', help='录制并标注好的截图目录，见 src/modules/cooktune.py 的 load_corpus')
+    cook_tune.add_argument('-t', '--tolerances', type=int, nargs='+', help='参与搜索的颜色容差')
+    cook_tune.add_argument('--min-margin', type=int, default=20, help='1920x1080下阈值到误判的最小余量（像素数）')
+    cook_tune.add_argument('--full-width', action='store_true', help='保持录制时的宽度，只缩小高度，录制的料理种类较少时使用')
+    cook_tune.add_argument('-o', '--output', help='参数保存路径，默认使用配置项cooking.profile')
+    cook_tune.add_argument('--generate', type=int, metavar='COUNT', help='生成每种分辨率COUNT个模拟的烹饪序列到corpus目录')
+    cook_tune.add_argument('--seed', type=int, help='生成序列的随机种子')
+    cook_tune.set_defaults(func=cmd_cook_tune)
+
+    loadtest = subparsers.add_parser('loadtest', help='启动本地替身服务，压测摹本、图标或OCR客户端的吞吐与尾延迟')
+    loadtest.add_argument('target', choices=['blueprint', 'icon', 'ocr'], help='压测的接口')
+    loadtest.add_argument('-n', '--requests', type=int, default=200, help='调用次数')
+    loadtest.add_argument('-c', '--concurrency', type=int, default=4, help='并发数')
+    loadtest.add_argument('--latency', type=float, default=0.0, help='服务端的固定延迟秒数')
+    loadtest.add_argument('--jitter', type=float, default=0.0, help='服务端额外的随机延迟上限')
+    loadtest.add_argument('--error-rate', type=float, default=0.0, help='返回接口错误的比例')
+    loadtest.add_argument('--qps', type=float, default=0, help='服务端的QPS上限，0为不限流')
+    loadtest.set_defaults(func=cmd_loadtest)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.json:
+        log_to_stderr()
+    out = Output(args.json)
+    args.func(args, out)
+    return out.finish()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
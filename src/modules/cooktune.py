@@ -0,0 +1,386 @@
+"""
+Author: iota
+Create: 2024.4.2 21:16
+Project: YuanShenTool
+Path: src/modules/cooktune.py
+IDE: PyCharm
+Description: 烹饪检测参数的离线调优，在录制并标注好的烹饪帧上搜索最小的截图区域、颜色容差与像素阈值，按分辨率生成cooking使用的参数
+"""
+import json
+import math
+import os
+import random
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from src.modules.window import BASE_SIZE
+from src.utils.support import logger
+
+LABELS_FILENAME = 'labels.json'
+BEGIN_FILENAME = 'begin.png'
+TOLERANCES = 0, 2, 5, 8, 12, 16, 24
+# 搜索截图区域的网格间距，基于1920x1080的像素
+ROW_STEP = 4
+COLUMN_STEP = 20
+
+
+@dataclass(frozen=True)
+class CookingProfile:
+    """cooking的检测参数
+
+    scan_rect为1920x1080客户区上的坐标，threshold为实际分辨率下减少的像素数，
+    最佳区域的像素比开始时减少超过threshold即认为指针到达最佳区域
+    """
+    scan_rect: tuple[int, int, int, int] = (520, 680, 1400, 860)
+    color: tuple[int, int, int] = (255, 192, 64)
+    tolerance: int = 5
+    threshold: int = 100
+
+
+DEFAULT_PROFILE = CookingProfile()
+
+
+def resolution_key(size) -> str:
+    return '%dx%d' % tuple(size)
+
+
+def load_profile(filepath, size) -> CookingProfile:
+    """读取调优生成的参数，没有该分辨率的参数时使用默认值
+
+    :param size: 游戏窗口客户区的 (宽, 高)
+    """
+    if size is None or not os.path.exists(filepath):
+        return DEFAULT_PROFILE
+    try:
+        with open(filepath, 'r', encoding='UTF-8') as fp:
+            entry = (json.load(fp).get('profiles') or {}).get(resolution_key(size))
+    except (OSError, ValueError) as exc:
+        logger.warning(f'无法读取烹饪参数{filepath}：{exc!r}')
+        return DEFAULT_PROFILE
+    if not entry:
+        return DEFAULT_PROFILE
+    return CookingProfile(tuple(entry['scan_rect']), tuple(entry['color']), entry['tolerance'], entry['threshold'])
+
+
+def record_sequence(record_dir, size, rect, begin_image: Image.Image, frames: list[Image.Image], fired=None) -> str:
+    """保存一次烹饪的截图，并在labels.json中记录标注
+
+    标注的 [first, last] 为指针位于最佳区域内的第一帧与最后一帧的序号，
+    录制时先记为检测到达的那一帧，需要人工查看截图后修正，未到达时为null，调优时跳过
+
+    :param size: 游戏窗口客户区的 (宽, 高)
+    :param rect: 截图区域，1920x1080客户区上的坐标
+    :param fired: 检测到达最佳区域的帧序号
+    :return: 序列名称
+    """
+    name = '%s/%s' % (resolution_key(size), time.strftime('%Y%m%d-%H%M%S'))
+    sequence_dir = os.path.join(record_dir, name)
+    os.makedirs(sequence_dir, exist_ok=True)
+    begin_image.save(os.path.join(sequence_dir, BEGIN_FILENAME), compress_level=1)
+    for index, frame in enumerate(frames):
+        frame.save(os.path.join(sequence_dir, '%04d.png' % index), compress_level=1)
+
+    labels_path = os.path.join(record_dir, LABELS_FILENAME)
+    labels = {}
+    if os.path.exists(labels_path):
+        with open(labels_path, 'r', encoding='UTF-8') as fp:
+            labels = json.load(fp)
+    labels[name] = {'rect': list(rect), 'hits': None if fired is None else [fired, fired]}
+    with open(labels_path, 'w', encoding='UTF-8') as fp:
+        json.dump(labels, fp, ensure_ascii=False, indent=4)
+    return name
+
+
+@dataclass
+class Sequence:
+    """一次烹饪录制的截图，frame_names按时间顺序排列"""
+    name: str
+    size: tuple[int, int]
+    rect: tuple[int, int, int, int]
+    hits: tuple[int, int]
+    directory: str
+    frame_names: list[str]
+
+    def begin(self) -> np.ndarray:
+        return _load(os.path.join(self.directory, BEGIN_FILENAME))
+
+    def frames(self, stop=None):
+        for name in self.frame_names[:stop]:
+            yield _load(os.path.join(self.directory, name))
+
+
+def _load(filepath) -> np.ndarray:
+    with Image.open(filepath) as image:
+        return np.asarray(image.convert('RGB'))
+
+
+def load_corpus(corpus_dir) -> list[Sequence]:
+    """读取录制的烹饪截图
+
+    目录下的labels.json以序列的相对路径为键，路径的第一级目录为分辨率，例如：
+    {"1920x1080/20240402-211600": {"rect": [520, 680, 1400, 860], "hits": [41, 44]}}
+    每个序列目录下有开始时的截图begin.png和按顺序编号的0000.png、0001.png……
+    """
+    with open(os.path.join(corpus_dir, LABELS_FILENAME), 'r', encoding='UTF-8') as fp:
+        labels = json.load(fp)
+    sequences = []
+    for name, label in labels.items():
+        if not label.get('hits'):
+            logger.warning(f'没有标注到达最佳区域的帧，跳过：{name}')
+            continue
+        directory = os.path.join(corpus_dir, name)
+        width, height = map(int, name.replace('\\', '/').split('/', 1)[0].split('x'))
+        frame_names = sorted(filename for filename in os.listdir(directory)
+                             if filename.endswith('.png') and filename != BEGIN_FILENAME)
+        sequences.append(Sequence(name, (width, height), tuple(label['rect']), tuple(label['hits']),
+                                  directory, frame_names))
+    return sequences
+
+
+def _color_distance(image: np.ndarray, color) -> np.ndarray:
+    """各像素与目标颜色在每个通道上之差的最大值，不大于容差即为匹配的像素"""
+    return np.abs(image.astype(np.int16) - np.array(color, dtype=np.int16)).max(axis=-1)
+
+
+def _grid_integrals(image: np.ndarray, color, tolerances, ys, xs) -> np.ndarray:
+    """各容差下匹配像素的积分图在网格交点上的取值，形状为 (容差数, len(ys), len(xs))"""
+    distance = _color_distance(image, color)
+    result = np.empty((len(tolerances), len(ys), len(xs)), dtype=np.int32)
+    for t, tolerance in enumerate(tolerances):
+        integral = np.zeros((distance.shape[0] + 1, distance.shape[1] + 1), dtype=np.int32)
+        integral[1:, 1:] = (distance <= tolerance).cumsum(axis=0, dtype=np.int32).cumsum(axis=1, dtype=np.int32)
+        result[t] = integral[np.ix_(ys, xs)]
+    return result
+
+
+def _grid_sum(grid: np.ndarray, rois: np.ndarray) -> np.ndarray:
+    """网格上各区域 (j1, i1, j2, i2) 的和，grid的最后两维为网格交点"""
+    j1, i1, j2, i2 = rois.T
+    return grid[..., i2, j2] - grid[..., i1, j2] - grid[..., i2, j1] + grid[..., i1, j1]
+
+
+@dataclass
+class _Scanned:
+    """一组序列在网格上的像素减少量
+
+    截图区域只在网格上搜索，每帧只需保存积分图在网格交点上的取值，任意网格区域的减少量都能直接算出
+    """
+    ys: np.ndarray
+    xs: np.ndarray
+    # 每个序列一项，形状为 (容差数, 帧数, len(ys), len(xs))
+    drops: list[np.ndarray]
+    hits: list[tuple[int, int]]
+
+    def evaluate(self, rois: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """各容差、各区域在每个序列的标注范围之前与之内的最大减少量，形状为 (容差数, 区域数, 序列数)"""
+        pre, peak = [], []
+        for drops, (first, last) in zip(self.drops, self.hits):
+            values = _grid_sum(drops, rois)
+            pre.append(values[:, :first].max(axis=1, initial=0))
+            peak.append(values[:, first:last + 1].max(axis=1, initial=0))
+        return np.stack(pre, axis=-1), np.stack(peak, axis=-1)
+
+    def areas(self, rois: np.ndarray) -> np.ndarray:
+        j1, i1, j2, i2 = rois.T
+        return (self.xs[j2] - self.xs[j1]) * (self.ys[i2] - self.ys[i1])
+
+
+def _scan(sequences: list[Sequence], color, tolerances, scale) -> _Scanned:
+    height, width = sequences[0].begin().shape[:2]
+    ys = np.unique(np.minimum(np.round(np.arange(0, height / scale + ROW_STEP, ROW_STEP) * scale), height)).astype(np.intp)
+    xs = np.unique(np.minimum(np.round(np.arange(0, width / scale + COLUMN_STEP, COLUMN_STEP) * scale), width)).astype(np.intp)
+    scanned = _Scanned(ys, xs, [], [])
+    for sequence in sequences:
+        begin = _grid_integrals(sequence.begin(), color, tolerances, ys, xs)
+        first, last = sequence.hits
+        # 标注范围之后的帧不影响结果
+        frames = [begin - _grid_integrals(frame, color, tolerances, ys, xs)
+                  for frame in sequence.frames(stop=last + 1)]
+        if len(frames) <= first:
+            logger.warning(f'标注范围超出了录制的帧数，跳过：{sequence.name}')
+            continue
+        scanned.drops.append(np.stack(frames, axis=1))
+        scanned.hits.append((first, min(last, len(frames) - 1)))
+    return scanned
+
+
+def _choose_threshold(pre: np.ndarray, peak: np.ndarray) -> tuple[int, float, int]:
+    """选择使最多序列在标注范围内到达的阈值
+
+    阈值t对某个序列正确，当且仅当标注范围之前的像素减少量都不超过t，且范围内有超过t的帧，即 pre <= t < peak；
+    准确率相同的阈值中取最长连续区间的中点，离两侧最远
+
+    :param pre: 各序列在标注范围之前的最大减少量
+    :param peak: 各序列在标注范围内的最大减少量
+    :return: 阈值，准确率，余量（正确的序列中阈值到pre或peak的最小距离）
+    """
+    thresholds = np.arange(0, max(int(peak.max()), 1))
+    correct = (pre[:, None] <= thresholds) & (thresholds < peak[:, None])
+    accuracy = correct.mean(axis=0)
+    best = accuracy.max()
+
+    # 最长的连续区间
+    edges = np.diff(np.concatenate(([0], (accuracy == best).astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    longest = np.argmax(ends - starts)
+    threshold = int((starts[longest] + ends[longest] - 1) // 2)
+
+    ok = correct[:, threshold]
+    margin = int(np.minimum(threshold - pre[ok], peak[ok] - 1 - threshold).min()) if ok.any() else 0
+    return threshold, float(best), margin
+
+
+def _search(scanned: _Scanned, rois: np.ndarray, tolerances, min_margin) -> tuple:
+    """在候选区域中选择参数：准确率最高的组合中截图面积最小的，余量不小于min_margin的组合优先
+
+    :return: (准确率, 余量, 面积, 容差, 区域, 阈值)
+    """
+    pre, peak = scanned.evaluate(rois)
+    areas = scanned.areas(rois)
+    results = []
+    for t, tolerance in enumerate(tolerances):
+        for r, roi in enumerate(rois):
+            threshold, accuracy, margin = _choose_threshold(pre[t, r], peak[t, r])
+            results.append((accuracy, margin, int(areas[r]), tolerance, tuple(roi), threshold))
+
+    best_accuracy = max(result[0] for result in results)
+    candidates = [result for result in results if result[0] == best_accuracy]
+    robust = [result for result in candidates if result[1] >= min_margin]
+    if robust:
+        return min(robust, key=lambda item: (item[2], -item[1], item[3]))
+    return max(candidates, key=lambda item: (item[1], -item[2]))
+
+
+def _to_base(rect, size, roi) -> tuple[int, int, int, int]:
+    """录制截图中的区域转换为1920x1080客户区坐标，向外取整，截图时不会变小"""
+    sx, sy = size[0] / BASE_SIZE[0], size[1] / BASE_SIZE[1]
+    ox, oy = round(rect[0] * sx), round(rect[1] * sy)
+    x1, y1, x2, y2 = (int(v) for v in roi)
+    return (math.floor((ox + x1) / sx), math.floor((oy + y1) / sy),
+            math.ceil((ox + x2) / sx), math.ceil((oy + y2) / sy))
+
+
+def tune(sequences: list[Sequence], tolerances=TOLERANCES, min_margin=20, full_width=False, progress=None) -> dict:
+    """为每种分辨率搜索参数
+
+    先在完整的宽度上搜索行的范围，再在选定的行上搜索列的范围；
+    列的范围只覆盖录制到的最佳区域，需要录制不同料理的烹饪，否则使用full_width
+
+    :param min_margin: 1920x1080下阈值的最小余量，其他分辨率按面积比例换算
+    :param full_width: 截图区域保持录制时的宽度，只缩小高度
+    :param progress: 进度回调，以关键字参数 done/total/message 调用
+    :return: 调优报告，profiles下为 {分辨率: {scan_rect, color, tolerance, threshold, accuracy, margin, ...}}
+    """
+    tolerances = sorted(set(tolerances) | {DEFAULT_PROFILE.tolerance})
+    color = DEFAULT_PROFILE.color
+    groups = {}
+    for sequence in sequences:
+        groups.setdefault((sequence.size, sequence.rect), []).append(sequence)
+
+    report = {'generated_at': time.strftime('%Y-%m-%d %H:%M:%S'), 'profiles': {}}
+    for done, ((size, rect), group) in enumerate(sorted(groups.items()), 1):
+        key = resolution_key(size)
+        if key in report['profiles']:
+            logger.warning(f'{key}有多个录制区域，只使用第一个：跳过{rect}的{len(group)}个序列')
+            continue
+        scale = size[1] / BASE_SIZE[1]
+        scanned = _scan(group, color, tolerances, scale)
+        if not scanned.drops:
+            continue
+        rows, columns = len(scanned.ys) - 1, len(scanned.xs) - 1
+        margin_pixels = min_margin * scale * scale
+
+        row_rois = np.array([(0, i1, columns, i2) for i1 in range(rows) for i2 in range(i1 + 1, rows + 1)])
+        accuracy, margin, area, tolerance, roi, threshold = _search(scanned, row_rois, tolerances, margin_pixels)
+        if not full_width:
+            _, i1, _, i2 = roi
+            column_rois = np.array([(j1, i1, j2, i2) for j1 in range(columns) for j2 in range(j1 + 1, columns + 1)])
+            accuracy, margin, area, tolerance, roi, threshold = _search(scanned, column_rois, tolerances, margin_pixels)
+        if margin < margin_pixels:
+            logger.warning(f'{key}没有余量达到{min_margin}的参数，选择余量最大的')
+
+        # 默认参数在同一批录制上的准确率，用于对比
+        full = np.array([(0, 0, columns, rows)])
+        pre, peak = scanned.evaluate(full)
+        t0 = tolerances.index(DEFAULT_PROFILE.tolerance)
+        baseline = np.mean((pre[t0, 0] <= DEFAULT_PROFILE.threshold) & (DEFAULT_PROFILE.threshold < peak[t0, 0]))
+        j1, i1, j2, i2 = roi
+        report['profiles'][key] = {
+            'scan_rect': list(_to_base(rect, size, (scanned.xs[j1], scanned.ys[i1], scanned.xs[j2], scanned.ys[i2]))),
+            'color': list(color),
+            'tolerance': tolerance,
+            'threshold': threshold,
+            'accuracy': round(accuracy, 4),
+            'margin': margin,
+            'area_ratio': round(area / int(scanned.areas(full)[0]), 4),
+            'sequences': len(scanned.drops),
+            'baseline_accuracy': round(float(baseline), 4),
+        }
+        if progress:
+            progress(done=done, total=len(groups), message=f'已完成{key}')
+    return report
+
+
+def save_report(filepath, report):
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    with open(filepath, 'w', encoding='UTF-8') as fp:
+        json.dump(report, fp, ensure_ascii=False, indent=4)
+
+
+def generate_corpus(corpus_dir, count=10, sizes=((1920, 1080), (1280, 720)), seed=None) -> int:
+    """生成已标注的模拟烹饪截图，用于检查调优流程
+
+    截图区域内有一条进度条、位置随机的最佳区域、匀速移动的指针，以及一块颜色与最佳区域相近的装饰；
+    指针的中心位于最佳区域内的帧即为标注范围
+
+    :param count: 每种分辨率的序列数量
+    :return: 生成的序列数量
+    """
+    rng = random.Random(seed)
+    noise = np.random.default_rng(seed)
+    rect = DEFAULT_PROFILE.scan_rect
+    bar_top, bar_bottom, bar_left, bar_right = 96, 112, 40, 840
+    labels = {}
+
+    for width, height in sizes:
+        scale = height / BASE_SIZE[1]
+        crop_size = (round(rect[2] * width / BASE_SIZE[0]) - round(rect[0] * width / BASE_SIZE[0]),
+                     round(rect[3] * scale) - round(rect[1] * scale))
+
+        def box(x1, y1, x2, y2):
+            return round(x1 * scale), round(y1 * scale), round(x2 * scale) - 1, round(y2 * scale) - 1
+
+        for i in range(count):
+            zone_left = rng.randint(150, 700)
+            zone_right = zone_left + rng.randint(50, 90)
+            speed = rng.uniform(6, 14)
+
+            def render(pointer=None) -> Image.Image:
+                image = Image.new('RGB', crop_size, (60, 50, 40))
+                draw = ImageDraw.Draw(image)
+                draw.rectangle(box(300, 10, 580, 30), fill=(250, 186, 70))
+                draw.rectangle(box(bar_left, bar_top, bar_right, bar_bottom), fill=(200, 200, 200))
+                draw.rectangle(box(zone_left, bar_top, zone_right, bar_bottom), fill=DEFAULT_PROFILE.color)
+                if pointer is not None:
+                    draw.rectangle(box(pointer - 4, bar_top - 6, pointer + 4, bar_bottom + 6), fill=(250, 250, 250))
+                array = np.asarray(image).astype(np.int16) + noise.integers(-3, 4, (crop_size[1], crop_size[0], 3))
+                return Image.fromarray(array.clip(0, 255).astype(np.uint8))
+
+            positions = [bar_left + speed * index for index in range(int((bar_right - bar_left) / speed))]
+            inside = [index for index, x in enumerate(positions) if zone_left <= x <= zone_right]
+            # 实际录制在检测到达后停止，只保留标注范围之后的几帧
+            positions = positions[:inside[-1] + 4]
+            name = '%s/%04d' % (resolution_key((width, height)), i)
+            sequence_dir = os.path.join(corpus_dir, name)
+            os.makedirs(sequence_dir, exist_ok=True)
+            render().save(os.path.join(sequence_dir, BEGIN_FILENAME), compress_level=1)
+            for index, x in enumerate(positions):
+                render(x).save(os.path.join(sequence_dir, '%04d.png' % index), compress_level=1)
+            labels[name] = {'rect': list(rect), 'hits': [inside[0], inside[-1]]}
+
+    with open(os.path.join(corpus_dir, LABELS_FILENAME), 'w', encoding='UTF-8') as fp:
+        json.dump(labels, fp, ensure_ascii=False, indent=4)
+    return len(labels)
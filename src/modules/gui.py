@@ -7,14 +7,16 @@ IDE: PyCharm
 Description: 实现图形界面
 """
 import os
-import threading
+import re
 import tkinter as tk
 import traceback
 from tkinter import messagebox, simpledialog
 from tkinter.ttk import Combobox
 
 from src.modules.inv import FetchInv, get_inv_filelist
+from src.modules.task import TaskExecutor
 from src.utils.support import SYSTEM_NAME, logger
+from src.utils.trace import tracer
 
 opr = None
 try:
@@ -72,12 +74,16 @@ class MainWindow:
         self.__combobox = None
         self.add_combobox()
 
+        self.executor = TaskExecutor(self.root)
+        self.status_panel = StatusPanel(self.root, x=90, y=20)
+
         self.root.protocol('WM_DELETE_WINDOW', self.__on_closing)
         logger.info('GUI -ok')
 
     def __on_closing(self):
         if opr and hasattr(opr, 'StopAll'):
             opr.StopAll = True
+        self.executor.shutdown()
         self.root.destroy()
         logger.info('UI程序已退出')
 
@@ -107,6 +113,34 @@ class MainWindow:
             self.__combobox.current(0)
         self.__combobox.bind('<<ComboboxSelected>>', lambda event: self.__combobox.select_clear())
 
+    def __run_task(self, kind, func, *args, on_done=None):
+        """在后台执行操作，进度和结果显示在状态栏中
+
+        :param kind: 操作类型，同类操作同时只运行一个
+        :param on_done: 结束回调，参数为 (成功标志, 消息)，默认直接显示结果
+        """
+
+        def done(task, result):
+            symbol, message = result
+            if on_done is None:
+                self.__show_result(kind, symbol, message)
+            else:
+                on_done(symbol, message)
+
+        task = self.executor.submit(kind, func, *args, on_done=done,
+                                    on_progress=lambda t: self.status_panel.update(kind, t.describe()))
+        if task is None:
+            messagebox.showwarning('警告', '任务正在运行', parent=self.root)
+        else:
+            self.status_panel.update(kind, '开始')
+
+    def __show_result(self, kind, symbol, message):
+        """在状态栏显示运行结果，启用追踪时将耗时统计放入状态栏的提示中"""
+        self.status_panel.update(kind, ('完成：' if symbol else '失败：') + str(message))
+        if tracer.enabled and tracer.last_summary:
+            self.status_panel.set_details(tracer.last_summary)
+            tracer.last_summary = ''
+
     def __buy_commodities(self, shelf):
         inv_file = self.__combobox.get()
         if not inv_file:
@@ -114,8 +148,11 @@ class MainWindow:
             return
         logger.info(f'Used File: {inv_file}')
         symbol, message = check_opr_module()
-        if symbol:
-            symbol, message = opr.buy_commodities(shelf, inv_file)
+        if not symbol:
+            self.__show_result('buy', symbol, message)
+            return
+
+        def on_done(symbol, message):
             if message == '<refresh_access_token>':
                 api_key = simpledialog.askstring('「OCR」需要刷新令牌', 'Api Key:', show='·', parent=self.root)
                 secret_key = simpledialog.askstring('继续输入', 'Secret Key:', show='*', parent=self.root)
@@ -125,20 +162,34 @@ class MainWindow:
                 else:
                     opr.ocr.save_ocr_keys(api_key, secret_key)
                     symbol, message = True, '刷新token成功，请重新开始'
-        messagebox.showinfo('完成' if symbol else '失败', message)
+            self.__show_result('buy', symbol, message)
+
+        windows = opr.count_game_windows()
+        if windows > 1:
+            answer = simpledialog.askstring(
+                '多开', f'检测到{windows}个游戏窗口，按窗口顺序输入各自的清单文件（以空格分隔），只输入一个时只操作当前窗口：',
+                initialvalue=inv_file, parent=self.root)
+            if answer is None:
+                return
+            inv_files = answer.split()
+            if len(inv_files) > 1:
+                self.__run_task('buy', opr.buy_commodities_multi, shelf, inv_files, on_done=on_done)
+                return
+        self.__run_task('buy', opr.buy_commodities, shelf, inv_file, on_done=on_done)
 
     def __fetch_inventory(self):
-        fetcher = FetchInv()
-        share_code = simpledialog.askstring('清单', '摹本分享码：', parent=self.root)
+        share_code = simpledialog.askstring('清单', '摹本分享码（多个分享码以空格分隔，将合并为一个清单）：',
+                                            parent=self.root)
         if share_code is None:
             return
-        elif not (share_code.isdigit() and len(share_code) > 9):
+        share_codes = re.split(r'[\s,，]+', share_code.strip())
+        if not all(code.isdigit() and len(code) > 9 for code in share_codes):
             messagebox.showwarning('警告', '分享码错误')
             return
+        self.__submit_fetch(FetchInv(), share_codes, retries=1)
 
-        for _ in range(2):
-            symbol, message = fetcher.fetch_inventory(share_code=share_code)
-            # symbol, message = True, 'inventory_%s.xlsx' % share_code
+    def __submit_fetch(self, fetcher, share_codes, retries):
+        def on_done(symbol, message):
             if symbol:
                 logger.info(f'获取清单成功，保存路径：「{message}」')
                 cur_vals = list(self.__combobox['values'])
@@ -148,15 +199,22 @@ class MainWindow:
                 cur_vals.append(message)
                 self.__combobox['values'] = cur_vals
                 self.__combobox.current(len(cur_vals) - 1)
-                return
             elif message == '<set_cookie>':
-                cookie = simpledialog.askstring('清单', '请输入新的有效cookie', parent=self.root)
-                fetcher.web.set_cookie(cookie)
+                if retries <= 0:
+                    messagebox.showwarning('警告', 'cookie无效，请检查')
+                    message = 'cookie无效'
+                elif cookie := simpledialog.askstring('清单', '请输入新的有效cookie', parent=self.root):
+                    fetcher.web.set_cookie(cookie)
+                    self.__submit_fetch(fetcher, share_codes, retries - 1)
+                    return
             else:
-                messagebox.showerror('错误', message)
                 logger.error(f'获取失败：「{message}」')
-                return
-        messagebox.showwarning('警告', 'cookie无效，请检查')
+            self.__show_result('fetch', symbol, message)
+
+        if len(share_codes) > 1:
+            self.__run_task('fetch', fetcher.fetch_inventories, share_codes, on_done=on_done)
+        else:
+            self.__run_task('fetch', fetcher.fetch_inventory, share_codes[0], on_done=on_done)
 
     def __open_inventory(self):
         selected_file = self.__combobox.get()
@@ -165,30 +223,22 @@ class MainWindow:
             messagebox.showerror('错误', '打开失败')
 
     def __play_plots(self):
-        for thd in threading.enumerate():
-            if thd.name == 'pp':
-                messagebox.showwarning('警告', '线程正在运行', parent=self.root)
-                return
-
-        def pp():
-            symbol, message = check_opr_module()
-            if symbol:
-                symbol, message = opr.play_plots()
-            messagebox.showinfo('完成' if symbol else '失败', message)
-
-        pp_thr = threading.Thread(target=pp, name='pp')
-        pp_thr.daemon = True
-        pp_thr.start()
+        symbol, message = check_opr_module()
+        if not symbol:
+            self.__show_result('play_plots', symbol, message)
+            return
+        self.__run_task('play_plots', opr.play_plots)
 
     def __cooking(self):
         symbol, message = check_opr_module()
-        if symbol:
-            count = simpledialog.askinteger('烹饪', '请输入次数：',
-                                            initialvalue=15, minvalue=1, maxvalue=20, parent=self.root)
-            if count is None:
-                return
-            symbol, message = opr.cooking(count)
-        messagebox.showinfo('完成' if symbol else '失败', message)
+        if not symbol:
+            self.__show_result('cooking', symbol, message)
+            return
+        count = simpledialog.askinteger('烹饪', '请输入次数：',
+                                        initialvalue=15, minvalue=1, maxvalue=20, parent=self.root)
+        if count is None:
+            return
+        self.__run_task('cooking', opr.cooking, count)
 
     def toggle_topmost(self, window, bind_button):
         if window.attributes('-topmost'):
@@ -204,6 +254,31 @@ class MainWindow:
         self.root.mainloop()
 
 
+class StatusPanel:
+    """显示各后台任务的实时状态"""
+
+    TASK_NAMES = {
+        'buy': '购买',
+        'fetch': '获取清单',
+        'play_plots': '播放剧情',
+        'cooking': '烹饪料理'
+    }
+
+    def __init__(self, root, x, y):
+        self.label = tk.Label(root, text='就绪', justify='left', anchor='w',
+                              background='#EFF', foreground='#0E76F8')
+        self.label.place(x=x, y=y)
+        self.tooltip = Tooltip(self.label, '鼠标悬停可查看耗时统计（需开启trace）')
+        self.__lines = {}
+
+    def update(self, kind, text):
+        self.__lines[kind] = text
+        self.label.config(text='\n'.join('[%s] %s' % (self.TASK_NAMES.get(k, k), v) for k, v in self.__lines.items()))
+
+    def set_details(self, text):
+        self.tooltip.text = text
+
+
 class Tooltip:
     def __init__(self, widget, text):
         self.widget = widget
@@ -0,0 +1,146 @@
+"""
+Author: iota
+Create: 2024.3.16 14:30
+Project: YuanShenTool
+Path: src/modules/inputs.py
+IDE: PyCharm
+Description: 输入事件调度，将动作序列编排为带时间戳的事件批次，按单调时钟的截止时间发送
+"""
+import time
+from dataclasses import dataclass
+
+from src.utils.cancel import current_token
+from src.utils.trace import percentile
+
+# 剩余时间小于该值时改为忙等，弥补sleep的精度不足
+SPIN_THRESHOLD = 0.002
+
+
+@dataclass
+class InputEvent:
+    at: float  # 相对批次开始的秒数
+    kind: str  # move / down / up / wheel
+    x: int = 0
+    y: int = 0
+    delta: int = 0
+
+
+class InputBatch:
+    """按时间顺序编排的一批输入事件，构建方法可以链式调用"""
+
+    def __init__(self):
+        self.events: list[InputEvent] = []
+        self.cursor = 0.0
+
+    def pause(self, seconds):
+        self.cursor += seconds
+        return self
+
+    def move(self, x, y):
+        self.events.append(InputEvent(self.cursor, 'move', round(x), round(y)))
+        return self
+
+    def click(self, x, y, hold=0.0):
+        """移动到指定位置并点击
+
+        :param hold: 按下到抬起之间的秒数
+        """
+        self.move(x, y)
+        self.events.append(InputEvent(self.cursor, 'down', round(x), round(y)))
+        self.cursor += hold
+        self.events.append(InputEvent(self.cursor, 'up', round(x), round(y)))
+        return self
+
+    def click_burst(self, x, y, count, interval):
+        """在同一位置连续点击count次，每次间隔interval秒"""
+        for i in range(count):
+            if i:
+                self.pause(interval)
+            self.click(x, y)
+        return self
+
+    def scroll_ramp(self, count, duration, step=1):
+        """在duration秒内均匀发送count次滚轮事件
+
+        :param step: 每次滚动的方向与幅度
+        """
+        interval = duration / count if count else 0
+        for i in range(count):
+            if i:
+                self.pause(interval)
+            self.events.append(InputEvent(self.cursor, 'wheel', delta=step))
+        return self
+
+
+class Win32Sink:
+    """通过Win32 API发送输入事件"""
+
+    # 与之前直接调用mouse_event时使用的参数保持一致
+    MOUSE_FLAGS = {'down': 2, 'up': 4, 'wheel': 8}
+
+    def __init__(self):
+        import win32api
+
+        self.__win32api = win32api
+
+    def send(self, event: InputEvent):
+        if event.kind == 'move':
+            self.__win32api.SetCursorPos((event.x, event.y))
+        elif event.kind == 'wheel':
+            self.__win32api.mouse_event(self.MOUSE_FLAGS['wheel'], 0, 0, event.delta)
+        else:
+            self.__win32api.mouse_event(self.MOUSE_FLAGS[event.kind], event.x, event.y, 0, 0)
+
+
+class FakeSink:
+    """只记录事件与发送时间，供测试和模拟器使用"""
+
+    def __init__(self):
+        self.sent: list[tuple[float, InputEvent]] = []
+
+    def send(self, event: InputEvent):
+        self.sent.append((time.perf_counter(), event))
+
+
+class InputScheduler:
+    """按截止时间发送事件批次，并统计实际发送时间与计划时间的偏差"""
+
+    def __init__(self, sink, max_samples=10000):
+        self.sink = sink
+        self.__jitters = []
+        self.__max_samples = max_samples
+
+    def dispatch(self, batch: InputBatch):
+        """发送一个批次，所在流程被取消时剩余事件不再发送"""
+        token = current_token()
+        start = time.perf_counter()
+        for event in batch.events:
+            deadline = start + event.at
+            remaining = deadline - time.perf_counter()
+            if remaining > SPIN_THRESHOLD:
+                token.sleep(remaining - SPIN_THRESHOLD)
+            while time.perf_counter() < deadline:
+                pass
+            self.sink.send(event)
+            self.__record(time.perf_counter() - deadline)
+
+    def __record(self, jitter):
+        if len(self.__jitters) >= self.__max_samples:
+            self.__jitters = self.__jitters[self.__max_samples // 2:]
+        self.__jitters.append(jitter)
+
+    def stats(self) -> dict[str, float]:
+        """事件发送偏差的统计，单位毫秒"""
+        jitters = sorted(self.__jitters)
+        return {
+            'count': len(jitters),
+            'p50': percentile(jitters, 50) * 1e3,
+            'p95': percentile(jitters, 95) * 1e3,
+            'max': (jitters[-1] if jitters else 0) * 1e3,
+        }
+
+    def format_stats(self) -> str:
+        return '输入事件%(count)d个，时间偏差 p50=%(p50).2fms p95=%(p95).2fms max=%(max).2fms' % self.stats()
+
+    def reset_stats(self):
+        self.__jitters = []
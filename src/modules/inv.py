@@ -6,24 +6,191 @@ Path: src/modules/inv.py
 IDE: PyCharm
 Description: 获取/操作需求清单
 """
+import csv
+import io
+import json
+import mmap
 import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 from openpyxl import Workbook, load_workbook
 from openpyxl.drawing.image import Image
 from openpyxl.styles import Alignment, Font, PatternFill
+from PIL import Image as PILImage
 
+from src.utils.cancel import HTTP_TIMEOUT
+from src.utils.common import dump_json_to_file, load_json_from_file
 from src.utils.cyber import UA
 from src.utils.support import SYSTEM_NAME, logger, pub_config
+from src.utils.trace import tracer
 
 if not os.path.exists('cache/'):
     os.makedirs('cache/')
 
 
+class BlueprintCache:
+    """摹本接口响应的本地缓存
+
+    每个分享码和区服对应 cache/blueprints/ 下的一个json文件，只缓存成功的响应
+    """
+
+    def __init__(self, ttl, cache_dir='cache/blueprints/'):
+        """
+        :param ttl: 缓存有效期，单位秒
+        :param cache_dir: 缓存目录
+        """
+        self.ttl = ttl
+        self.__cache_dir = cache_dir
+        if not os.path.exists(self.__cache_dir):
+            os.makedirs(self.__cache_dir)
+
+    def __path(self, share_code, region):
+        return '%s/%s_%s.json' % (self.__cache_dir, region, share_code)
+
+    def get(self, share_code, region) -> dict | None:
+        """读取缓存条目，格式为 {'fetched_at', 'etag', 'last_modified', 'result'}"""
+        path = self.__path(share_code, region)
+        if not os.path.exists(path):
+            return None
+        try:
+            return load_json_from_file(path)
+        except (OSError, ValueError):
+            logger.warning(f'缓存文件已损坏：{path}')
+            return None
+
+    def is_fresh(self, entry) -> bool:
+        return time.time() - entry['fetched_at'] < self.ttl
+
+    def put(self, share_code, region, result, etag=None, last_modified=None):
+        entry = {
+            'fetched_at': time.time(),
+            'etag': etag,
+            'last_modified': last_modified,
+            'result': result
+        }
+        # 先写临时文件再替换，避免中断时留下不完整的缓存
+        path = self.__path(share_code, region)
+        dump_json_to_file(path + '.tmp', entry)
+        os.replace(path + '.tmp', path)
+
+    def touch(self, share_code, region, entry):
+        """重新验证通过后刷新缓存时间"""
+        self.put(share_code, region, entry['result'], entry['etag'], entry['last_modified'])
+
+
+class IconStore:
+    """物品图标的打包缓存
+
+    图标统一缩放为ICON_SIZE见方的缩略图，依次追加到一个pack文件中，另用json索引记录每个ID的偏移和长度；
+    读取时通过mmap映射pack文件，不需要逐个打开小文件
+    """
+
+    ICON_SIZE = 40
+
+    def __init__(self, pack_path='cache/item_icons.pack', legacy_dir='cache/item_icons/'):
+        """
+        :param pack_path: pack文件路径，索引保存在同名的.idx文件中
+        :param legacy_dir: 旧版逐个保存图标的目录，存在时迁移到pack文件后删除
+        """
+        self.__pack_path = pack_path
+        self.__index_path = os.path.splitext(pack_path)[0] + '.idx'
+        self.__index = load_json_from_file(self.__index_path) if os.path.exists(self.__index_path) else {}
+        self.__dirty = False
+        self.__map = None
+        self.__lock = threading.Lock()
+        if os.path.isdir(legacy_dir):
+            self.__migrate(legacy_dir)
+
+    def __contains__(self, item_id):
+        return str(item_id) in self.__index
+
+    def __len__(self):
+        return len(self.__index)
+
+    @classmethod
+    def make_thumbnail(cls, image_bytes) -> bytes:
+        """缩放为保持比例、居中、透明背景的缩略图"""
+        image = PILImage.open(io.BytesIO(image_bytes)).convert('RGBA')
+        image.thumbnail((cls.ICON_SIZE, cls.ICON_SIZE), PILImage.LANCZOS)
+        canvas = PILImage.new('RGBA', (cls.ICON_SIZE, cls.ICON_SIZE), (0, 0, 0, 0))
+        canvas.paste(image, ((cls.ICON_SIZE - image.width) // 2, (cls.ICON_SIZE - image.height) // 2))
+        buffer = io.BytesIO()
+        canvas.save(buffer, format='PNG', optimize=True)
+        return buffer.getvalue()
+
+    def put(self, item_id, image_bytes):
+        """保存图标，索引在flush时写入"""
+        thumbnail = self.make_thumbnail(image_bytes)
+        with self.__lock:
+            with open(self.__pack_path, 'ab') as fp:
+                offset = fp.tell()
+                fp.write(thumbnail)
+            self.__index[str(item_id)] = [offset, len(thumbnail)]
+            self.__dirty = True
+
+    def get(self, item_id) -> bytes | None:
+        """读取缩略图的PNG数据"""
+        with self.__lock:
+            entry = self.__index.get(str(item_id))
+            if entry is None:
+                return None
+            offset, length = entry
+            if self.__map is None or offset + length > len(self.__map):
+                # pack文件追加过内容，重新映射
+                if self.__map is not None:
+                    self.__map.close()
+                with open(self.__pack_path, 'rb') as fp:
+                    self.__map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.__map[offset:offset + length]
+
+    def flush(self):
+        """写入索引，先写临时文件再替换"""
+        with self.__lock:
+            if not self.__dirty:
+                return
+            dump_json_to_file(self.__index_path + '.tmp', self.__index)
+            os.replace(self.__index_path + '.tmp', self.__index_path)
+            self.__dirty = False
+
+    def close(self):
+        self.flush()
+        with self.__lock:
+            if self.__map is not None:
+                self.__map.close()
+                self.__map = None
+
+    def __migrate(self, legacy_dir):
+        count = 0
+        for filename in os.listdir(legacy_dir):
+            item_id, ext = os.path.splitext(filename)
+            if ext != '.png' or item_id in self.__index:
+                continue
+            try:
+                with open(os.path.join(legacy_dir, filename), 'rb') as fp:
+                    self.put(item_id, fp.read())
+                count += 1
+            except (OSError, PILImage.UnidentifiedImageError) as exc:
+                logger.warning(f'无法迁移图标{filename}：{exc!r}')
+        self.flush()
+        shutil.rmtree(legacy_dir, ignore_errors=True)
+        logger.info(f'已将{count}个图标迁移到{self.__pack_path}')
+
+
 class Web:
     """网络接口的请求"""
 
-    def __init__(self):
+    def __init__(self, offline=None, base_url=None):
+        """
+        :param offline: 离线模式，只使用本地缓存，默认使用配置项blueprint_cache.offline
+        :param base_url: 接口地址，默认使用配置项mihoyo_api.base_url，压测时指向本地替身服务
+        """
+        self.base_url = (base_url or (pub_config.get('mihoyo_api') or {}).get('base_url')
+                         or 'https://api-takumi.mihoyo.com').rstrip('/')
         self.__cookie_path = 'cache/mys_cookie.txt'
         if os.path.exists(self.__cookie_path):
             with open(self.__cookie_path, 'r', encoding='ASCII') as fp:
@@ -31,6 +198,10 @@ class Web:
         else:
             self.cookie = None
 
+        cache_config = pub_config.get('blueprint_cache') or {}
+        self.offline = cache_config.get('offline', False) if offline is None else offline
+        self.cache = BlueprintCache(ttl=cache_config.get('ttl', 3600))
+
     def cookie_is_valid(self):
         return self.cookie and len(self.cookie) > 50 and self.cookie.isascii()
 
@@ -46,60 +217,102 @@ class Web:
             with open(self.__cookie_path, 'w', encoding='ASCII') as fp:
                 fp.write(self.cookie)
 
-    def get_inventory(self, share_code):
+    @tracer.traced('web.get_inventory')
+    def get_inventory(self, share_code, region='cn_gf01'):
         """摹本物品列表的请求方法
 
+        缓存有效期内直接返回缓存；过期后带上条件请求头重新验证；请求失败时使用过期的缓存
+
         :param share_code: 摹本分享码
+        :param region: 区服
         :return: 接口返回数据
         """
-        url = 'https://api-takumi.mihoyo.com/event/e20200928calculate/v1/furniture/blueprint'
+        entry = self.cache.get(share_code, region)
+        if entry and (self.offline or self.cache.is_fresh(entry)):
+            logger.debug('使用缓存：%s %s', region, share_code)
+            return entry['result']
+        elif self.offline:
+            raise requests.ConnectionError(f'离线模式下没有缓存：{share_code}')
+
+        url = self.base_url + '/event/e20200928calculate/v1/furniture/blueprint'
         params = {
             'share_code': share_code,
-            'region': 'cn_gf01'
+            'region': region
         }
         headers = {
             'Cookie': self.cookie,
             'Referer': 'https://webstatic.mihoyo.com/',
             'User-Agent': UA
         }
-        logger.debug('==> GET %s P=%s' % (url, params))
-        response = requests.get(url, params=params, headers=headers)
-        logger.debug('<== %s %s %s' % (response.status_code, url, response.text[:100]))
-        return response.json()
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        logger.debug('==> GET %s P=%s', url, params)
+        try:
+            response = requests.get(url, params=params, headers=headers, timeout=HTTP_TIMEOUT)
+        except requests.RequestException as exc:
+            if entry is None:
+                raise
+            logger.warning(f'请求失败，使用过期的缓存：{exc!r}')
+            return entry['result']
+        logger.debug('<== %s %s %.100s', response.status_code, url, response.text)
+
+        if response.status_code == 304 and entry:
+            self.cache.touch(share_code, region, entry)
+            return entry['result']
+        elif response.status_code >= 500 and entry:
+            logger.warning(f'服务器错误{response.status_code}，使用过期的缓存')
+            return entry['result']
+
+        result = response.json()
+        if result.get('data'):
+            self.cache.put(share_code, region, result,
+                           etag=response.headers.get('ETag'),
+                           last_modified=response.headers.get('Last-Modified'))
+        return result
 
 
 class FetchInv:
     """获取需求清单"""
 
-    def __init__(self):
+    def __init__(self, auto_open=True, insert_image=None, incremental=None):
+        """
+        :param auto_open: 保存后是否用系统默认方式打开清单
+        :param insert_image: 是否插入物品图片，默认使用配置项insert_image
+        :param incremental: 清单已存在时是否只更新变化的行并保留已有数量，默认使用配置项incremental_refresh
+        """
         self.web = Web()
-        self.__workbook = Workbook()
-        self.__worksheet = self.__workbook.active
+        self.auto_open = auto_open
+        self.insert_image = pub_config['insert_image'] if insert_image is None else insert_image
+        self.incremental = pub_config.get('incremental_refresh', True) if incremental is None else incremental
 
-        self.__icon_dir = 'cache/item_icons/'
-        if os.path.exists(self.__icon_dir):
-            self.__item_ids = {_[:-4] for _ in os.listdir(self.__icon_dir)}
-        else:
-            self.__item_ids = {}
-            os.makedirs(self.__icon_dir)
+        self.icons = IconStore()
 
-    def fetch_inventory(self, share_code):
+    @tracer.session('fetch_inventory')
+    def fetch_inventory(self, share_code, progress=None):
         """请求接口获得列表后，提取数据并保存为Excel文件
 
         :param share_code: 分享码
+        :param progress: 进度回调，以关键字参数 message 调用
         :return: 成功标志，消息
         """
         if not share_code:
             return False, '摹本分享码不能为空'
-        elif not self.web.cookie_is_valid():
+        elif not (self.web.offline or self.web.cookie_is_valid()):
             return False, '<set_cookie>'
 
         try:
+            if progress:
+                progress(message=f'获取清单 {share_code}')
             result = self.web.get_inventory(share_code)
             if result['data']:
                 info_list = result['data']['list'] + result['data']['not_calc_list']
                 filename = 'inventory_%s.xlsx' % share_code
-                self.__save_inventory_as_xlsx(info_list, filename)
+                if progress:
+                    progress(message=f'保存清单，共{len(info_list)}项')
+                self.__store_inventory(info_list, filename)
                 return True, filename
             elif result['retcode'] == -100:
                 self.web.set_cookie(value='')
@@ -111,75 +324,321 @@ class FetchInv:
         except requests.JSONDecodeError:
             return False, '响应结果解析失败'
 
-    def __save_inventory_as_xlsx(self, data: list[dict], filename):
+    @tracer.session('fetch_inventories')
+    def fetch_inventories(self, share_codes, merged_filename=None, progress=None):
+        """并发请求多个分享码，按物品ID汇总所有物品后保存为一个清单
+
+        :param share_codes: 分享码列表
+        :param merged_filename: 保存文件名，默认由分享码拼接而成
+        :param progress: 进度回调，以关键字参数 done/total/message 调用
+        :return: 成功标志，消息
+        """
+        share_codes = list(dict.fromkeys(share_codes))
+        if not share_codes:
+            return False, '摹本分享码不能为空'
+        elif not (self.web.offline or self.web.cookie_is_valid()):
+            return False, '<set_cookie>'
+
+        sources = {}
+        with ThreadPoolExecutor(max_workers=pub_config.get('fetch_max_workers', 4),
+                                thread_name_prefix='fetch_inv') as executor:
+            futures = {executor.submit(tracer.bind(self.web.get_inventory), code): code for code in share_codes}
+            for done, future in enumerate(as_completed(futures), 1):
+                share_code = futures[future]
+                try:
+                    result = future.result()
+                except requests.RequestException:
+                    return False, '无网络连接'
+                except requests.JSONDecodeError:
+                    return False, f'{share_code} 响应结果解析失败'
+
+                if result['data']:
+                    sources[share_code] = result['data']['list'] + result['data']['not_calc_list']
+                elif result['retcode'] == -100:
+                    self.web.set_cookie(value='')
+                    return False, '<set_cookie>'
+                else:
+                    return False, f'{share_code} 失败：' + result['message']
+                if progress:
+                    progress(done=done, total=len(share_codes), message=f'已获取 {share_code}')
+
+        if merged_filename is None:
+            merged_filename = 'inventory_%s.xlsx' % '+'.join(share_codes)
+        # 按输入顺序排列来源列
+        self.__store_inventory(merge_items({code: sources[code] for code in share_codes}),
+                               merged_filename, sources=share_codes)
+        return True, merged_filename
+
+    def merge_inventories(self, filenames, merged_filename):
+        """合并多个本地清单，按物品ID累加需求数量与已有数量
+
+        :param filenames: 清单文件名列表
+        :param merged_filename: 合并后保存的文件名
+        :return: 成功标志，消息
+        """
+        sources = {}
+        for filename in filenames:
+            if not os.path.exists('cache/' + filename):
+                return False, f'清单不存在：{filename}'
+            inventory = HandleInv(filename)
+            sources[filename.removeprefix('inventory_').removesuffix('.xlsx')] = inventory.read_items()
+            inventory.close()
+
+        merged = merge_items(sources)
+        if not merged:
+            return False, '清单是空的'
+        self.__save_inventory_as_xlsx(merged, merged_filename, sources=list(sources))
+        return True, merged_filename
+
+    @staticmethod
+    def __titles(sources):
+        return ['ID', '等级', '名称', '图片', '需求数量', '已有数量'] + list(sources)
+
+    def __store_inventory(self, data: list[dict], filename, sources=None):
+        """保存接口获取的物品列表，清单已存在时增量更新，否则生成新的清单"""
+        if self.incremental and os.path.exists('cache/' + filename):
+            if self.__refresh_inventory_xlsx(data, filename, sources) is not None:
+                return
+            # 来源列不同，只能重新生成，按物品ID保留已有数量
+            inventory = HandleInv(filename)
+            owned = {str(item['id']): item['owned'] for item in inventory.read_items()}
+            inventory.close()
+            for item in data:
+                item['owned'] = owned.get(str(item['id']), 0)
+        self.__save_inventory_as_xlsx(data, filename, sources)
+
+    @tracer.traced('inv.refresh_xlsx')
+    def __refresh_inventory_xlsx(self, data: list[dict], filename, sources=None) -> dict | None:
+        """按物品ID将新的物品列表合并到已有清单，只改动新增、删除和变化的行，已有数量与图片保持不变
+
+        :return: 各类改动的行数，表头与来源不一致时不做改动并返回None
+        """
+        saved_path = 'cache/' + filename
+        sources = sources or []
+        titles = self.__titles(sources)
+        workbook = load_workbook(saved_path)
+        worksheet = workbook.active
+        if [cell.value for cell in worksheet[1]] != titles:
+            workbook.close()
+            return None
+
+        rows = {parse_id_cell(worksheet.cell(row, 1).value)[1]: row for row in range(2, worksheet.max_row + 1)}
+        fresh = {str(item['id']): item for item in data}
+        counts = {'added': 0, 'removed': 0, 'changed': 0, 'unchanged': 0}
+
+        for item_id, row in rows.items():
+            if item_id not in fresh:
+                continue
+            item = fresh[item_id]
+            values = [self.__id_cell_value(item), item['level'], item['name'], item['num']]
+            values += [item['breakdown'].get(source) for source in sources]
+            columns = [1, 2, 3, 5] + list(range(7, 7 + len(sources)))
+            if [worksheet.cell(row, col).value for col in columns] == values:
+                counts['unchanged'] += 1
+                continue
+            for col, value in zip(columns, values):
+                worksheet.cell(row, col).value = value
+            counts['changed'] += 1
+
+        # 从下往上删除，前面的行号不受影响
+        for row in sorted((row for item_id, row in rows.items() if item_id not in fresh), reverse=True):
+            self.__delete_row(worksheet, row)
+            counts['removed'] += 1
+
+        added = [item for item_id, item in fresh.items() if item_id not in rows]
+        added.sort(key=lambda item: item['num'], reverse=True)
+        if self.insert_image:
+            self.__prefetch_icons(added)
+        for item in added:
+            self.__write_row(worksheet, worksheet.max_row + 1, item, sources, len(titles))
+            counts['added'] += 1
+
+        if counts['added'] or counts['removed'] or counts['changed']:
+            workbook.save(saved_path)
+        workbook.close()
+        self.icons.flush()
+        logger.info(f'增量更新{filename}：{counts}')
+        self.__open_saved(saved_path)
+        return counts
+
+    @staticmethod
+    def __delete_row(worksheet, row):
+        """删除一行，并移动下方的图片，openpyxl删除行时不会处理图片"""
+        worksheet.delete_rows(row)
+        row_index = row - 1  # 图片锚点的行号从0开始
+        for image in list(worksheet._images):
+            anchor = image.anchor
+            if isinstance(anchor, str):
+                continue
+            if anchor._from.row == row_index:
+                worksheet._images.remove(image)
+            elif anchor._from.row > row_index:
+                anchor._from.row -= 1
+                if getattr(anchor, 'to', None) is not None:
+                    anchor.to.row -= 1
+
+    @staticmethod
+    def __id_cell_value(item):
+        return '=HYPERLINK("%s", %s)' % (item['wiki_url'], item['id']) if item.get('wiki_url') else str(item['id'])
+
+    @tracer.traced('inv.save_xlsx')
+    def __save_inventory_as_xlsx(self, data: list[dict], filename, sources=None):
         """保存数据为Excel文件
 
-        :param data: 响应数据的物品列表
+        :param data: 响应数据的物品列表，项目中带有owned时写入已有数量
         :param filename: 保存文件名
+        :param sources: 合并清单的来源名称，每个来源在表格末尾增加一列，填入项目breakdown中对应的数量
         :return:
         """
         saved_path = 'cache/' + filename
         data.sort(key=lambda item: item['num'], reverse=True)
+        sources = sources or []
 
-        titles = ['ID', '等级', '名称', '图片', '需求数量', '已有数量']
-        self.__worksheet.append(titles)
-        for col in range(1, 7):
-            cell = self.__worksheet.cell(1, col)
+        if self.insert_image:
+            self.__prefetch_icons(data)
+
+        workbook = Workbook()
+        worksheet = workbook.active
+        titles = self.__titles(sources)
+        worksheet.append(titles)
+        for col in range(1, len(titles) + 1):
+            cell = worksheet.cell(1, col)
             cell.fill = PatternFill(start_color='2CC544', end_color='00FF00', fill_type='solid')
             cell.font = Font(bold=False, color='FFFFFF', italic=True)
             cell.alignment = Alignment(horizontal='center', vertical='center')
-        self.__worksheet.row_dimensions[1].height = 20
+        worksheet.row_dimensions[1].height = 20
 
         for i in range(len(data)):
-            row = i + 2
-            self.__worksheet.cell(row, 1).value = '=HYPERLINK("%s", %s)' % (data[i]['wiki_url'], data[i]['id']) \
-                if data[i]['wiki_url'] \
-                else str(data[i]['id'])
-            self.__worksheet.cell(row, 2).value = data[i]['level']
-            self.__worksheet.cell(row, 3).value = data[i]['name']
-
-            if pub_config['insert_image']:
+            self.__write_row(worksheet, i + 2, data[i], sources, len(titles))
+
+        worksheet.column_dimensions['C'].width = 40
+        worksheet.column_dimensions['D'].width = 5
+        workbook.save(saved_path)
+        # 日志中记录的是购买后的已有数量，不清空会在下次读取时覆盖新清单的数量
+        PurchaseJournal.of_inventory(filename).clear()
+        self.icons.flush()
+        self.__open_saved(saved_path)
+
+    def __write_row(self, worksheet, row, item, sources, column_count):
+        worksheet.cell(row, 1).value = self.__id_cell_value(item)
+        worksheet.cell(row, 2).value = item['level']
+        worksheet.cell(row, 3).value = item['name']
+
+        if self.insert_image and (item['id'] in self.icons or item.get('icon_url')):
+            try:
+                worksheet.add_image(self.__get_item_icon(item), 'D' + str(row))
+            except (requests.RequestException, PILImage.UnidentifiedImageError):
+                worksheet.cell(row, 4).value = '!err'
+        else:
+            worksheet.cell(row, 4).value = 'NoImg'
+
+        worksheet.cell(row, 5).value = item['num']
+        if item.get('owned'):
+            worksheet.cell(row, 6).value = item['owned']
+        for col, source in enumerate(sources, 7):
+            worksheet.cell(row, col).value = item['breakdown'].get(source)
+
+        worksheet.row_dimensions[row].height = 30
+        for col in range(1, column_count + 1):
+            worksheet.cell(row, col).alignment = Alignment(horizontal='center', vertical='center')
+
+    def __open_saved(self, saved_path):
+        if self.auto_open:
+            os.system(('start ' if SYSTEM_NAME == 'Windows' else 'open ') + saved_path)
+
+    def __prefetch_icons(self, data):
+        """并发下载本地没有缓存的图标"""
+        missing = [item for item in data if item['id'] not in self.icons and item.get('icon_url')]
+        if len(missing) < 2:
+            return
+        with ThreadPoolExecutor(max_workers=pub_config.get('fetch_max_workers', 4),
+                                thread_name_prefix='fetch_icon') as executor:
+            for future in [executor.submit(tracer.bind(self.__get_item_icon), item) for item in missing]:
                 try:
-                    image = self.__get_item_icon(data[i])
-                    image.width, image.height = 40, 40
-                    self.__worksheet.add_image(image, 'D' + str(row))
-                except requests.RequestException:
-                    self.__worksheet.cell(row, 4).value = '!err'
-            else:
-                self.__worksheet.cell(row, 4).value = 'NoImg'
-
-            self.__worksheet.cell(row, 5).value = data[i]['num']
-
-            self.__worksheet.row_dimensions[row].height = 30
-            for col in range(1, 7):
-                self.__worksheet.cell(row, col).alignment = Alignment(horizontal='center', vertical='center')
-
-        self.__worksheet.column_dimensions['C'].width = 40
-        self.__worksheet.column_dimensions['D'].width = 5
-        self.__workbook.save(saved_path)
-        os.system('start ' if SYSTEM_NAME == 'Windows' else 'open ' + saved_path)
+                    future.result()
+                except (requests.RequestException, PILImage.UnidentifiedImageError):
+                    # 保存时会重试并标记为!err
+                    pass
+        self.icons.flush()
 
+    @tracer.traced('inv.get_icon')
     def __get_item_icon(self, item):
-        """获取物品的图标，本地无对应图标时下载并缓存
+        """获取物品的图标缩略图，本地无对应图标时下载并缓存
 
         :param item: 保存物品信息的项目
         :return: Image对象
         """
-        icon_path = '%s/%s.png' % (self.__icon_dir, item['id'])
-        if str(item['id']) not in self.__item_ids:
-            with open(icon_path, 'wb') as fp:
-                fp.write(requests.get(
-                    item['icon_url'],
-                    headers={'Connection': 'keep-alive', 'User-Agent': UA}
-                ).content)
-                logger.debug('已缓存' + icon_path)
-        return Image(icon_path)
+        if item['id'] not in self.icons:
+            content = requests.get(
+                item['icon_url'],
+                headers={'Connection': 'keep-alive', 'User-Agent': UA},
+                timeout=HTTP_TIMEOUT
+            ).content
+            self.icons.put(item['id'], content)
+            logger.debug('已缓存图标%s', item['id'])
+        return Image(io.BytesIO(self.icons.get(item['id'])))
+
+
+class PurchaseJournal:
+    """购买记录的追加日志
+
+    每次购买追加一行JSON，记录购买后的已有数量，重放多次结果相同；清单保存后清空日志
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__fp = None
+
+    @classmethod
+    def of_inventory(cls, xlsx_filename) -> 'PurchaseJournal':
+        """清单文件对应的购买日志"""
+        return cls('cache/journal/%s.jsonl' % xlsx_filename)
+
+    def replay(self) -> list[dict]:
+        """读取日志中的记录，程序崩溃时写了一半的行会被跳过"""
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path, 'r', encoding='UTF-8') as fp:
+            for line in fp:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning(f'跳过不完整的购买记录：{line!r}')
+        return entries
+
+    def append(self, name, bought, owned):
+        if self.__fp is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.__fp = open(self.path, 'a+', encoding='UTF-8')
+            # 上次写了一半的行单独成行，避免与新记录连在一起
+            if self.__fp.tell() and self.__tail_byte() != b'\n':
+                self.__fp.write('\n')
+        self.__fp.write(json.dumps({'time': time.time(), 'name': name, 'bought': bought, 'owned': owned},
+                                   ensure_ascii=False) + '\n')
+        self.__fp.flush()
+        os.fsync(self.__fp.fileno())
+
+    def __tail_byte(self):
+        with open(self.path, 'rb') as fp:
+            fp.seek(-1, os.SEEK_END)
+            return fp.read(1)
+
+    def close(self):
+        if self.__fp is not None:
+            self.__fp.close()
+            self.__fp = None
+
+    def clear(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
 
 
 class HandleInv:
     """使用本地清单数据
 
-    初始化会读取指定Excel文件的数据转为字典，缓存到data属性
+    初始化会读取指定Excel文件的数据转为字典，缓存到data属性，并重放上次未保存的购买记录
     保存时会将更改后的data数据写入到源文件中
     """
 
@@ -188,26 +647,114 @@ class HandleInv:
         self.__workbook = load_workbook(self.__source_path)
         self.__worksheet = self.__workbook.active
         self.data = {}
+        self.__rows = {}
         self.__set_data()
+        self.journal = PurchaseJournal.of_inventory(xlsx_filename)
+        self.__replay_journal()
 
     def __set_data(self):
         """读取Excel表数据"""
         for row in range(2, self.__worksheet.max_row + 1):
+            self.__rows[self.__worksheet.cell(row, 3).value] = row
             self.data[self.__worksheet.cell(row, 3).value] = [
                 self.__worksheet.cell(row, 5).value,
                 0 if (_ := self.__worksheet.cell(row, 6).value) is None else _
             ]
 
+    def __replay_journal(self):
+        """将上次异常退出前的购买记录应用到数据和表格上"""
+        entries = [entry for entry in self.journal.replay() if entry.get('name') in self.data]
+        for entry in entries:
+            self.data[entry['name']][1] = entry['owned']
+            self.__worksheet.cell(self.__rows[entry['name']], 6).value = entry['owned']
+        if entries:
+            logger.info(f'从购买日志恢复了{len(entries)}条记录：{self.journal.path}')
+
+    def record_purchase(self, name, count):
+        """记录一次购买，更新已有数量并写入购买日志，日志在save_data时合并到清单文件"""
+        self.data[name][1] += count
+        self.journal.append(name, count, self.data[name][1])
+
+    def read_items(self) -> list[dict]:
+        """按行读取完整的物品信息
+
+        :return: 与接口物品列表格式相同的字典列表，另带有owned已有数量
+        """
+        items = []
+        for row in range(2, self.__worksheet.max_row + 1):
+            wiki_url, item_id = parse_id_cell(self.__worksheet.cell(row, 1).value)
+            items.append({
+                'id': int(item_id) if item_id.isdigit() else item_id,
+                'level': self.__worksheet.cell(row, 2).value,
+                'name': self.__worksheet.cell(row, 3).value,
+                'num': self.__worksheet.cell(row, 5).value or 0,
+                'owned': self.__worksheet.cell(row, 6).value or 0,
+                'wiki_url': wiki_url,
+            })
+        return items
+
+    def export(self, filepath):
+        """导出清单为json或csv文件，根据后缀判断格式"""
+        items = self.read_items()
+        if filepath.endswith('.csv'):
+            with open(filepath, 'w', encoding='UTF-8-SIG', newline='') as fp:
+                writer = csv.DictWriter(fp, fieldnames=['id', 'level', 'name', 'num', 'owned', 'wiki_url'])
+                writer.writeheader()
+                writer.writerows(items)
+        else:
+            dump_json_to_file(filepath, items)
+
+    def close(self):
+        self.journal.close()
+        self.__workbook.close()
+
     def save_data(self):
-        """将data的数据保存到源文件，并关闭工作簿"""
+        """将data的数据保存到源文件，清空购买日志，并关闭工作簿
+
+        先写入临时文件再替换，保存中途退出时源文件和日志都保持完整
+        """
         for row in range(2, self.__worksheet.max_row + 1):
             key = self.__worksheet.cell(row, 3).value
             self.__worksheet.cell(row, 5).value = self.data[key][0]
             self.__worksheet.cell(row, 6).value = self.data[key][1]
-        self.__workbook.save(self.__source_path)
+        directory, filename = os.path.split(self.__source_path)
+        temp_path = os.path.join(directory, '.%s.tmp' % filename)
+        self.__workbook.save(temp_path)
+        os.replace(temp_path, self.__source_path)
+        self.journal.clear()
         self.__workbook.close()
 
 
+def parse_id_cell(value) -> tuple[str | None, str]:
+    """解析清单ID列的值
+
+    :return: wiki链接（没有时为None），物品ID字符串
+    """
+    id_value = str(value)
+    if matched := re.fullmatch(r'=HYPERLINK\("(.*)", (\d+)\)', id_value):
+        return matched.group(1), matched.group(2)
+    return None, id_value
+
+
+def merge_items(sources: dict[str, list[dict]]) -> list[dict]:
+    """按物品ID汇总多个来源的物品列表
+
+    :param sources: 来源名称 -> 物品列表
+    :return: 汇总后的物品列表，num/owned为累加值，breakdown记录每个来源的需求数量
+    """
+    merged = {}
+    for source, items in sources.items():
+        for item in items:
+            if item['id'] in merged:
+                target = merged[item['id']]
+                target['num'] += item['num']
+                target['owned'] = target.get('owned', 0) + item.get('owned', 0)
+            else:
+                target = merged[item['id']] = dict(item, breakdown={})
+            target['breakdown'][source] = target['breakdown'].get(source, 0) + item['num']
+    return list(merged.values())
+
+
 def get_inv_filelist():
     return [filename for filename in os.listdir('cache/') if filename.startswith('inventory')]
 
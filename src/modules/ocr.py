@@ -6,151 +6,464 @@ Path: src/modules/ocr.py
 IDE: PyCharm
 Description: 实现本地及云端OCR类
 """
+import contextlib
+import gc
+import importlib.util
+import io
+import json
 import os
+import threading
 import time
 from abc import ABC, abstractmethod
 
 import requests
+from PIL import Image, ImageOps
 
-from src.utils.common import read_config, save_config
+from src.utils.cancel import current_token
+from src.utils.config import private_config
 from src.utils.cyber import *
-from src.utils.support import DEBUG_MODE, logger, pub_config
+from src.utils.recorder import frame_recorder
+from src.utils.support import logger, pub_config
+from src.utils.trace import tracer
 
-if DEBUG_MODE:
+# 购买流程中识别的截图类型：商品列表、售罄状态、最大购买数量
+CROP_TYPES = 'shop_list', 'sellout', 'quantity'
+
+
+def _render_detected_image(image_bytes, detection, detail):
+    """供调试使用，在图片上标注识别结果，由记录器在后台线程中调用"""
     import cv2
     import numpy as np
 
+    image_array = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), flags=cv2.IMREAD_UNCHANGED)
 
-class BaseOCR:
-    def __init__(self):
-        self.__count = 0
-        self.__temp_dir = 'debug/ocr/'
+    if detail:
+        for item in detection:
+            top_left = tuple(map(int, item[0][0]))
+            bottom_right = tuple(map(int, item[0][2]))
+            text = '%s (%.3f)' % (item[1], item[2])
+            image_array = cv2.rectangle(image_array, pt1=top_left, pt2=bottom_right, color=(0, 255, 0), thickness=1)
+            image_array = cv2.putText(image_array, text=text, org=top_left,
+                                      fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=0.6, color=(0, 0, 255),
+                                      thickness=1, lineType=cv2.LINE_AA)
+    else:
+        left_top = [1, 20]
+        for text in detection:
+            image_array = cv2.putText(image_array, text=text, org=left_top,
+                                      fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=0.6, color=(0, 0, 255),
+                                      thickness=1, lineType=cv2.LINE_AA)
+            left_top[1] += 20
 
-        if os.path.exists(self.__temp_dir):
-            for fi in os.listdir(self.__temp_dir):
-                os.remove(self.__temp_dir + fi)
-        else:
-            os.mkdir(self.__temp_dir)
+    return cv2.imencode('.png', image_array, [cv2.IMWRITE_PNG_COMPRESSION, 1])[1].tobytes()
 
-    def __record_detected_image(self, image_bytes, detection, detail):
+
+class BaseOCR:
+    def _record_detected_image(self, image_bytes, detection, detail):
         """供调试使用，记录图片识别结果"""
-        image_array = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), flags=cv2.IMREAD_UNCHANGED)
-
-        if detail:
-            for item in detection:
-                top_left = item[0][0]
-                bottom_right = item[0][2]
-                text = '%s (%.3f)' % (item[1], item[2])
-                image_array = cv2.rectangle(image_array, pt1=top_left, pt2=bottom_right, color=(0, 255, 0), thickness=1)
-                image_array = cv2.putText(image_array, text=text, org=top_left,
-                                          fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=0.6, color=(0, 0, 255),
-                                          thickness=1, lineType=cv2.LINE_AA)
-        else:
-            left_top = [1, 20]
-            for text in detection:
-                image_array = cv2.putText(image_array, text=text, org=left_top,
-                                          fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=0.6, color=(0, 0, 255),
-                                          thickness=1, lineType=cv2.LINE_AA)
-                left_top[1] += 20
+        if frame_recorder.enabled:
+            logger.debug('识别结果: %s', detection)
+            frame_recorder.record('ocr', '.png', _render_detected_image, image_bytes, list(detection), detail)
 
-        image_path = '%s/%s-%03d.png' % (self.__temp_dir, time.strftime('%H%M%S'), self.__count)
-        cv2.imwrite(image_path, image_array)
-        logger.debug(f'图像[{image_path}]识别结果: {detection}')
-        self.__count += 1
 
+class ModelHolder:
+    """按需加载的模型：第一次使用时加载，空闲超过idle_timeout秒后释放，下次使用时重新加载"""
+
+    def __init__(self, name, loader, idle_timeout=0, measure=None):
+        """
+        :param name: 模型名称，用于日志
+        :param loader: 加载模型的函数
+        :param idle_timeout: 空闲多少秒后释放，为0时不释放
+        :param measure: 计算模型占用内存字节数的函数
+        """
+        self.name = name
+        self.idle_timeout = idle_timeout
+        self.__loader = loader
+        self.__measure = measure
+        self.__model = None
+        self.__in_use = 0
+        self.__last_used = 0.0
+        self.__lock = threading.Condition()
+        self.__stats = {'loads': 0, 'evictions': 0, 'load_seconds': 0.0, 'resident_bytes': 0}
+
+    @contextlib.contextmanager
+    def use(self):
+        """使用期间模型不会被释放"""
+        with self.__lock:
+            if self.__model is None:
+                self.__load()
+            self.__in_use += 1
+        try:
+            yield self.__model
+        finally:
+            with self.__lock:
+                self.__in_use -= 1
+                self.__last_used = time.monotonic()
+
+    def __load(self):
+        start = time.perf_counter()
+        self.__model = self.__loader()
+        self.__stats['loads'] += 1
+        self.__stats['load_seconds'] = round(time.perf_counter() - start, 3)
+        if self.__measure:
+            try:
+                self.__stats['resident_bytes'] = self.__measure(self.__model)
+            except Exception as exc:
+                logger.debug(f'无法计算{self.name}占用的内存：{exc!r}')
+        self.__last_used = time.monotonic()
+        logger.info('%s已加载，耗时%.2f秒，占用%.1fMB', self.name, self.__stats['load_seconds'],
+                    self.__stats['resident_bytes'] / 2 ** 20)
+        if self.idle_timeout > 0:
+            threading.Thread(target=self.__evict_when_idle, name='evict_' + self.name, daemon=True).start()
+
+    def __evict_when_idle(self):
+        # 判断空闲与释放在同一次加锁中完成，期间不会有新的使用者
+        with self.__lock:
+            while self.__model is not None:
+                idle = time.monotonic() - self.__last_used
+                if not self.__in_use and idle >= self.idle_timeout:
+                    logger.info(f'{self.name}空闲超过{self.idle_timeout}秒')
+                    self.__drop()
+                    break
+                self.__lock.wait(max(self.idle_timeout - idle, 1))
+            else:
+                return
+        self.__collected()
+
+    def release(self):
+        with self.__lock:
+            if self.__model is None or self.__in_use:
+                return
+            self.__drop()
+        self.__collected()
+
+    def __drop(self):
+        """需要持有锁"""
+        self.__model = None
+        self.__stats['evictions'] += 1
+        self.__stats['resident_bytes'] = 0
+
+    def __collected(self):
+        gc.collect()
+        logger.info(f'{self.name}已释放')
+
+    @property
+    def loaded(self) -> bool:
+        return self.__model is not None
+
+    def stats(self) -> dict:
+        with self.__lock:
+            stats = dict(self.__stats, loaded=self.__model is not None)
+            stats['idle_seconds'] = round(time.monotonic() - self.__last_used, 1) if self.__model is not None else None
+        return stats
+
+
+def _torch_model_bytes(reader) -> int:
+    """EasyOCR检测与识别模型的参数和缓冲区占用的字节数"""
+    total = 0
+    for module in (reader.detector, reader.recognizer):
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            total += tensor.numel() * tensor.element_size()
+    return total
 
-class EasyOCR(BaseOCR):
-    def __init__(self):
-        import easyocr
 
+class EasyOCR(BaseOCR):
+    def __init__(self, ocr_name):
         super().__init__()
+        if importlib.util.find_spec('easyocr') is None:
+            raise ImportError('未安装easyocr')
+
+        local_ocr_config = pub_config['local_ocr']
+        # 模型在第一次识别时才加载，只播放剧情或烹饪时不占用内存
+        self.model = ModelHolder('本地OCR模型', self.__load_reader,
+                                 idle_timeout=local_ocr_config.get('idle_timeout', 0), measure=_torch_model_bytes)
+        # 多开时各窗口共用一个模型，逐个识别
+        self.__infer_lock = threading.Lock()
+
+    @staticmethod
+    def __load_reader():
+        import easyocr
 
         local_ocr_config = pub_config['local_ocr']
-        self.reader = easyocr.Reader(local_ocr_config['lang_list'], gpu=local_ocr_config['use_gpu'])
+        return easyocr.Reader(local_ocr_config['lang_list'], gpu=local_ocr_config['use_gpu'])
 
-    def scan_image(self, image_bytes, ret_detail, compression_ratio=1):
-        detection = self.reader.readtext(image_bytes, detail=ret_detail, mag_ratio=compression_ratio,
-                                         text_threshold=0.75, link_threshold=0.05)
-        if DEBUG_MODE:
-            self.__record_detected_image(image_bytes, detection, ret_detail)
+    def __readtext(self, image_bytes, **kwargs):
+        with self.model.use() as reader, self.__infer_lock:
+            return reader.readtext(image_bytes, **kwargs)
+
+    def stats(self) -> dict:
+        return self.model.stats()
+
+    @tracer.traced('ocr.local.scan_image')
+    def scan_image(self, image_bytes, ret_detail, compression_ratio=1, crop_type=None):
+        # 在后台线程中识别，所在流程被取消时不必等待识别结束
+        detection = current_token().run(self.__readtext, image_bytes, detail=ret_detail,
+                                        mag_ratio=compression_ratio, text_threshold=0.75, link_threshold=0.05)
+        self._record_detected_image(image_bytes, detection, ret_detail)
         return detection
 
 
 class CloudOCR(BaseOCR, ABC):
-    __ocr_keys_filepath = 'config/private.yml'
-
-    def __init__(self, ocr_name):
+    def __init__(self, ocr_name, keys_filepath=None):
+        """
+        :param ocr_name: OCR名称，也是私有配置中的键名
+        :param keys_filepath: 保存key与令牌的文件，默认为config/private.yml
+        """
         super().__init__()
         self.__ocr_name = ocr_name
+        # 按文件修改时间缓存，读取key与令牌时不再每次解析文件
+        self.__private = private_config(keys_filepath or 'config/private.yml')
+
+        self.preprocess = dict(pub_config.get('cloud_ocr_preprocess') or {})
+        self.upload_stats = {'calls': 0, 'raw_bytes': 0, 'sent_bytes': 0}
+        pub_config.subscribe(self._on_config_changed)
+
+    def _on_config_changed(self, changed: dict):
+        if 'cloud_ocr_preprocess' in changed:
+            self.preprocess = dict(changed['cloud_ocr_preprocess'] or {})
+            logger.info(f'上传前处理：{self.preprocess}')
+
+    def prepare_image(self, image_bytes, compression_ratio=1) -> tuple[bytes, float]:
+        """上传前处理图片以减小请求体积：灰度、缩放、二值化，再按配置重新编码
+
+        各项处理默认关闭，开启前先用ocr-bench确认识别准确率不下降
+
+        :param image_bytes: 原图字节流
+        :param compression_ratio: 缩放比例，配置中开启scale时才生效
+        :return: 处理后的图片字节流，实际缩放比例（用于还原坐标）
+        """
+        config = self.preprocess
+        # 只读取文件头，像素在处理时才解码
+        image = Image.open(io.BytesIO(image_bytes))
+        scale = 1
+        if config.get('scale', False) and compression_ratio < 1:
+            # 接口要求最短边不小于15像素
+            scale = min(max(compression_ratio, 15 / min(image.size)), 1)
+        if (scale == 1 and not config.get('grayscale', False) and not config.get('binarize', False)
+                and config.get('encoder', 'png') == 'png'):
+            # 没有任何处理时直接上传截图，不再解码与重新编码
+            return image_bytes, 1
+
+        if config.get('grayscale', False):
+            image = image.convert('L')
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        if scale < 1:
+            image = image.resize((round(image.width * scale), round(image.height * scale)), Image.BILINEAR)
+
+        if config.get('binarize', False):
+            threshold = config.get('binarize_threshold', 128)
+            image = ImageOps.autocontrast(image.convert('L')).point(lambda p: 255 if p >= threshold else 0)
+
+        buffer = io.BytesIO()
+        if config.get('encoder', 'png') == 'jpeg':
+            image.save(buffer, format='JPEG', quality=config.get('jpeg_quality', 85))
+        else:
+            image.save(buffer, format='PNG', optimize=False, compress_level=config.get('png_level', 1))
+        return buffer.getvalue(), scale
 
     @abstractmethod
     def scan_image(self,
                    image_bytes: bytes,
                    ret_detail: bool,
-                   compression_ratio=1) -> list[list[tuple[int] | str | float]] | list[str]:
+                   compression_ratio=1,
+                   crop_type=None) -> list[list[tuple[int] | str | float]] | list[str]:
         """识别图像中的文本
 
         :param image_bytes: 图片字节流
         :param ret_detail: 是否返回更多细节
         :param compression_ratio: 压缩图片比例
+        :param crop_type: 截图类型，见CROP_TYPES，供AutoOCR选择引擎，具体引擎忽略该参数
         :return: 当ret_detail为真，每项按照 [矩形顶点位置, 识别文字, 可信度] 的格式放入列表中再返回；
                  否则，直接将识别到的文字放入一个列表中返回。
         """
 
     def get_ocr_keys(self):
         """获取本地已保存的key"""
-        if os.path.exists(self.__ocr_keys_filepath):
-            config = read_config(self.__ocr_keys_filepath)
-            if config and self.__ocr_name in config:
-                return config[self.__ocr_name].get('api_key'), config[self.__ocr_name].get('secret_key')
-        return None, None
+        entry = self.__private.section(self.__ocr_name)
+        return entry.get('api_key'), entry.get('secret_key')
 
     def save_ocr_keys(self, api_key, secret_key):
         """将key保存到本地"""
-        if os.path.exists(self.__ocr_keys_filepath):
-            config = read_config(self.__ocr_keys_filepath)
-            if not isinstance(config, dict):
-                config = {}
-        else:
-            config = {}
-        config.update({self.__ocr_name: {'api_key': api_key, 'secret_key': secret_key}})
-        save_config(self.__ocr_keys_filepath, config)
+        self.__private.update_section(self.__ocr_name, api_key=api_key, secret_key=secret_key)
+
+    def get_cached_token(self):
+        """获取本地已保存的令牌及其过期时间戳"""
+        entry = self.__private.section(self.__ocr_name)
+        return entry.get('access_token'), entry.get('expires_at', 0)
+
+    def save_access_token(self, access_token, expires_at):
+        """将令牌与过期时间戳保存到本地，与key放在一起"""
+        self.__private.update_section(self.__ocr_name, access_token=access_token, expires_at=expires_at)
 
 
 class BaiduOCR(CloudOCR):
-    def __init__(self, ocr_name):
-        super().__init__(ocr_name)
+    # 令牌在过期前多少秒刷新
+    TOKEN_REFRESH_MARGIN = 24 * 3600
 
-        self.BASE_URL = 'https://aip.baidubce.com'
+    # 接口错误码，见 https://ai.baidu.com/ai-doc/OCR/dk3h7y5vr
+    RETRYABLE_ERRORS = {2, 18, 282000}  # 服务暂不可用、QPS超限、服务器内部错误：退避后重试
+    QUOTA_ERRORS = {4, 6, 17, 19}  # 集群超限、无接口权限、每日/总调用量超限：切换到下一个接口
+    TOKEN_ERRORS = {110, 111}  # 令牌无效、令牌过期：刷新令牌后重试
+    # 没有配置或配置无效时各接口的QPS
+    DEFAULT_QPS = 2
+
+    def __init__(self, ocr_name, base_url=None, keys_filepath=None):
+        """
+        :param base_url: 接口地址，默认使用配置项baidu_ocr.base_url
+        """
+        super().__init__(ocr_name, keys_filepath)
+
+        baidu_config = pub_config.get('baidu_ocr') or {}
+        self.BASE_URL = (base_url or baidu_config.get('base_url') or 'https://aip.baidubce.com').rstrip('/')
         self.headers = {
             'Content-Type': 'application/x-www-form-urlencoded',
             'Accept': 'application/json'
         }
-        self.access_token = None
-        self.refresh_access_token(*self.get_ocr_keys())
-
-        self.__api_version = 'general'
-
+        self.max_retries = baidu_config.get('max_retries', 3)
+        # 按顺序使用的接口，前一个额度用完时切换到下一个；识别位置与只识别文字的接口分开
+        self.__api_chains = {
+            True: list(baidu_config.get('locate_apis', ['general', 'accurate'])),
+            False: list(baidu_config.get('basic_apis', ['general_basic', 'accurate_basic']))
+        }
+        self.__chain_lock = threading.Lock()
+        qps_config = baidu_config.get('qps') or {}
+        self.__limiters = {api: TokenBucket(self.__qps_of(qps_config, api))
+                           for api in self.__api_chains[True] + self.__api_chains[False]}
+
+        # 优先使用本地保存的令牌，过期前由后台线程提前刷新
+        self.__token_changed = threading.Event()
+        self.access_token, self.token_expires_at = self.get_cached_token()
+        if not self.__token_is_usable():
+            self.access_token = None
+            self.refresh_access_token(*self.get_ocr_keys())
+        threading.Thread(target=self.__keep_token_fresh, name='refresh_token', daemon=True).start()
+
+    def _on_config_changed(self, changed: dict):
+        super()._on_config_changed(changed)
+        if 'baidu_ocr' not in changed:
+            return
+        baidu_config = changed['baidu_ocr'] or {}
+        self.max_retries = baidu_config.get('max_retries', 3)
+        qps_config = baidu_config.get('qps') or {}
+        for api, limiter in self.__limiters.items():
+            limiter.set_rate(self.__qps_of(qps_config, api))
+        logger.info(f'百度OCR：重试{self.max_retries}次，QPS {qps_config}')
+
+    @classmethod
+    def __qps_of(cls, qps_config, api) -> float:
+        """接口的QPS，不是正数时使用默认值，避免令牌桶除以0"""
+        qps = qps_config.get(api, cls.DEFAULT_QPS)
+        if isinstance(qps, bool) or not isinstance(qps, (int, float)) or qps <= 0:
+            logger.warning(f'baidu_ocr.qps.{api}的值{qps!r}无效，需要为正数，使用默认值{cls.DEFAULT_QPS}')
+            return cls.DEFAULT_QPS
+        return qps
+
+    def __token_is_usable(self):
+        return self.access_token is not None and time.time() < self.token_expires_at - self.TOKEN_REFRESH_MARGIN
+
+    @tracer.traced('ocr.baidu.refresh_token')
     def refresh_access_token(self, api_key, secret_key):
+        if not (api_key and secret_key):
+            logger.warning('未设置key，无法刷新token')
+            return
         api = self.BASE_URL + '/oauth/2.0/token'
         url = api + f'?grant_type=client_credentials&client_id={api_key}&client_secret={secret_key}'
         logger.debug('==> POST %s' % url)
-        response = requests.post(url)
-        self.access_token = response.json().get('access_token')
-        logger.debug('<== %s %s %s..' % (response.status_code, api, response.text[:100]))
-
-    def send_image_to_webapi(self, image_base64, locate_text=True):
-        api = self.BASE_URL + '/rest/2.0/ocr/v1/' + (
-            self.__api_version if locate_text else self.__api_version + '_basic')
+        response = current_token().request('POST', url)
+        logger.debug('<== %s %s %.100s..', response.status_code, api, response.text)
+        result = response.json()
+        if access_token := result.get('access_token'):
+            self.access_token = access_token
+            self.token_expires_at = time.time() + result.get('expires_in', 2592000)
+            self.save_access_token(self.access_token, self.token_expires_at)
+            logger.info('token已刷新，有效期至%s' % time.strftime('%Y-%m-%d %H:%M', time.localtime(self.token_expires_at)))
+            self.__token_changed.set()
+        elif time.time() >= self.token_expires_at:
+            # 旧令牌未过期时继续使用
+            self.access_token = None
+
+    def __keep_token_fresh(self):
+        """后台线程，在令牌过期前刷新，失败时按指数退避重试；没有key时等待用户输入新的key"""
+        failures = 0
+        while True:
+            self.__token_changed.clear()
+            if self.__token_is_usable():
+                failures = 0
+                self.__token_changed.wait(self.token_expires_at - self.TOKEN_REFRESH_MARGIN - time.time())
+                continue
+            keys = self.get_ocr_keys()
+            if not all(keys):
+                self.__token_changed.wait()
+                continue
+
+            # 接口返回错误或请求失败都会重试，不论旧令牌是否已被清除
+            try:
+                self.refresh_access_token(*keys)
+            except (requests.RequestException, ValueError) as exc:
+                logger.warning(f'刷新token失败：{exc!r}')
+            if not self.__token_is_usable():
+                delay = backoff_delay(failures, base=5, cap=600)
+                failures += 1
+                logger.info(f'{delay:.0f}秒后第{failures}次重试刷新token')
+                self.__token_changed.wait(delay)
+
+    def request_ocr(self, image_value, locate_text):
+        """按限流请求识别接口，根据错误码重试、刷新令牌或切换接口
+
+        :return: 接口返回数据
+        """
+        token = current_token()
+        chain = self.__api_chains[locate_text]
+        retries = 0
+        token_refreshed = False
+        while True:
+            api_name = chain[0]
+            self.__limiters[api_name].acquire(sleep=token.sleep)
+            try:
+                result = self.send_image_to_webapi(image_value, api_name, locate_text)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                if retries >= self.max_retries:
+                    raise
+                result = {'error_code': None, 'error_msg': repr(exc)}
+            else:
+                if 'error_code' not in result:
+                    return result
+            error_code = result['error_code']
+
+            if error_code in self.QUOTA_ERRORS and len(chain) > 1:
+                with self.__chain_lock:
+                    # 多个窗口共用时，其他线程可能已经切换过
+                    if chain[0] == api_name and len(chain) > 1:
+                        chain.pop(0)
+                        logger.warning(f'接口{api_name}不可用({error_code} {result.get("error_msg")})，切换到{chain[0]}')
+            elif error_code in self.TOKEN_ERRORS and not token_refreshed:
+                token_refreshed = True
+                self.refresh_access_token(*self.get_ocr_keys())
+            elif (error_code is None or error_code in self.RETRYABLE_ERRORS) and retries < self.max_retries:
+                delay = backoff_delay(retries)
+                retries += 1
+                logger.info(f'接口{api_name}返回{error_code}，{delay:.2f}秒后第{retries}次重试')
+                token.sleep(delay)
+            else:
+                raise Warning(f'接口返回错误：{error_code} {result.get("error_msg")}')
+
+    @tracer.traced('ocr.baidu.request')
+    def send_image_to_webapi(self, image_value, api_name, locate_text=True):
+        """
+        :param image_value: 已转为表单值的图片，见 base64_form_value
+        """
+        api = self.BASE_URL + '/rest/2.0/ocr/v1/' + api_name
         url = api + f'?access_token={self.access_token}'
-        payload = 'vertexes_location={1}&probability={1}&image={0}'.format(urlencoded(image_base64),
-                                                                           'true' if locate_text else 'false')
-        logger.debug('==> POST %s %s..' % (url, payload[:100]))
-        response = requests.post(url, headers=self.headers, data=payload)
-        logger.debug('<== %s %s %s..' % (response.status_code, api, response.text[:100]))
+        payload = (b'vertexes_location=true&probability=true&image=' if locate_text
+                   else b'vertexes_location=false&probability=false&image=') + image_value
+        # 日志参数延迟格式化，避免在识别循环中拼接长字符串
+        logger.debug('==> POST %s %.100s..', url, payload)
+        response = current_token().request('POST', url, headers=self.headers, data=payload)
+        logger.debug('<== %s %s %.100s..', response.status_code, api, response.text)
         return response.json()
 
-    def scan_image(self, image_bytes, ret_detail, compression_ratio=1):
+    @tracer.traced('ocr.baidu.scan_image')
+    def scan_image(self, image_bytes, ret_detail, compression_ratio=1, crop_type=None):
         if self.access_token is None:
             logger.error('token不能为空')
             return None
@@ -158,44 +471,127 @@ class BaiduOCR(CloudOCR):
             logger.error('image不能为空')
             return None
 
-        image_base64 = bytes_to_base64str(image_bytes)
-        result = self.send_image_to_webapi(image_base64, locate_text=ret_detail)
+        upload_bytes, scale = self.prepare_image(image_bytes, compression_ratio)
+        image_value = base64_form_value(upload_bytes)
+        self.upload_stats['calls'] += 1
+        self.upload_stats['raw_bytes'] += len(image_bytes)
+        self.upload_stats['sent_bytes'] += len(image_value)
+        logger.debug('上传图片：原图%d字节，编码后%d字节，请求体%d字节', len(image_bytes), len(upload_bytes), len(image_value))
+
+        result = self.request_ocr(image_value, locate_text=ret_detail)
         detection = []
         try:
             for item in result['words_result']:
                 text = item['words']
                 if ret_detail:
-                    rect = [(_['x'], _['y']) for _ in item['vertexes_location']]
+                    # 还原到原图的坐标
+                    rect = [(round(_['x'] / scale), round(_['y'] / scale)) for _ in item['vertexes_location']]
                     prob = item['probability']['average']
                     detection.append([rect, text, prob])
                 else:
                     detection.append(text)
         except KeyError as ke:
-            self.__api_version = 'accurate'
             raise Warning(f'接口返回数据错误，请重试或检查：{ke}')
-        if DEBUG_MODE:
-            self.__record_detected_image(image_bytes, detection, ret_detail)
+        self._record_detected_image(image_bytes, detection, ret_detail)
         return detection
 
 
+class AutoOCR(BaseOCR):
+    """按截图类型把识别交给不同的引擎
+
+    根据测评报告，每类截图选择准确率达标的引擎中最快的一个，例如数字交给本地引擎、商品名称交给云端引擎
+    """
+
+    def __init__(self, ocr_name):
+        super().__init__()
+        config = pub_config.get('auto_ocr') or {}
+        self.engine_names = list(config.get('engines') or ['baidu_ocr'])
+        self.fallback = self.engine_names[0]
+        report = load_bench_report(config.get('report', 'cache/ocr_bench.json'))
+        self.routes = choose_routes(report, config.get('accuracy_floor', 0.95), self.engine_names)
+        logger.info(f'OCR路由：{self.routes}，其它使用{self.fallback}')
+
+        self.__engines = {}
+        self.__lock = threading.Lock()
+        # 预先初始化所有用到的引擎，避免第一次识别时等待
+        self.engine(self.fallback)
+        for crop_type, name in list(self.routes.items()):
+            try:
+                self.engine(name)
+            except Exception as exc:
+                logger.warning(f'引擎{name}初始化失败，{crop_type}改用{self.fallback}：{exc!r}')
+                del self.routes[crop_type]
+
+    def engine(self, name) -> BaseOCR:
+        with self.__lock:
+            if name not in self.__engines:
+                self.__engines[name] = OCR_CLASSES[name](name)
+            return self.__engines[name]
+
+    def scan_image(self, image_bytes, ret_detail, compression_ratio=1, crop_type=None):
+        engine = self.engine(self.routes.get(crop_type, self.fallback))
+        return engine.scan_image(image_bytes, ret_detail, compression_ratio, crop_type)
+
+    def __getattr__(self, name):
+        # 令牌相关的属性与方法（access_token、refresh_access_token等）转发给具有它们的引擎
+        for engine in self.__dict__.get('_AutoOCR__engines', {}).values():
+            if hasattr(engine, name):
+                return getattr(engine, name)
+        raise AttributeError(name)
+
+
+OCR_CLASSES = {
+    'local_ocr': EasyOCR,
+    'baidu_ocr': BaiduOCR,
+}
+
+
+def load_bench_report(filepath) -> dict:
+    """读取ocr-bench生成的测评报告，不存在时返回空报告"""
+    if not os.path.exists(filepath):
+        return {}
+    with open(filepath, 'r', encoding='UTF-8') as fp:
+        return json.load(fp)
+
+
+def choose_routes(report: dict, accuracy_floor, engine_names=None) -> dict[str, str]:
+    """根据测评报告为每类截图选择引擎
+
+    :param report: 测评报告，engines下为 {引擎: {截图类型: {accuracy, p50, ...}}}
+    :param accuracy_floor: 准确率下限
+    :param engine_names: 参与选择的引擎，默认为报告中的所有引擎
+    :return: {截图类型: 引擎名称}
+    """
+    results = {name: types for name, types in (report.get('engines') or {}).items()
+               if engine_names is None or name in engine_names}
+    routes = {}
+    for crop_type in CROP_TYPES:
+        candidates = [(stats['p50'], name) for name, types in results.items()
+                      if (stats := types.get(crop_type)) and not stats.get('errors')]
+        if not candidates:
+            continue
+        qualified = [c for c in candidates if results[c[1]][crop_type]['accuracy'] >= accuracy_floor]
+        if qualified:
+            routes[crop_type] = min(qualified)[1]
+        else:
+            routes[crop_type] = max(candidates, key=lambda c: results[c[1]][crop_type]['accuracy'])[1]
+    return routes
+
+
 def get_ocr(ocr_name):
     """根据OCR名称去实例化一个OCR实现类
 
-    :param ocr_name: OCR名称
+    :param ocr_name: OCR名称，auto表示按截图类型自动选择
     :return: OCR实例化的对象
     """
-    ocr_class = {
-        'local_ocr': EasyOCR,
-        'baidu_ocr': BaiduOCR,
-        'google_ocr': None
-    }[ocr_name]
+    ocr_class = AutoOCR if ocr_name == 'auto' else OCR_CLASSES[ocr_name]
     logger.info(f'{ocr_class=}')
     return ocr_class(ocr_name)
 
 
 if __name__ == '__main__':
     logger.info('start..')
-    obj = get_ocr('local')
+    obj = get_ocr('local_ocr')
 
     with open('debug/screenshot.png', 'rb') as fp:
         start = time.time()
@@ -0,0 +1,176 @@
+"""
+Author: iota
+Create: 2024.3.22 20:37
+Project: YuanShenTool
+Path: src/modules/ocrbench.py
+IDE: PyCharm
+Description: OCR引擎测评，在标注好的截图上统计各引擎的延迟分位数与准确率，结果供AutoOCR选择引擎
+"""
+import json
+import os
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+from src.modules.ocr import CROP_TYPES, OCR_CLASSES
+from src.utils.support import logger
+from src.utils.trace import percentile
+
+# 各类截图在购买流程中的识别参数
+SCAN_ARGS = {
+    'shop_list': {'ret_detail': True, 'compression_ratio': 0.5},
+    'sellout': {'ret_detail': False},
+    'quantity': {'ret_detail': False},
+}
+LABELS_FILENAME = 'labels.json'
+
+
+@dataclass
+class Sample:
+    crop_type: str
+    filename: str
+    image_bytes: bytes
+    expected: list[str]
+
+
+def load_corpus(corpus_dir) -> list[Sample]:
+    """读取测评用的截图
+
+    目录下的labels.json记录每张截图应识别出的文字，键为相对路径，路径的第一级目录为截图类型，例如：
+    {"shop_list/0001.png": ["摆设A", "摆设B"], "quantity/0001.png": ["6"], "sellout/0002.png": []}
+    """
+    with open(os.path.join(corpus_dir, LABELS_FILENAME), 'r', encoding='UTF-8') as fp:
+        labels = json.load(fp)
+    samples = []
+    for filename, expected in labels.items():
+        crop_type = filename.replace('\\', '/').split('/', 1)[0]
+        if crop_type not in CROP_TYPES:
+            logger.warning(f'未知的截图类型，跳过：{filename}')
+            continue
+        with open(os.path.join(corpus_dir, filename), 'rb') as fp:
+            samples.append(Sample(crop_type, filename, fp.read(), list(expected)))
+    return samples
+
+
+def texts_of(detection, ret_detail) -> list[str]:
+    if not detection:
+        return []
+    return [item[1] for item in detection] if ret_detail else list(detection)
+
+
+def score(expected: list[str], detected: list[str]) -> float:
+    """识别结果的得分，按文字完全匹配计算F1，都为空时为1"""
+    if not expected and not detected:
+        return 1.0
+    matched = sum((Counter(expected) & Counter(detected)).values())
+    return 2 * matched / (len(expected) + len(detected))
+
+
+def benchmark(engines: dict, samples: list[Sample], repeat=1, progress=None) -> dict:
+    """在所有截图上运行各引擎
+
+    :param engines: {引擎名称: OCR对象}
+    :param repeat: 每张截图识别的次数，只有第一次计入准确率
+    :param progress: 进度回调，以关键字参数 done/total/message 调用
+    :return: 测评报告，engines下为 {引擎: {截图类型: {count, accuracy, p50, p95, max, errors}}}，时间单位毫秒
+    """
+    report = {'generated_at': time.strftime('%Y-%m-%d %H:%M:%S'), 'repeat': repeat, 'engines': {}}
+    total = len(engines) * len(samples)
+    done = 0
+    for name, engine in engines.items():
+        latencies = {crop_type: [] for crop_type in CROP_TYPES}
+        scores = {crop_type: [] for crop_type in CROP_TYPES}
+        errors = Counter()
+        for sample in samples:
+            args = SCAN_ARGS[sample.crop_type]
+            for i in range(repeat):
+                start = time.perf_counter()
+                try:
+                    detection = engine.scan_image(sample.image_bytes, crop_type=sample.crop_type, **args)
+                except Exception as exc:
+                    logger.warning(f'{name} 识别 {sample.filename} 失败：{exc!r}')
+                    errors[sample.crop_type] += 1
+                    break
+                latencies[sample.crop_type].append(time.perf_counter() - start)
+                if i == 0:
+                    scores[sample.crop_type].append(score(sample.expected, texts_of(detection, args['ret_detail'])))
+            done += 1
+            if progress:
+                progress(done=done, total=total, message=f'{name} {sample.filename}')
+
+        report['engines'][name] = {}
+        for crop_type in CROP_TYPES:
+            values = sorted(latencies[crop_type])
+            if not values and not errors[crop_type]:
+                continue
+            report['engines'][name][crop_type] = {
+                'count': len(scores[crop_type]),
+                'accuracy': round(sum(scores[crop_type]) / len(scores[crop_type]), 4) if scores[crop_type] else 0,
+                'p50': round(percentile(values, 50) * 1e3, 2),
+                'p95': round(percentile(values, 95) * 1e3, 2),
+                'max': round(values[-1] * 1e3, 2) if values else 0,
+                'errors': errors[crop_type],
+            }
+    return report
+
+
+def create_engines(names=None) -> dict:
+    """实例化要测评的引擎，默认为所有已注册的引擎，初始化失败的引擎会被跳过"""
+    engines = {}
+    for name in names or OCR_CLASSES:
+        try:
+            engines[name] = OCR_CLASSES[name](name)
+        except Exception as exc:
+            logger.warning(f'引擎{name}初始化失败，不参与测评：{exc!r}')
+    return engines
+
+
+def save_report(filepath, report):
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    with open(filepath, 'w', encoding='UTF-8') as fp:
+        json.dump(report, fp, ensure_ascii=False, indent=4)
+
+
+def generate_corpus(corpus_dir, count=20, font_path=None, seed=None) -> int:
+    """用商店模拟器生成已标注的截图，需要提供能显示中文的字体，图片才能被真实的引擎识别
+
+    :param count: 每类截图的数量
+    :return: 生成的截图数量
+    """
+    from src.modules.sim import BUTTONS, LIST_RECT, QUANTITY_RECT, ROW_HEIGHT, STATUS_RECT, ShopItem, ShopSimulator
+
+    rng = random.Random(seed)
+    labels = {}
+
+    def save(crop_type, index, simulator, rect):
+        filename = '%s/%04d.png' % (crop_type, index)
+        os.makedirs(os.path.join(corpus_dir, crop_type), exist_ok=True)
+        simulator.render().crop(rect).save(os.path.join(corpus_dir, filename))
+        x1, y1, x2, y2 = rect
+        labels[filename] = [text for text, (bx1, by1, bx2, by2) in simulator.words()
+                            if bx1 >= x1 and by1 >= y1 and bx2 <= x2 and by2 <= y2]
+
+    for i in range(count):
+        shelf = rng.choice(['stuff', 'blueprint'])
+        items = [ShopItem(''.join(rng.choice('桌椅灯柜屏风石木花窗台榻镜') for _ in range(rng.randint(2, 9))),
+                          rng.randint(1, 30) if shelf == 'stuff' else 1, sold_out=rng.random() < 0.3)
+                 for _ in range(rng.randint(4, 20))]
+        simulator = ShopSimulator(items, shelf=shelf, font_path=font_path)
+        simulator.on_click(*BUTTONS['open_shop'][:2])
+        simulator.on_click(*BUTTONS['tab_' + shelf][:2])
+        sold_out_rows = [row for row, item in enumerate(simulator.items) if item.sold_out]
+        if sold_out_rows and rng.random() < 0.5:
+            # 一半的样本滚动到售罄的商品，使售罄状态的截图有文字
+            max_scroll = max(0, len(items) * ROW_HEIGHT - (LIST_RECT[3] - LIST_RECT[1]))
+            simulator.scroll = min(sold_out_rows[0] * ROW_HEIGHT, max_scroll)
+        save('shop_list', i, simulator, LIST_RECT)
+        save('sellout', i, simulator, STATUS_RECT)
+        simulator.scroll = 0
+        simulator.on_click(LIST_RECT[0] + 100, LIST_RECT[1] + ROW_HEIGHT // 2)
+        simulator.on_click(*BUTTONS['exchange'][:2])
+        save('quantity', i, simulator, QUANTITY_RECT)
+
+    with open(os.path.join(corpus_dir, LABELS_FILENAME), 'w', encoding='UTF-8') as fp:
+        json.dump(labels, fp, ensure_ascii=False, indent=4)
+    return len(labels)
@@ -10,15 +10,25 @@ import ctypes
 import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 from typing import Literal
 
 import keyboard
 
+from src.modules.arbiter import ForegroundArbiter
 from src.modules.base import Automize
+from src.modules.cooktune import DEFAULT_PROFILE, load_profile, record_sequence
 from src.modules.inv import HandleInv
 from src.modules.ocr import get_ocr
+from src.modules.plot import CHOICES, NO_DIALOGUE, RENDERED, get_detector
+from src.modules.window import BASE_SIZE, find_windows
+from src.utils.cancel import CancelToken, OperationCancelled, cancel_scope
 from src.utils.img import count_pixels_of_color
-from src.utils.support import DEBUG_MODE, logger, pub_config
+from src.utils.profiler import profiler
+from src.utils.recorder import frame_recorder
+from src.utils.support import DEBUG_MODE, LogSampler, logger, pub_config
+from src.utils.trace import tracer
 
 
 class OPR:
@@ -27,11 +37,34 @@ class OPR:
             raise PermissionError('未获得管理员权限，无法操作窗口')
 
         self.auto = Automize(window_title='原神', window_classname='UnityWndClass')
+        # 多开时每个窗口一个Automize，共用前台仲裁者与OCR
+        self.arbiter = ForegroundArbiter(pub_config.get('foreground_quantum', 8), pub_config.get('foreground_grace', 0))
+        self.__windows = {}
         self.ocr = None
         init_ocr_thr = threading.Thread(target=self.__init_ocr, name='init_ocr')
         init_ocr_thr.daemon = True
         init_ocr_thr.start()
-        self.StopAll = False
+        # 所有流程的取消令牌都派生自它，关闭程序时一起取消
+        self.stop_token = CancelToken()
+        pub_config.subscribe(self.__on_config_changed)
+        # 快捷键切换下一次运行是否进行性能剖析
+        if hotkey := (pub_config.get('profile') or {}).get('hotkey'):
+            keyboard.add_hotkey(hotkey, profiler.toggle)
+
+    def __on_config_changed(self, changed: dict):
+        if 'foreground_quantum' in changed:
+            self.arbiter.quantum = changed['foreground_quantum']
+        if 'foreground_grace' in changed:
+            self.arbiter.grace = changed['foreground_grace']
+
+    @property
+    def StopAll(self):
+        return self.stop_token.cancelled
+
+    @StopAll.setter
+    def StopAll(self, value):
+        if value:
+            self.stop_token.cancel()
 
     def __init_ocr(self):
         try:
@@ -43,52 +76,93 @@ class OPR:
             self.ocr = False
             self.__ocr_error = exc
 
-    def cooking(self, count=1):
+    @tracer.session('cooking')
+    @profiler.session('cooking')
+    def cooking(self, count=1, progress=None):
+        """自动烹饪完美料理
+
+        :param count: 烹饪次数
+        :param progress: 进度回调，以关键字参数 done/total/message 调用
+        :return: 返回成功标志，结果消息
+        """
         if not self.auto.activate_window():
             return False, self.auto.window_title + '未启动！'
 
-        def on_escape():
-            nonlocal stop_execution
-            stop_execution = True
-
-        stop_execution = False
-        keyboard.add_hotkey('ESC', callback=on_escape)
-
-        scan_rect = 520, 680, 1400, 860
-        best_area_color = 255, 192, 64
+        token = self.stop_token.child()
+        hotkey = keyboard.add_hotkey('ESC', callback=token.cancel)
+
+        cooking_config = pub_config.get('cooking') or {}
+        recording = bool(cooking_config.get('record'))
+        window = self.auto.get_window_position()
+        size = window[2:] if window else BASE_SIZE
+        # 录制时使用默认的截图区域，调优在其中搜索更小的区域
+        profile = DEFAULT_PROFILE if recording else load_profile(
+            cooking_config.get('profile', 'cache/cooking_profile.json'), size)
+        if profile is not DEFAULT_PROFILE:
+            logger.info(f'使用调优的烹饪参数：{profile}')
+        scan_rect = profile.scan_rect
         begin_best_area = None
+        pixels_log = LogSampler(interval=0.5)
 
-        for c in range(count):
-            if stop_execution or self.StopAll:
-                break
-
-            self.auto.click(1030, 1030)
-            self.auto.waiting(2)
-            if begin_best_area is None:
-                begin_image = self.auto.take_screenshot_as_image(*scan_rect)
-                begin_best_area = count_pixels_of_color(begin_image, best_area_color, tolerance=5)
-                logger.info(f'初始最佳区域面积：{begin_best_area}')
-
-            for _ in range(300):
-                panel_image = self.auto.take_screenshot_as_image(*scan_rect)
-                now_best_area = count_pixels_of_color(panel_image, best_area_color, tolerance=5)
-                logger.debug(f'PIXELS NUM: {now_best_area}')
-                if begin_best_area - now_best_area > 100:
-                    logger.info('到达最佳区域，点击结束')
-                    self.auto.click(960, 940)
-                    break
-
-            self.auto.waiting(7)
-            self.auto.click(1020, 910)
-
-        keyboard.remove_hotkey(on_escape)
-        if stop_execution:
+        try:
+            with cancel_scope(token):
+                for c in range(count):
+                    self.auto.click(1030, 1030)
+                    self.auto.waiting(2)
+                    if begin_best_area is None:
+                        begin_image = self.auto.take_screenshot_as_image(*scan_rect)
+                        begin_best_area = count_pixels_of_color(begin_image, profile.color, tolerance=profile.tolerance)
+                        logger.info(f'初始最佳区域面积：{begin_best_area}')
+                        if begin_best_area <= profile.threshold and profile is not DEFAULT_PROFILE:
+                            # 调优的截图区域没有覆盖这道料理的最佳区域，指针到达时面积的减少不会超过阈值
+                            logger.warning(f'初始最佳区域面积不超过调优的阈值{profile.threshold}，改用默认的烹饪参数，'
+                                           f'请录制这道料理后重新运行cook-tune')
+                            profile = DEFAULT_PROFILE
+                            scan_rect = profile.scan_rect
+                            begin_image = self.auto.take_screenshot_as_image(*scan_rect)
+                            begin_best_area = count_pixels_of_color(begin_image, profile.color,
+                                                                    tolerance=profile.tolerance)
+                            logger.info(f'初始最佳区域面积：{begin_best_area}')
+
+                    frames, fired = [], None
+                    for i in range(300):
+                        token.raise_if_cancelled()
+                        with tracer.span('cooking.frame'):
+                            panel_image = self.auto.take_screenshot_as_image(*scan_rect)
+                            now_best_area = count_pixels_of_color(panel_image, profile.color,
+                                                                  tolerance=profile.tolerance)
+                        if recording:
+                            frames.append(panel_image)
+                        if pixels_log.ready():
+                            logger.debug('PIXELS NUM: %d (省略%d帧)', now_best_area, pixels_log.skipped)
+                        if begin_best_area - now_best_area > profile.threshold:
+                            logger.info('到达最佳区域，点击结束')
+                            self.auto.click(960, 940)
+                            fired = i
+                            break
+
+                    if recording:
+                        name = record_sequence(cooking_config.get('record_dir', 'cache/cooking_frames'), size,
+                                               scan_rect, begin_image, frames, fired)
+                        logger.info(f'已录制{len(frames)}帧：{name}')
+                    self.auto.waiting(7)
+                    self.auto.click(1020, 910)
+                    if progress:
+                        progress(done=c + 1, total=count, message='烹饪中')
+        except OperationCancelled:
+            frame_recorder.dump('cooking_stopped')
             return False, '操作停止'
+        finally:
+            keyboard.remove_hotkey(hotkey)
+            logger.info(self.auto.input.format_stats())
         return True, '操作成功'
 
-    def play_plots(self):
+    @tracer.session('play_plots')
+    @profiler.session('play_plots')
+    def play_plots(self, progress=None):
         """自动播放剧情
 
+        :param progress: 进度回调，以关键字参数 message 调用
         :return: 返回成功标志，结果消息
         """
         if not self.auto.activate_window():
@@ -96,17 +170,24 @@ class OPR:
 
         logger.info('[开始]播放剧情')
         switch = True
-        stop_execution = False
+        token = self.stop_token.child()
+        # 每次点击后至少间隔的秒数
         playing_delay = 0.1
+        detector = get_detector(self.auto)
+        plots_config = pub_config.get('play_plots') or {}
+        poll_interval = plots_config.get('poll_interval', 0.05)
+        # 开始后一直没有检测到对话时，取样区域多半与当前的分辨率或界面不符，改为定时点击
+        fallback_after = plots_config.get('fallback_after', 10)
 
         def pause():
             nonlocal switch
             switch = not switch
             logger.info('[继续]播放剧情' if switch else '[暂停]播放剧情')
+            if progress:
+                progress(message='播放剧情' if switch else '已暂停')
 
         def stop():
-            nonlocal stop_execution
-            stop_execution = True
+            token.cancel()
             logger.info('[停止]播放剧情')
 
         def speed_up():
@@ -121,82 +202,235 @@ class OPR:
             if playing_delay > 2:
                 playing_delay = 2
 
-        keyboard.add_hotkey('CAPSLOCK', pause)
-        keyboard.add_hotkey('ALT+Q', stop)
-        keyboard.add_hotkey('LEFT', slow_down)
-        keyboard.add_hotkey('RIGHT', speed_up)
-
-        while not (stop_execution or self.StopAll):
-            if switch and self.auto.is_window_on_top():
-                self.auto.click(1300, 800)
-                time.sleep(playing_delay)
-            else:
-                time.sleep(0.1)
-
-        keyboard.remove_hotkey(pause)
-        keyboard.remove_hotkey(stop)
-        keyboard.remove_hotkey(slow_down)
-        keyboard.remove_hotkey(speed_up)
+        hotkeys = [
+            keyboard.add_hotkey('CAPSLOCK', pause),
+            keyboard.add_hotkey('ALT+Q', stop),
+            keyboard.add_hotkey('LEFT', slow_down),
+            keyboard.add_hotkey('RIGHT', speed_up)
+        ]
+        if progress:
+            progress(message='播放剧情')
+
+        on_top = False
+        next_focus_check = 0
+        started_at = time.monotonic()
+        dialogue_seen = timed_click = False
+        try:
+            with cancel_scope(token):
+                while not token.cancelled:
+                    # 窗口焦点变化不频繁，每0.5秒检查一次
+                    if time.monotonic() >= next_focus_check:
+                        on_top = self.auto.is_window_on_top()
+                        next_focus_check = time.monotonic() + 0.5
+                    if not (switch and on_top):
+                        # 暂停或窗口不在前台的时间不计入
+                        started_at = time.monotonic()
+                        token.wait(0.1)
+                        continue
+
+                    # 文字显示完毕时点击继续，出现选项时点击第一个选项，其它状态只继续取样
+                    state = detector.detect()
+                    if state != NO_DIALOGUE and not dialogue_seen:
+                        dialogue_seen = True
+                        if timed_click:
+                            timed_click = False
+                            logger.info('检测到对话，恢复按对话状态点击')
+                    elif not dialogue_seen and not timed_click and time.monotonic() - started_at >= fallback_after:
+                        timed_click = True
+                        logger.warning(f'{fallback_after}秒内未检测到对话，取样区域可能需要校准'
+                                       '（配置项play_plots.markers），改为定时点击')
+
+                    if timed_click:
+                        self.auto.click(1300, 800)
+                    elif state == RENDERED:
+                        self.auto.click(960, 900)
+                    elif state == CHOICES:
+                        self.auto.click(*detector.choice_position)
+                    else:
+                        token.wait(poll_interval)
+                        continue
+                    logger.debug('对话状态：%s', state)
+                    token.wait(playing_delay)
+        except OperationCancelled:
+            pass
+        finally:
+            for hotkey in hotkeys:
+                keyboard.remove_hotkey(hotkey)
         return True, '结束自动播放'
 
-    def buy_commodities(self, shelf: Literal['stuff', 'blueprint'], inv_file):
+    def __check_ocr(self) -> str | None:
+        """OCR不可用时返回原因"""
+        if self.ocr is None:
+            return '请等待OCR完成初始化'
+        elif self.ocr is False:
+            return f'OCR启用不成功：{self.__ocr_error}'
+        elif hasattr(self.ocr, 'access_token') and self.ocr.access_token is None:
+            return '<refresh_access_token>'
+        return None
+
+    def count_game_windows(self) -> int:
+        """打开的游戏窗口数量，只枚举句柄，不创建Automize"""
+        return len(find_windows(self.auto.window_title, self.auto.window_classname))
+
+    def game_windows(self) -> list[Automize]:
+        """所有打开的游戏窗口，按句柄排序，已关闭的窗口不再保留
+
+        每个窗口的Automize会监听窗口事件，只在多开购买时创建
+        """
+        handles = sorted(find_windows(self.auto.window_title, self.auto.window_classname))
+        for handle in set(self.__windows) - set(handles):
+            self.__windows.pop(handle).watcher.stop()
+        for handle in handles:
+            if handle not in self.__windows:
+                self.__windows[handle] = Automize(self.auto.window_title, self.auto.window_classname,
+                                                  handle=handle, arbiter=self.arbiter)
+        return [self.__windows[handle] for handle in handles]
+
+    @tracer.session('buy_commodities')
+    @profiler.session('buy_commodities')
+    def buy_commodities(self, shelf: Literal['stuff', 'blueprint'], inv_file, progress=None):
         """自动读取需求清单，购买洞天摆设或图纸
 
         需已打开与壶灵的对话列表
 
         :param shelf: stuff=摆设，blueprint=图纸
         :param inv_file: 保存清单的Excel文件名称
+        :param progress: 进度回调，以关键字参数 done/total/message 调用
         :return: 返回成功标志，结果信息
         """
-        if self.ocr is None:
-            return False, '请等待OCR完成初始化'
-        elif self.ocr is False:
-            return False, f'OCR启用不成功：{self.__ocr_error}'
-        elif hasattr(self.ocr, 'access_token') and self.ocr.access_token is None:
-            return False, '<refresh_access_token>'
+        if message := self.__check_ocr():
+            return False, message
         elif not self.auto.activate_window():
             return False, self.auto.window_title + '未启动！'
+        elif shelf not in ('stuff', 'blueprint'):
+            logger.warning(f'unacceptable value: {shelf}')
+            return False, 'shelf参数错误'
 
         logger.info(self.auto.window_title + '启动！')
-        self.auto.click(1300, 650)
-        self.auto.waiting(1)
-        match shelf:
-            case 'stuff':
-                self.auto.click(200, 250)
-            case 'blueprint':
-                self.auto.click(200, 340)
-            case _:
-                logger.warning(f'unacceptable value: {shelf}')
-                return False, 'shelf参数错误'
-        self.auto.waiting(1.5)
-
+        token = self.stop_token.child()
+        hotkey = keyboard.add_hotkey('ESC', callback=token.cancel)
         try:
-            return ImplementBuyCommodities(self, inv_file).main(shelf)
+            with cancel_scope(token):
+                self.auto.click(1300, 650)
+                self.auto.waiting(1)
+                self.auto.click(200, 250 if shelf == 'stuff' else 340)
+                self.auto.waiting(1.5)
+                symbol, message = ImplementBuyCommodities(self, inv_file, token, progress).main(shelf)
+        except OperationCancelled:
+            symbol, message = False, '操作停止'
         except Exception as exc:
             logger.error(f'An error occurred: {exc}')
+            frame_recorder.dump('buy_error')
+            return False, f'发生错误：{exc}'
+        finally:
+            keyboard.remove_hotkey(hotkey)
+            logger.info(self.auto.input.format_stats())
+            if hasattr(self.ocr, 'stats'):
+                logger.info(f'OCR模型：{self.ocr.stats()}')
+        if not symbol:
+            frame_recorder.dump('buy_stopped')
+        return symbol, message
+
+    @tracer.session('buy_commodities_multi')
+    @profiler.session('buy_commodities_multi')
+    def buy_commodities_multi(self, shelf: Literal['stuff', 'blueprint'], inv_files: list[str], progress=None):
+        """多开时在所有游戏窗口中同时购买，按窗口顺序使用各自的清单
+
+        点击、滚动与截图由前台仲裁者轮流分配，一个窗口识别截图时其他窗口可以继续操作
+
+        :param inv_files: 每个窗口的清单文件，数量少于窗口时多出的窗口不操作
+        :param progress: 进度回调，以关键字参数 done/total/message 调用，message带有窗口序号
+        :return: 返回成功标志，各窗口的结果信息
+        """
+        if message := self.__check_ocr():
+            return False, message
+        elif shelf not in ('stuff', 'blueprint'):
+            logger.warning(f'unacceptable value: {shelf}')
+            return False, 'shelf参数错误'
+        elif len(set(inv_files)) != len(inv_files):
+            # 同一个清单的购买日志不能由多个窗口同时写入
+            return False, '每个窗口需要使用不同的清单'
+
+        windows = self.game_windows()
+        if not windows:
+            return False, self.auto.window_title + '未启动！'
+        pairs = list(zip(windows, inv_files))
+        logger.info(f'共{len(windows)}个窗口，操作其中{len(pairs)}个')
+
+        token = self.stop_token.child()
+        hotkey = keyboard.add_hotkey('ESC', callback=token.cancel)
+        try:
+            with ThreadPoolExecutor(max_workers=len(pairs), thread_name_prefix='buy_window') as executor:
+                futures = [executor.submit(tracer.bind(self.__buy_in_window), index, auto, inv_file, shelf, token, progress)
+                           for index, (auto, inv_file) in enumerate(pairs, 1)]
+                results = [future.result() for future in futures]
+        finally:
+            keyboard.remove_hotkey(hotkey)
+            logger.info(self.arbiter.format_stats())
+        symbol = all(symbol for symbol, _ in results)
+        if not symbol:
+            frame_recorder.dump('buy_stopped')
+        return symbol, '；'.join(f'窗口{index}：{message}' for index, (_, message) in enumerate(results, 1))
+
+    def __buy_in_window(self, index, auto: Automize, inv_file, shelf, token, progress=None):
+        def window_progress(message, **kwargs):
+            progress(message=f'[窗口{index}] {message}', **kwargs)
+
+        context = SimpleNamespace(auto=auto, ocr=self.ocr)
+        try:
+            with cancel_scope(token):
+                auto.click(1300, 650)
+                auto.waiting(1)
+                auto.click(200, 250 if shelf == 'stuff' else 340)
+                auto.waiting(1.5)
+                return ImplementBuyCommodities(context, inv_file, token, progress and window_progress).main(shelf)
+        except OperationCancelled:
+            return False, '操作停止'
+        except Exception as exc:
+            logger.error(f'窗口{index}发生错误：{exc}')
+            return False, f'发生错误：{exc}'
+        finally:
+            logger.info(f'窗口{index}：{auto.input.format_stats()}')
 
 
 class ImplementBuyCommodities:
-    def __init__(self, opr_obj, inv_file):
+    def __init__(self, opr_obj, inv_file, token, progress=None):
         self.opr = opr_obj
         self.inventory = HandleInv(inv_file)
         self.ignored_set = set()
-        self.stop_execution = False
+        self.token = token
+
+        # 进度：需要购买的物品种类数、已购买的种类数、已扫描的页数
+        self.progress = progress
+        self.needed_count = sum(1 for need, own in self.inventory.data.values() if need > own)
+        self.bought_count = 0
+        self.scanned_pages = 0
 
         # 识别商品的矩形区域
         self.rect_left_top = 510, 100
         self.rect_right_bottom = 970, 950
-        # 监听按下ESC时退出
-        keyboard.add_hotkey('ESC', self.on_escape)
 
     def main(self, shelf):
         if not self.inventory.data:
             return False, '清单是空的'
 
+        try:
+            return self.buy_loop(shelf)
+        except OperationCancelled:
+            logger.info('操作停止')
+            return False, '操作停止'
+        finally:
+            # 无论是否中断都保存已购买的数量
+            self.inventory.save_data()
+
+    def buy_loop(self, shelf):
         first_text = ''
-        while not (self.stop_execution or self.opr.StopAll):
-            screenshot = self.opr.auto.take_screenshot_as_png(*self.rect_left_top, *self.rect_right_bottom)
-            detected_items = self.opr.ocr.scan_image(screenshot, ret_detail=True, compression_ratio=0.5)
+        while True:
+            self.token.raise_if_cancelled()
+            with tracer.span('buy.scan_page'):
+                screenshot = self.opr.auto.take_screenshot_as_png(*self.rect_left_top, *self.rect_right_bottom)
+                detected_items = self.opr.ocr.scan_image(screenshot, ret_detail=True, compression_ratio=0.5,
+                                                         crop_type='shop_list')
             if not detected_items:
                 return False, '(っ °Д °;)っ解析结果是空的'
 
@@ -205,9 +439,12 @@ class ImplementBuyCommodities:
                 logger.info('列表结束')
                 break
             first_text = detected_items[0][1]
+            self.scanned_pages += 1
+            self.report_progress(f'扫描第{self.scanned_pages}页')
 
             # 遍历所有已识别的项目
-            need_to_start_over = self.traversal_every_items(detected_items, shelf)
+            with tracer.span('buy.traversal'):
+                need_to_start_over = self.traversal_every_items(detected_items, shelf)
             if need_to_start_over:
                 first_text = ''
                 continue
@@ -217,28 +454,22 @@ class ImplementBuyCommodities:
                 logger.info('购买完成')
                 break
 
-            # 向下滚动列表
-            self.opr.auto.move_to(1200, 860)
-            self.opr.auto.scroll(-45)
+            # 向下滚动列表，滚轮作用于光标所在的窗口，移动与滚动之间不能切换窗口
+            with self.opr.auto.exclusive():
+                self.opr.auto.move_to(1200, 860)
+                self.opr.auto.scroll(-45)
 
             # 检查是否已售罄
             sellout_image = self.opr.auto.take_screenshot_as_png(1200, 110, 1350, 250)
-            temp_items = self.opr.ocr.scan_image(sellout_image, ret_detail=False)
+            temp_items = self.opr.ocr.scan_image(sellout_image, ret_detail=False, crop_type='sellout')
             if temp_items and temp_items[0] in ['已售罄', '已掌握该配方']:
                 logger.info('剩余商品已无法购买')
                 break
-
-        self.inventory.save_data()
-        keyboard.remove_hotkey(self.on_escape)
-        if self.stop_execution:
-            return False, '操作停止'
-        else:
-            return True, '操作完成'
+        return True, '操作完成'
 
     def traversal_every_items(self, detected_items, shelf):
         for item in detected_items:
-            if self.stop_execution or self.opr.StopAll:
-                return False
+            self.token.raise_if_cancelled()
 
             rect, item_name, reliability = item
             if item_name in self.ignored_set:
@@ -254,45 +485,49 @@ class ImplementBuyCommodities:
                 logger.info('物品数量已足够')
                 continue
 
-            # 还原文本所处的坐标，点击目标商品
-            self.opr.auto.click(self.rect_left_top[0] + rect[2][0], self.rect_left_top[1] + rect[2][1])
-            # 点击兑换
-            self.opr.auto.click(1800, 1024)
-            if shelf == 'stuff':
-                # 增加购买数量
-                purchase_num, limited_num = self.click_increase_purchase_num_button(needed_num - existing_num)
-                self.inventory.data[item_name][1] = existing_num + purchase_num
-            else:
-                purchase_num, limited_num = 1, 1
-            logger.info(f'购买数量：{purchase_num}')
-            if not DEBUG_MODE:
-                # 确定兑换
-                self.opr.auto.click(1210, 800)
+            with tracer.span('buy.purchase', item=item_name):
+                # 还原文本所处的坐标，点击目标商品
+                self.opr.auto.click(self.rect_left_top[0] + rect[2][0], self.rect_left_top[1] + rect[2][1])
+                # 点击兑换
+                self.opr.auto.click(1800, 1024)
+                if shelf == 'stuff':
+                    # 增加购买数量
+                    purchase_num, limited_num = self.click_increase_purchase_num_button(needed_num - existing_num)
+                else:
+                    purchase_num, limited_num = 1, 1
+                logger.info(f'购买数量：{purchase_num}')
+                # 确定兑换，调试模式下取消
+                self.opr.auto.click(*((1210, 800) if not DEBUG_MODE else (800, 780)), wait=False)
+                if shelf == 'stuff':
+                    # 点击发出后、任何可取消的等待之前写入购买日志，中途取消、出错或崩溃时下次运行会恢复
+                    self.inventory.record_purchase(item_name, purchase_num)
                 self.opr.auto.waiting(1)
-                # 点击空白
-                self.opr.auto.click(1210, 800)
-            else:
-                # 取消
-                self.opr.auto.click(800, 780)
+                if not DEBUG_MODE:
+                    self.opr.auto.waiting(1)
+                    # 点击空白
+                    self.opr.auto.click(1210, 800)
             self.ignored_set.add(item_name)
+            self.bought_count += 1
+            self.report_progress(f'已购买：{item_name} x{purchase_num}')
             if purchase_num == limited_num:
                 return True
         return False
 
     def click_increase_purchase_num_button(self, real_needed_num):
         max_number_image = self.opr.auto.take_screenshot_as_png(1190, 580, 1260, 620)
-        temp_items = self.opr.ocr.scan_image(max_number_image, ret_detail=False)
+        temp_items = self.opr.ocr.scan_image(max_number_image, ret_detail=False, crop_type='quantity')
         if temp_items and temp_items[0].isdigit():
             limited_num = int(temp_items[0])
         else:
             limited_num = 6
         purchase_num = min(real_needed_num, limited_num)
-        for _ in range(purchase_num - 1):
-            self.opr.auto.click(1290, 600)
+        self.opr.auto.click_burst(1290, 600, purchase_num - 1)
         return purchase_num, limited_num
 
-    def on_escape(self):
-        self.stop_execution = True
+    def report_progress(self, message):
+        if self.progress:
+            self.progress(done=self.bought_count, total=self.needed_count,
+                          pages=self.scanned_pages, message=message)
 
 
 if __name__ == '__main__':
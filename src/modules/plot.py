@@ -0,0 +1,81 @@
+"""
+Author: iota
+Create: 2024.3.13 22:04
+Project: YuanShenTool
+Path: src/modules/plot.py
+IDE: PyCharm
+Description: 通过少量像素取样判断剧情对话的状态，供自动播放剧情使用
+"""
+import numpy as np
+
+from src.utils.img import count_pixels_of_color
+from src.utils.support import pub_config
+
+# 对话状态
+NO_DIALOGUE = 'no_dialogue'
+RENDERING = 'rendering'  # 文字正在逐字显示
+RENDERED = 'rendered'  # 文字已完全显示，等待点击
+CHOICES = 'choices'  # 显示了对话选项
+
+# 取样区域，坐标基于1920x1080；rect为 (x1, y1, x2, y2)，区域内接近color的像素不少于min_pixels时视为出现
+DEFAULT_MARKERS = {
+    # 对话进行中时左上角的「自动」按钮
+    'dialogue': {'rect': (80, 30, 150, 65), 'color': (236, 229, 216), 'tolerance': 20, 'min_pixels': 40},
+    # 文字显示完毕后对话框下方出现的箭头
+    'rendered': {'rect': (940, 995, 980, 1035), 'color': (255, 230, 150), 'tolerance': 30, 'min_pixels': 12},
+    # 对话选项左侧的气泡图标
+    'choices': {'rect': (1280, 420, 1340, 900), 'color': (255, 255, 255), 'tolerance': 15, 'min_pixels': 40},
+}
+
+
+class DialogueDetector:
+    """对话状态检测器，每次检测只截取几个很小的区域"""
+
+    def __init__(self, auto, markers: dict = None):
+        """
+        :param auto: Automize对象
+        :param markers: 覆盖默认取样区域的配置
+        """
+        self.auto = auto
+        self.markers = {name: dict(marker) for name, marker in DEFAULT_MARKERS.items()}
+        for name, marker in (markers or {}).items():
+            self.markers.setdefault(name, {}).update(marker)
+        self.choice_position = None
+
+    def __pixels(self, name):
+        marker = self.markers[name]
+        image = self.auto.take_screenshot_as_image(*marker['rect'])
+        return count_pixels_of_color(image, tuple(marker['color']), tolerance=marker['tolerance'])
+
+    def __present(self, name):
+        return self.__pixels(name) >= self.markers[name]['min_pixels']
+
+    def detect(self) -> str:
+        """检测当前的对话状态，显示选项时choice_position为第一个选项的点击位置
+
+        先确认处于对话中，明亮或下雪的场景中选项区域也可能有足够多的白色像素
+        """
+        if not self.__present('dialogue'):
+            return NO_DIALOGUE
+        if self.__present('choices'):
+            self.choice_position = self.markers['choices']['rect'][2] + 100, self.__first_choice_y()
+            return CHOICES
+        if self.__present('rendered'):
+            return RENDERED
+        return RENDERING
+
+    def __first_choice_y(self):
+        """最上方选项图标的纵坐标"""
+        marker = self.markers['choices']
+        x1, y1, x2, y2 = marker['rect']
+        image_array = np.array(self.auto.take_screenshot_as_image(*marker['rect']), dtype=np.int16)
+        matching = np.all(np.abs(image_array - np.array(marker['color'])) <= marker['tolerance'], axis=-1)
+        rows = np.flatnonzero(matching.any(axis=1))
+        if not rows.size:
+            return y1 + (y2 - y1) // 2
+        # 截图按实际分辨率缩放过，换算回1920x1080坐标
+        return y1 + round(rows[0] * (y2 - y1) / matching.shape[0]) + 10
+
+
+def get_detector(auto) -> DialogueDetector:
+    return DialogueDetector(auto, (pub_config.get('play_plots') or {}).get('markers'))
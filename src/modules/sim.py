@@ -0,0 +1,555 @@
+"""
+Author: iota
+Create: 2024.3.20 21:15
+Project: YuanShenTool
+Path: src/modules/sim.py
+IDE: PyCharm
+Description: 洞天百宝商店界面的模拟器与百度OCR接口替身，不需要游戏即可端到端运行购买流程并统计吞吐
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from types import SimpleNamespace
+
+from openpyxl import Workbook
+from PIL import Image, ImageDraw, ImageFont
+
+from src.modules.window import BASE_SIZE, WindowState
+from src.utils.common import save_config
+from src.utils.support import DEBUG_MODE, logger
+
+# 界面布局，坐标基于1920x1080，与opr.py中使用的坐标对应
+LIST_RECT = 510, 100, 970, 950  # 识别商品名称的区域
+LIST_PANEL = 500, 90, 1420, 960  # 可以点击商品、滚动列表的区域
+ROW_HEIGHT = 85
+TEXT_LEFT = 540
+STATUS_RECT = 1200, 110, 1350, 250  # 列表顶部商品的售罄状态
+LIMIT_TEXT_POS = 1200, 588  # 兑换对话框中的最大可购买数量
+QUANTITY_RECT = 1190, 580, 1260, 620  # 识别最大可购买数量的区域
+BUTTONS = {
+    # 名称: (中心x, 中心y, 半宽, 半高)
+    'open_shop': (1300, 650, 200, 30),
+    'tab_stuff': (200, 250, 120, 40),
+    'tab_blueprint': (200, 340, 120, 40),
+    'exchange': (1800, 1024, 100, 30),
+    'plus': (1290, 600, 25, 25),
+    'confirm': (1210, 800, 120, 30),
+    'cancel': (800, 780, 120, 30),
+}
+SOLD_OUT_TEXT = {'stuff': '已售罄', 'blueprint': '已掌握该配方'}
+
+
+@dataclass
+class ShopItem:
+    name: str
+    stock: int  # 剩余可购买数量
+    sold_out: bool = False
+    bought: int = 0
+
+
+class _Shot:
+    """与mss截图相同的 size / rgb 属性"""
+
+    def __init__(self, image: Image.Image):
+        self.size = image.size
+        self.rgb = image.tobytes()
+
+
+def _fingerprint(image: Image.Image) -> bytes:
+    """缩小后的灰度图，用于在多个模拟器的截图中找到上传的图片"""
+    return image.convert('L').resize((24, 24), Image.BILINEAR).tobytes()
+
+
+class SimDesktop:
+    """多开时的桌面：同一时刻只有一个模拟器在前台，只有它接收输入、出现在截图中
+
+    发给后台模拟器的输入和截图会落到前台的模拟器上，与真实桌面一致，并计入misdirected
+    """
+
+    def __init__(self):
+        self.simulators: list['ShopSimulator'] = []
+        self.foreground = None
+        self.stats = {'activations': 0, 'misdirected_inputs': 0, 'misdirected_grabs': 0}
+        self.__lock = threading.Lock()
+
+    def add(self, simulator):
+        self.simulators.append(simulator)
+        if self.foreground is None:
+            self.activate(simulator)
+        else:
+            simulator.watcher.is_foreground = False
+
+    def activate(self, simulator):
+        with self.__lock:
+            self.foreground = simulator
+            self.stats['activations'] += 1
+            for other in self.simulators:
+                other.watcher.is_foreground = other is simulator
+
+    def route(self, simulator, kind):
+        """实际接收输入或截图的模拟器"""
+        foreground = self.foreground
+        if foreground is not simulator:
+            with self.__lock:
+                self.stats['misdirected_' + kind] += 1
+        return foreground
+
+    def lookup_capture(self, image: Image.Image):
+        """在所有模拟器最近的截图中查找与上传图片最接近的一张，返回其中的文字与位置"""
+        matches = [match for simulator in self.simulators if (match := simulator.match_capture(image))]
+        return min(matches, key=lambda match: match[0])[1] if matches else None
+
+
+class ShopSimulator:
+    """洞天百宝商店的模拟界面，同时作为Automize的screen与input_sink
+
+    按 对话 -> 商店 -> 兑换对话框 -> 获得物品 的状态响应点击与滚轮，售罄的商品排到列表末尾；
+    每次截图都会记录区域内的文字与位置，供OCR替身按图片尺寸或内容查找
+    """
+
+    def __init__(self, items: list[ShopItem], shelf='stuff', font_path=None, font_size=26, scroll_step=17,
+                 desktop: SimDesktop = None, tint=0):
+        """
+        :param items: 商品，按列表顺序排列
+        :param shelf: 商品所在的货架，stuff=摆设，blueprint=图纸
+        :param font_path: 绘制文字使用的字体文件，默认使用PIL内置字体
+        :param font_size: 字号，也决定识别结果中文字框的大小
+        :param scroll_step: 每个滚轮事件滚动的像素
+        :param desktop: 多开时共用的桌面
+        :param tint: 背景色的偏移，多开时使各模拟器的截图可以区分
+        """
+        self.items = list(items)
+        self.shelf = shelf
+        self.font_size = font_size
+        self.scroll_step = scroll_step
+        self.font = self.__load_font(font_path, font_size)
+
+        self.watcher = WindowState(client_rect=(0, 0) + BASE_SIZE)
+        self.state = 'dialogue'
+        self.tab = None
+        self.scroll = 0
+        self.selected = None
+        self.quantity = 0
+        self.cursor = 0, 0
+        self.stats = {'clicks': 0, 'missed_clicks': 0, 'wheels': 0, 'purchases': 0, 'grabs': 0}
+
+        self.tint = tint
+        self.__frame = None
+        self.__captures = deque(maxlen=32)
+        self.__lock = threading.Lock()
+        self.__sort_items()
+        self.desktop = desktop
+        if desktop is not None:
+            desktop.add(self)
+
+    @staticmethod
+    def __load_font(font_path, font_size):
+        if font_path:
+            return ImageFont.truetype(font_path, font_size)
+        try:
+            return ImageFont.load_default(size=font_size)
+        except TypeError:
+            return ImageFont.load_default()
+
+    def __sort_items(self):
+        self.items.sort(key=lambda item: item.sold_out)
+
+    def __visible_items(self) -> list[ShopItem]:
+        return self.items if self.tab == self.shelf else []
+
+    def __max_scroll(self):
+        return max(0, len(self.__visible_items()) * ROW_HEIGHT - (LIST_RECT[3] - LIST_RECT[1]))
+
+    # ---- 窗口与截图 ----
+
+    def activate(self):
+        if self.desktop is not None:
+            self.desktop.activate(self)
+
+    def grab(self, rect):
+        """截取区域并记录其中的文字，rect为屏幕坐标 (left, top, right, bottom)"""
+        if self.desktop is not None and (foreground := self.desktop.route(self, 'grabs')) is not self:
+            return foreground.grab(rect)
+        x1, y1, x2, y2 = rect
+        if self.__frame is None:
+            self.__frame = self.render()
+        words = [(text, (bx1 - x1, by1 - y1, bx2 - x1, by2 - y1))
+                 for text, (bx1, by1, bx2, by2) in self.words()
+                 if bx1 >= x1 and by1 >= y1 and bx2 <= x2 and by2 <= y2]
+        image = self.__frame.crop(rect)
+        with self.__lock:
+            self.__captures.append((x2 - x1, y2 - y1, words, _fingerprint(image) if self.desktop else None))
+            self.stats['grabs'] += 1
+        return _Shot(image)
+
+    def lookup_capture(self, width, height):
+        """按上传图片的尺寸查找最近一次截图，返回按比例缩放后的文字与位置"""
+        with self.__lock:
+            captures = list(self.__captures)
+        for cap_width, cap_height, words, _ in reversed(captures):
+            scale = width / cap_width
+            if abs(cap_height * scale - height) <= 1.5:
+                return _scale_words(words, scale)
+        return None
+
+    def match_capture(self, image: Image.Image):
+        """多开时按内容匹配上传的图片
+
+        每个窗口截图后立即识别，所以只取尺寸相符的最近一次截图，与其他模拟器比较内容的差异
+        :return: (差异, 缩放后的文字与位置)，没有尺寸相符的截图时返回None
+        """
+        with self.__lock:
+            captures = list(self.__captures)
+        for cap_width, cap_height, words, cap_fingerprint in reversed(captures):
+            scale = image.width / cap_width
+            if cap_fingerprint is not None and abs(cap_height * scale - image.height) <= 1.5:
+                distance = sum(abs(a - b) for a, b in zip(_fingerprint(image), cap_fingerprint))
+                return distance, _scale_words(words, scale)
+        return None
+
+    def words(self) -> list[tuple[str, tuple[int, int, int, int]]]:
+        """当前界面上的文字及其所在矩形"""
+        words = []
+        if self.state == 'dialogue':
+            words.append(('洞天百宝', self.__text_box(1200, 636, '洞天百宝')))
+            return words
+        for row, item in self.__rows():
+            top = LIST_RECT[1] + row * ROW_HEIGHT - self.scroll
+            words.append((item.name, self.__text_box(TEXT_LEFT, top + (ROW_HEIGHT - self.font_size) // 2, item.name,
+                                                     right=LIST_RECT[2] - 10)))
+        rows = self.__rows()
+        if rows and rows[0][1].sold_out:
+            text = SOLD_OUT_TEXT[self.shelf]
+            words.append((text, self.__text_box(STATUS_RECT[0] + 10, STATUS_RECT[1] + 30, text,
+                                                right=STATUS_RECT[2] - 2)))
+        if self.state == 'dialog':
+            text = str(self.items[self.selected].stock)
+            words.append((text, self.__text_box(*LIMIT_TEXT_POS, text)))
+        return words
+
+    def __text_box(self, x, y, text, right=None):
+        """文字所在的矩形，汉字按字号宽度、数字按半宽估算，超出right时截断"""
+        width = self.font_size * len(text) // (2 if text.isdigit() else 1)
+        if right is not None:
+            width = min(width, right - x)
+        return x, y, x + width, y + self.font_size
+
+    def __rows(self) -> list[tuple[int, ShopItem]]:
+        """完整显示在列表区域内的行"""
+        rows = []
+        for row, item in enumerate(self.__visible_items()):
+            top = LIST_RECT[1] + row * ROW_HEIGHT - self.scroll
+            if top >= LIST_RECT[1] and top + ROW_HEIGHT <= LIST_RECT[3]:
+                rows.append((row, item))
+        return rows
+
+    def render(self) -> Image.Image:
+        """绘制整个界面"""
+        image = Image.new('RGB', BASE_SIZE, (40 + self.tint, 44 + self.tint, 60 + self.tint))
+        draw = ImageDraw.Draw(image)
+        if self.state != 'dialogue':
+            for name in ('tab_stuff', 'tab_blueprint', 'exchange'):
+                draw.rectangle(self.__button_rect(name), fill=(70, 80, 110))
+            for row, item in self.__rows():
+                top = LIST_RECT[1] + row * ROW_HEIGHT - self.scroll
+                fill = (120, 120, 120) if item.sold_out else (236 - self.tint, 229 - self.tint, 216 - self.tint)
+                if row == self.selected:
+                    fill = (255, 230, 150)
+                draw.rectangle((LIST_PANEL[0], top + 4, 1180, top + ROW_HEIGHT - 4), fill=fill)
+        for text, box in self.words():
+            draw.text(box[:2], text, fill=(20, 20, 20), font=self.font)
+        if self.state == 'dialog':
+            for name in ('plus', 'confirm', 'cancel'):
+                draw.rectangle(self.__button_rect(name), fill=(200, 160, 60))
+        return image
+
+    # ---- 输入 ----
+
+    @staticmethod
+    def __button_rect(name):
+        x, y, half_width, half_height = BUTTONS[name]
+        return x - half_width, y - half_height, x + half_width, y + half_height
+
+    def __hit(self, name, x, y):
+        x1, y1, x2, y2 = self.__button_rect(name)
+        return x1 <= x <= x2 and y1 <= y <= y2
+
+    def send(self, event):
+        """作为Automize的input_sink接收输入事件"""
+        if self.desktop is not None and (foreground := self.desktop.route(self, 'inputs')) is not self:
+            foreground.send(event)
+            return
+        if event.kind == 'move':
+            self.cursor = event.x, event.y
+        elif event.kind == 'up':
+            self.stats['clicks'] += 1
+            if not self.on_click(event.x, event.y):
+                self.stats['missed_clicks'] += 1
+                logger.debug('模拟器：未命中的点击 (%d, %d) 状态=%s', event.x, event.y, self.state)
+            self.__frame = None
+        elif event.kind == 'wheel':
+            self.stats['wheels'] += 1
+            x, y = self.cursor
+            if self.state == 'shop' and LIST_PANEL[0] <= x <= LIST_PANEL[2] and LIST_PANEL[1] <= y <= LIST_PANEL[3]:
+                self.scroll = min(max(self.scroll - event.delta * self.scroll_step, 0), self.__max_scroll())
+                self.__select_top_row()
+                self.__frame = None
+
+    def __select_top_row(self):
+        rows = self.__rows()
+        self.selected = rows[0][0] if rows else None
+
+    def on_click(self, x, y) -> bool:
+        """处理一次点击，返回是否命中了可点击的元素"""
+        if self.state == 'dialogue':
+            if self.__hit('open_shop', x, y):
+                self.state = 'shop'
+                return True
+        elif self.state == 'shop':
+            for tab in ('stuff', 'blueprint'):
+                if self.__hit('tab_' + tab, x, y):
+                    self.tab, self.scroll, self.selected = tab, 0, None
+                    return True
+            if self.__hit('exchange', x, y):
+                if self.selected is None or self.items[self.selected].sold_out:
+                    return False
+                self.state, self.quantity = 'dialog', 1
+                return True
+            if LIST_PANEL[0] <= x <= 1180 and LIST_RECT[1] <= y <= LIST_RECT[3]:
+                row = (y - LIST_RECT[1] + self.scroll) // ROW_HEIGHT
+                if row < len(self.__visible_items()):
+                    self.selected = row
+                    return True
+        elif self.state == 'dialog':
+            item = self.items[self.selected]
+            if self.__hit('plus', x, y):
+                self.quantity = min(self.quantity + 1, item.stock)
+                return True
+            if self.__hit('confirm', x, y):
+                self.__purchase(item)
+                self.state = 'receipt'
+                return True
+            if self.__hit('cancel', x, y):
+                self.state = 'shop'
+                return True
+        elif self.state == 'receipt':
+            # 点击任意位置关闭
+            self.state = 'shop'
+            return True
+        return False
+
+    def __purchase(self, item: ShopItem):
+        item.stock -= self.quantity
+        item.bought += self.quantity
+        self.stats['purchases'] += 1
+        logger.debug('模拟器：购买 %s x%d', item.name, self.quantity)
+        if item.stock <= 0:
+            # 售罄的商品移到列表末尾
+            item.sold_out = True
+            self.__sort_items()
+            self.selected = None
+
+
+def _scale_words(words, scale):
+    return [(text, tuple(round(v * scale) for v in box)) for text, box in words]
+
+
+def generate_scenario(item_count=30, shelf='stuff', seed=None, sold_out_ratio=0.1, extra_ratio=0.2,
+                      max_stock=6, shuffle=True):
+    """随机生成商品与需求清单
+
+    :param item_count: 需求清单中的物品数量
+    :param extra_ratio: 额外加入的不在清单中的商品比例
+    :return: 商品列表，清单 {名称: [需求数量, 已有数量]}
+    """
+    rng = random.Random(seed)
+    inventory, items = {}, []
+    for i in range(item_count):
+        name = '测试摆设%03d' % i if shelf == 'stuff' else '测试图纸%03d' % i
+        need = rng.randint(1, 8)
+        inventory[name] = [need, rng.randint(0, need)]
+    names = list(inventory) + ['无关商品%03d' % i for i in range(round(item_count * extra_ratio))]
+    for name in names:
+        stock = 1 if shelf == 'blueprint' else rng.randint(1, max_stock)
+        sold_out = rng.random() < sold_out_ratio
+        items.append(ShopItem(name, 0 if sold_out else stock, sold_out=sold_out))
+    if shuffle:
+        rng.shuffle(items)
+    return items, inventory
+
+
+def write_inventory(filename, inventory: dict):
+    """保存为HandleInv可以读取的清单，文件名相对于cache/"""
+    workbook = Workbook()
+    worksheet = workbook.active
+    worksheet.append(['ID', '等级', '名称', '图片', '需求数量', '已有数量'])
+    for i, (name, (need, own)) in enumerate(inventory.items()):
+        worksheet.append([str(i), 1, name, 'NoImg', need, own])
+    os.makedirs(os.path.dirname('cache/' + filename), exist_ok=True)
+    workbook.save('cache/' + filename)
+
+
+def expected_purchases(items: list[ShopItem], inventory: dict, shelf) -> dict[str, int]:
+    """按购买流程的规则计算每种商品应购买的数量"""
+    expected = {}
+    for item in items:
+        if item.name not in inventory or item.sold_out or DEBUG_MODE:
+            continue
+        need, own = inventory[item.name]
+        if need > own:
+            expected[item.name] = 1 if shelf == 'blueprint' else min(need - own, item.stock)
+    return expected
+
+
+def run_shop_simulation(items: list[ShopItem], inventory: dict, shelf='stuff', action_delay=None,
+                        font_path=None, font_size=26, ocr_latency=0.0, progress=None) -> dict:
+    """在模拟器上运行完整的购买流程
+
+    :param items: 商品列表
+    :param inventory: 需求清单 {名称: [需求数量, 已有数量]}
+    :param action_delay: 覆盖配置的动作延迟，加快运行
+    :param ocr_latency: OCR替身的响应延迟秒数
+    :param progress: 进度回调，同ImplementBuyCommodities
+    :return: 耗时、吞吐与正确性的统计
+    """
+    from src.modules.base import Automize
+    from src.modules.opr import ImplementBuyCommodities
+    from src.modules.standin import Faults, StandInServer
+    from src.utils.cancel import CancelToken, cancel_scope
+
+    expected = expected_purchases(items, inventory, shelf)
+    simulator = ShopSimulator(items, shelf=shelf, font_path=font_path, font_size=font_size)
+    standin = StandInServer({'ocr': Faults(latency=ocr_latency)},
+                            ocr_words=lambda image: simulator.lookup_capture(*image.size)).start()
+
+    inv_file = 'sim/inventory_sim.xlsx'
+    write_inventory(inv_file, inventory)
+
+    try:
+        auto = Automize('洞天百宝模拟器', input_sink=simulator, screen=simulator)
+        if action_delay is not None:
+            auto.ACTION_DELAY = action_delay
+        ocr = _standin_ocr(standin)
+        opr = SimpleNamespace(auto=auto, ocr=ocr)
+
+        token = CancelToken()
+        start = time.perf_counter()
+        with cancel_scope(token):
+            auto.click(1300, 650)
+            auto.click(200, 250 if shelf == 'stuff' else 340)
+            buyer = ImplementBuyCommodities(opr, inv_file, token, progress)
+            symbol, message = buyer.main(shelf)
+        elapsed = time.perf_counter() - start
+    finally:
+        standin.close()
+
+    mismatches = _mismatches(items, expected)
+    items_bought = sum(1 for item in items if item.bought)
+    return {
+        'ok': symbol and not mismatches,
+        'message': message,
+        'elapsed': round(elapsed, 3),
+        'items_bought': items_bought,
+        'items_per_minute': round(items_bought / elapsed * 60, 2) if elapsed else 0,
+        'pages': buyer.scanned_pages,
+        'mismatches': mismatches,
+        'simulator': dict(simulator.stats),
+        'ocr_requests': {service: standin.stats[service] for service in ('token', 'ocr')},
+        'input': auto.input.format_stats(),
+    }
+
+
+def run_multi_simulation(scenarios: list[tuple[list[ShopItem], dict]], shelf='stuff', action_delay=None,
+                         font_path=None, font_size=26, ocr_latency=0.0, quantum=8, grace=0.0, progress=None) -> dict:
+    """模拟多开：每个场景一个模拟器窗口，在各自的线程中购买，共用前台仲裁者与一个OCR对象
+
+    与OPR.buy_commodities_multi的结构相同；输入或截图落到非前台的窗口时计入desktop的misdirected
+
+    :param scenarios: 每个窗口的 (商品列表, 需求清单)
+    :param quantum: 前台仲裁者的quantum
+    :param grace: 前台仲裁者的优先期
+    :return: 总耗时、总吞吐与每个窗口的统计
+    """
+    from src.modules.arbiter import ForegroundArbiter
+    from src.modules.base import Automize
+    from src.modules.opr import ImplementBuyCommodities
+    from src.modules.standin import Faults, StandInServer
+    from src.utils.cancel import CancelToken, cancel_scope
+
+    desktop = SimDesktop()
+    simulators = [ShopSimulator(items, shelf=shelf, font_path=font_path, font_size=font_size, desktop=desktop,
+                                tint=index * 8)
+                  for index, (items, _) in enumerate(scenarios)]
+    standin = StandInServer({'ocr': Faults(latency=ocr_latency)}, ocr_words=desktop.lookup_capture).start()
+    arbiter = ForegroundArbiter(quantum, grace)
+    token = CancelToken()
+
+    def run(index):
+        items, inventory = scenarios[index]
+        expected = expected_purchases(items, inventory, shelf)
+        inv_file = 'sim/inventory_sim_%d.xlsx' % (index + 1)
+        write_inventory(inv_file, inventory)
+        auto = Automize('洞天百宝模拟器%d' % (index + 1), input_sink=simulators[index], screen=simulators[index],
+                        arbiter=arbiter)
+        if action_delay is not None:
+            auto.ACTION_DELAY = action_delay
+        window_progress = progress and (lambda message, **kwargs: progress(
+            message=f'[窗口{index + 1}] {message}', **kwargs))
+        start = time.perf_counter()
+        with cancel_scope(token):
+            auto.click(1300, 650)
+            auto.click(200, 250 if shelf == 'stuff' else 340)
+            buyer = ImplementBuyCommodities(SimpleNamespace(auto=auto, ocr=ocr), inv_file, token, window_progress)
+            symbol, message = buyer.main(shelf)
+        elapsed = time.perf_counter() - start
+        mismatches = _mismatches(items, expected)
+        items_bought = sum(1 for item in items if item.bought)
+        return {
+            'ok': symbol and not mismatches,
+            'message': message,
+            'elapsed': round(elapsed, 3),
+            'items_bought': items_bought,
+            'pages': buyer.scanned_pages,
+            'mismatches': mismatches,
+            'simulator': dict(simulators[index].stats),
+        }
+
+    try:
+        ocr = _standin_ocr(standin)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(scenarios), thread_name_prefix='sim_window') as executor:
+            windows = list(executor.map(run, range(len(scenarios))))
+        elapsed = time.perf_counter() - start
+    finally:
+        standin.close()
+
+    items_bought = sum(window['items_bought'] for window in windows)
+    return {
+        'ok': all(window['ok'] for window in windows) and not desktop.stats['misdirected_inputs'],
+        'clients': len(scenarios),
+        'elapsed': round(elapsed, 3),
+        'items_bought': items_bought,
+        'items_per_minute': round(items_bought / elapsed * 60, 2) if elapsed else 0,
+        'arbiter': dict(arbiter.stats, wait_seconds=round(arbiter.stats['wait_seconds'], 3)),
+        'desktop': dict(desktop.stats),
+        'ocr_requests': {service: standin.stats[service] for service in ('token', 'ocr')},
+        'windows': windows,
+    }
+
+
+def _standin_ocr(standin):
+    from src.modules.ocr import BaiduOCR
+
+    keys_filepath = 'cache/sim/private.yml'
+    save_config(keys_filepath, {'baidu_ocr': {'api_key': 'sim', 'secret_key': 'sim'}})
+    return BaiduOCR('baidu_ocr', base_url=standin.url, keys_filepath=keys_filepath)
+
+
+def _mismatches(items: list[ShopItem], expected: dict[str, int]) -> dict:
+    bought = {item.name: item.bought for item in items if item.bought}
+    return {name: {'expected': expected.get(name, 0), 'bought': bought.get(name, 0)}
+            for name in set(expected) | set(bought) if expected.get(name, 0) != bought.get(name, 0)}
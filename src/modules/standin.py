@@ -0,0 +1,345 @@
+"""
+Author: iota
+Create: 2024.3.25 20:26
+Project: YuanShenTool
+Path: src/modules/standin.py
+IDE: PyCharm
+Description: 米游社摹本接口、物品图标、百度OCR令牌与识别接口的本地替身服务，可以注入延迟、错误和QPS限制，并提供压测
+"""
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from PIL import Image
+
+from src.utils.cyber import UA, TokenBucket
+from src.utils.support import logger
+from src.utils.trace import percentile
+
+BLUEPRINT_PATH = '/event/e20200928calculate/v1/furniture/blueprint'
+TOKEN_PATH = '/oauth/2.0/token'
+OCR_PATH_PREFIX = '/rest/2.0/ocr/v1/'
+ICON_PATH_PREFIX = '/icons/'
+SERVICES = 'blueprint', 'icon', 'token', 'ocr'
+
+
+@dataclass
+class Faults:
+    """注入到一个接口的故障
+
+    error_rate比例的请求返回该接口的典型错误：摹本接口retcode=-100，识别接口缺少words_result，
+    令牌接口invalid_client，图标返回HTTP 500；超过qps的请求按接口的限流方式拒绝
+    """
+    latency: float = 0.0  # 固定延迟秒数
+    jitter: float = 0.0  # 额外的随机延迟上限
+    error_rate: float = 0.0
+    qps: float = 0  # 为0时不限流
+
+
+class StandInServer:
+    """在一个本地端口上提供所有替身接口，各客户端的base_url都指向url即可"""
+
+    ACCESS_TOKEN = 'standin-access-token'
+
+    def __init__(self, faults: dict[str, Faults] = None, ocr_words=None, items_per_blueprint=50,
+                 host='127.0.0.1', port=0, seed=None):
+        """
+        :param faults: {接口: Faults}，接口为SERVICES之一
+        :param ocr_words: 识别接口的文字来源，以PIL图片调用，返回 [(文字, (x1, y1, x2, y2))]，返回None表示无法识别
+        :param items_per_blueprint: 每个摹本的物品数量
+        :param seed: 注入故障的随机种子
+        """
+        self.faults = {service: Faults() for service in SERVICES}
+        self.faults.update(faults or {})
+        self.ocr_words = ocr_words or (lambda image: [('测试文字', (0, 0, image.width, image.height))])
+        self.items_per_blueprint = items_per_blueprint
+        self.stats = {service: {'requests': 0, 'injected_errors': 0, 'throttled': 0} for service in SERVICES}
+        self.stats['ocr']['unmatched'] = 0
+
+        self.__random = random.Random(seed)
+        self.__limiters = {service: TokenBucket(f.qps) for service, f in self.faults.items() if f.qps}
+        self.__lock = threading.Lock()
+        self.__server = ThreadingHTTPServer((host, port), self.__handler_class())
+        self.__server.daemon_threads = True
+        self.url = 'http://%s:%d' % self.__server.server_address[:2]
+
+    def start(self):
+        threading.Thread(target=self.__server.serve_forever, name='standin_server', daemon=True).start()
+        return self
+
+    def close(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __admit(self, service) -> str | None:
+        """按注入的故障处理一次请求：等待延迟后返回 'throttled'、'error' 或 None"""
+        faults = self.faults[service]
+        with self.__lock:
+            self.stats[service]['requests'] += 1
+            delay = faults.latency + (self.__random.uniform(0, faults.jitter) if faults.jitter else 0)
+            failed = faults.error_rate and self.__random.random() < faults.error_rate
+        if delay:
+            time.sleep(delay)
+        limiter = self.__limiters.get(service)
+        if limiter and not limiter.try_acquire():
+            with self.__lock:
+                self.stats[service]['throttled'] += 1
+            return 'throttled'
+        if failed:
+            with self.__lock:
+                self.stats[service]['injected_errors'] += 1
+            return 'error'
+        return None
+
+    # ---- 各接口，返回 (状态码, 响应头, 响应体) ----
+
+    def blueprint_items(self, share_code) -> list[dict]:
+        """由分享码确定的物品列表，同一分享码每次相同"""
+        rng = random.Random(share_code)
+        items = []
+        for _ in range(self.items_per_blueprint):
+            item_id = rng.randint(360000, 379999)
+            items.append({
+                'id': item_id,
+                'name': '摆设%d' % item_id,
+                'level': rng.randint(1, 5),
+                'num': rng.randint(1, 20),
+                'icon_url': '%s%s%d.png' % (self.url, ICON_PATH_PREFIX, item_id),
+                'wiki_url': 'https://baike.mihoyo.com/ys/obc/content/%d/detail' % item_id,
+            })
+        return items
+
+    def handle_blueprint(self, query, headers):
+        outcome = self.__admit('blueprint')
+        if outcome == 'throttled':
+            return 429, {}, b''
+        if outcome == 'error':
+            return 200, {}, _json({'retcode': -100, 'message': '登录失效，请重新登录', 'data': None})
+
+        share_code = query.get('share_code', [''])[0]
+        body = _json({'retcode': 0, 'message': 'OK',
+                      'data': {'list': self.blueprint_items(share_code), 'not_calc_list': []}})
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if headers.get('If-None-Match') == etag:
+            return 304, {'ETag': etag}, b''
+        return 200, {'ETag': etag}, body
+
+    def handle_icon(self, path):
+        outcome = self.__admit('icon')
+        if outcome == 'throttled':
+            return 429, {}, b''
+        if outcome == 'error':
+            return 500, {}, b''
+        item_id = int(path[len(ICON_PATH_PREFIX):].split('.')[0] or 0)
+        buffer = io.BytesIO()
+        Image.new('RGBA', (256, 256), (item_id % 256, item_id // 256 % 256, 128, 255)).save(buffer, format='PNG')
+        return 200, {'Content-Type': 'image/png'}, buffer.getvalue()
+
+    def handle_token(self):
+        outcome = self.__admit('token')
+        if outcome == 'throttled':
+            return 429, {}, b''
+        if outcome == 'error':
+            return 401, {}, _json({'error': 'invalid_client', 'error_description': 'unknown client id'})
+        return 200, {}, _json({'access_token': self.ACCESS_TOKEN, 'expires_in': 2592000})
+
+    def handle_ocr(self, query, body):
+        outcome = self.__admit('ocr')
+        if outcome == 'throttled':
+            return 200, {}, _json({'error_code': 18, 'error_msg': 'Open api qps request limit reached'})
+        if query.get('access_token', [None])[0] != self.ACCESS_TOKEN:
+            return 200, {}, _json({'error_code': 110, 'error_msg': 'Access token invalid or no longer valid'})
+        if outcome == 'error':
+            # 与偶尔出现的异常响应一致：只有log_id，没有words_result
+            return 200, {}, _json({'log_id': time.time_ns()})
+
+        form = parse_qs(body.decode())
+        locate = form.get('vertexes_location', ['false'])[0] == 'true'
+        image = Image.open(io.BytesIO(base64.b64decode(form['image'][0])))
+        words = self.ocr_words(image)
+        if words is None:
+            with self.__lock:
+                self.stats['ocr']['unmatched'] += 1
+            words = []
+
+        words_result = []
+        for text, (x1, y1, x2, y2) in words:
+            item = {'words': text}
+            if locate:
+                item['vertexes_location'] = [{'x': x1, 'y': y1}, {'x': x2, 'y': y1},
+                                             {'x': x2, 'y': y2}, {'x': x1, 'y': y2}]
+                item['probability'] = {'average': 0.99, 'min': 0.98, 'variance': 0}
+            words_result.append(item)
+        return 200, {}, _json({'log_id': time.time_ns(), 'words_result_num': len(words_result),
+                               'words_result': words_result})
+
+    def __handler_class(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                if parsed.path == BLUEPRINT_PATH:
+                    self.__reply(*standin.handle_blueprint(parse_qs(parsed.query), self.headers))
+                elif parsed.path.startswith(ICON_PATH_PREFIX):
+                    self.__reply(*standin.handle_icon(parsed.path))
+                else:
+                    self.__reply(404, {}, b'')
+
+            def do_POST(self):
+                parsed = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if parsed.path == TOKEN_PATH:
+                    self.__reply(*standin.handle_token())
+                elif parsed.path.startswith(OCR_PATH_PREFIX):
+                    self.__reply(*standin.handle_ocr(parse_qs(parsed.query), body))
+                else:
+                    self.__reply(200, {}, _json({'error_code': 3, 'error_msg': 'Open api not support'}))
+
+            def __reply(self, status, headers, body):
+                self.send_response(status)
+                headers.setdefault('Content-Type', 'application/json')
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug('替身服务：' + format, *args)
+
+        return Handler
+
+
+def _json(data) -> bytes:
+    return json.dumps(data, ensure_ascii=False).encode()
+
+
+# ---- 压测 ----
+
+def _blueprint_client(server, workdir):
+    from src.modules.inv import BlueprintCache, Web
+
+    web = Web(base_url=server.url)
+    web.cookie = 'standin=' + 'x' * 60
+    # 有效期为0，每次都带条件请求头重新验证
+    web.cache = BlueprintCache(ttl=0, cache_dir=os.path.join(workdir, 'blueprints/'))
+
+    def call(i):
+        result = web.get_inventory('SC%04d' % (i % 20))
+        if result['retcode'] != 0:
+            raise Warning(f'retcode={result["retcode"]}')
+    return call
+
+
+def _icon_client(server, workdir):
+    from src.modules.inv import IconStore
+
+    # 与FetchInv下载图标的方式相同：请求原图后写入缩略图存储
+    icons = IconStore(pack_path=os.path.join(workdir, 'icons.pack'), legacy_dir=os.path.join(workdir, 'none/'))
+    items = server.blueprint_items('load_test')
+    session = requests.Session()
+
+    def call(i):
+        response = session.get(items[i % len(items)]['icon_url'], headers={'User-Agent': UA})
+        response.raise_for_status()
+        icons.put(i, response.content)
+    return call
+
+
+def _ocr_client(server, workdir):
+    from src.modules.ocr import BaiduOCR
+    from src.utils.common import save_config
+
+    keys_filepath = os.path.join(workdir, 'private.yml')
+    save_config(keys_filepath, {'baidu_ocr': {'api_key': 'standin', 'secret_key': 'standin'}})
+    ocr = BaiduOCR('baidu_ocr', base_url=server.url, keys_filepath=keys_filepath)
+    buffer = io.BytesIO()
+    Image.new('RGB', (460, 850), (236, 229, 216)).save(buffer, format='PNG')
+    image_bytes = buffer.getvalue()
+
+    def call(i):
+        ocr.scan_image(image_bytes, ret_detail=True, compression_ratio=0.5)
+    return call
+
+
+LOAD_TARGETS = {
+    'blueprint': _blueprint_client,
+    'icon': _icon_client,
+    'ocr': _ocr_client,
+}
+
+
+def run_load_test(target, total=100, concurrency=4, faults: dict[str, Faults] = None,
+                  workdir='cache/loadtest/', progress=None) -> dict:
+    """启动替身服务，用真实的客户端并发发起请求，统计吞吐与延迟
+
+    :param target: 压测的客户端，见LOAD_TARGETS
+    :param total: 调用次数
+    :param concurrency: 并发数
+    :param faults: 注入的故障
+    :param workdir: 客户端缓存使用的目录，与正式缓存分开
+    :param progress: 进度回调，以关键字参数 done/total/message 调用
+    :return: 统计结果，时间单位毫秒
+    """
+    os.makedirs(workdir, exist_ok=True)
+    latencies, errors = [], {}
+    lock = threading.Lock()
+
+    with StandInServer(faults) as server:
+        call = LOAD_TARGETS[target](server, workdir)
+
+        def timed(i):
+            start = time.perf_counter()
+            try:
+                call(i)
+                error = None
+            except Exception as exc:
+                error = type(exc).__name__
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if error:
+                    errors[error] = errors.get(error, 0) + 1
+                done = len(latencies)
+            if progress and (done % max(1, total // 20) == 0 or done == total):
+                progress(done=done, total=total, message=f'{target} 压测中')
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='load_test') as executor:
+            list(executor.map(timed, range(total)))
+        elapsed = time.perf_counter() - start
+        server_stats = {service: stats for service, stats in server.stats.items() if stats['requests']}
+
+    latencies.sort()
+    return {
+        'target': target,
+        'calls': total,
+        'concurrency': concurrency,
+        'errors': errors,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(total / elapsed, 2) if elapsed else 0,
+        'p50': round(percentile(latencies, 50) * 1e3, 2),
+        'p95': round(percentile(latencies, 95) * 1e3, 2),
+        'p99': round(percentile(latencies, 99) * 1e3, 2),
+        'max': round(latencies[-1] * 1e3, 2) if latencies else 0,
+        'server': server_stats,
+    }
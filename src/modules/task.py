@@ -0,0 +1,121 @@
+"""
+Author: iota
+Create: 2024.3.9 15:26
+Project: YuanShenTool
+Path: src/modules/task.py
+IDE: PyCharm
+Description: 在后台线程中执行界面触发的耗时操作，通过队列把进度传回界面线程
+"""
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from src.utils.support import logger
+
+
+class Task:
+    """一次后台操作，由工作线程调用report()汇报进度"""
+
+    def __init__(self, kind, events: queue.SimpleQueue):
+        self.kind = kind
+        self.start_time = time.monotonic()
+        self.progress = {}
+        self.__events = events
+
+    def report(self, **fields):
+        """汇报进度，可以是任意字段；同时带有done和total时会计算预计剩余时间
+
+        :param fields: 如 done=3, total=10, message='已购买：xxx'
+        """
+        done, total = fields.get('done'), fields.get('total')
+        if done and total:
+            elapsed = time.monotonic() - self.start_time
+            fields['eta'] = elapsed / done * (total - done)
+        self.__events.put(('progress', self, fields))
+
+    def describe(self) -> str:
+        fields = self.progress
+        text = fields.get('message', '运行中')
+        if fields.get('total'):
+            text += ' (%s/%s)' % (fields.get('done', 0), fields['total'])
+        if fields.get('eta') is not None:
+            text += ' 剩余约%d秒' % fields['eta']
+        return text
+
+
+class TaskExecutor:
+    """后台任务执行器
+
+    同一种操作同时只运行一个任务；进度和结果在界面线程中通过root.after轮询队列取出后回调
+    """
+
+    def __init__(self, root, max_workers=4, poll_interval=100):
+        """
+        :param root: tkinter根窗口
+        :param max_workers: 工作线程数量
+        :param poll_interval: 轮询队列的间隔毫秒数
+        """
+        self.root = root
+        self.poll_interval = poll_interval
+        self.__pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='task')
+        self.__events = queue.SimpleQueue()
+        self.__running = {}
+        self.__callbacks = {}
+        self.__lock = threading.Lock()
+        self.root.after(self.poll_interval, self.__poll)
+
+    def is_running(self, kind) -> bool:
+        return kind in self.__running
+
+    def submit(self, kind, func, *args, on_progress=None, on_done=None, **kwargs) -> Task | None:
+        """提交任务
+
+        :param kind: 操作类型
+        :param func: 在工作线程中执行的函数，会以关键字参数progress传入Task.report
+        :param on_progress: 界面线程中的进度回调，参数为 (task)
+        :param on_done: 界面线程中的结束回调，参数为 (task, 函数返回值)；出错时返回值为 (False, 错误信息)
+        :return: 任务对象，同类任务正在运行时返回None
+        """
+        with self.__lock:
+            if kind in self.__running:
+                return None
+            task = self.__running[kind] = Task(kind, self.__events)
+        self.__callbacks[task] = on_progress, on_done
+        logger.info(f'开始任务：{kind}')
+        self.__pool.submit(self.__run, task, func, args, kwargs)
+        return task
+
+    def __run(self, task, func, args, kwargs):
+        try:
+            result = func(*args, progress=task.report, **kwargs)
+        except Exception as exc:
+            logger.error(f'任务[{task.kind}]出错：{traceback.format_exc()}')
+            result = False, f'发生错误：{exc}'
+        self.__events.put(('done', task, result))
+
+    def __poll(self):
+        try:
+            while True:
+                event, task, data = self.__events.get_nowait()
+                on_progress, on_done = self.__callbacks.get(task, (None, None))
+                if event == 'progress':
+                    task.progress.update(data)
+                    if on_progress:
+                        on_progress(task)
+                else:
+                    with self.__lock:
+                        self.__running.pop(task.kind, None)
+                    self.__callbacks.pop(task, None)
+                    logger.info(f'任务结束：{task.kind} {time.monotonic() - task.start_time:.1f}s')
+                    if on_done:
+                        on_done(task, data)
+        except queue.Empty:
+            pass
+        except Exception:
+            logger.error(f'处理任务事件出错：{traceback.format_exc()}')
+        self.root.after(self.poll_interval, self.__poll)
+
+    def shutdown(self):
+        self.__pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,199 @@
+"""
+Author: iota
+Create: 2024.3.18 20:52
+Project: YuanShenTool
+Path: src/modules/window.py
+IDE: PyCharm
+Description: 缓存目标窗口的状态，由窗口事件和定时轮询更新，避免每次动作都调用Win32接口
+"""
+import ctypes
+import ctypes.wintypes
+import threading
+import time
+
+from src.utils.support import logger
+
+# 代码中的 x/y 坐标数值基于该分辨率下的客户区
+BASE_SIZE = 1920, 1080
+
+EVENT_SYSTEM_FOREGROUND = 0x0003
+EVENT_SYSTEM_MINIMIZEEND = 0x0017
+EVENT_OBJECT_LOCATIONCHANGE = 0x800B
+WINEVENT_OUTOFCONTEXT = 0x0000
+OBJID_WINDOW = 0
+QS_ALLINPUT = 0x04FF
+PM_REMOVE = 0x0001
+WAIT_TIMEOUT = 0x0102
+
+
+def find_windows(window_title, window_classname=None) -> list[int]:
+    """所有标题与类名都匹配的可见窗口句柄，多开时每个游戏窗口一个"""
+    import win32gui
+
+    handles = []
+
+    def collect(hwnd, _):
+        if (win32gui.IsWindowVisible(hwnd) and win32gui.GetWindowText(hwnd) == window_title
+                and (window_classname is None or win32gui.GetClassName(hwnd) == window_classname)):
+            handles.append(hwnd)
+        return True
+
+    win32gui.EnumWindows(collect, None)
+    return handles
+
+
+class WindowState:
+    """固定位置、始终在前台的窗口，模拟器等替身直接使用，也是WindowWatcher的基类"""
+
+    def __init__(self, client_rect=(0, 0) + BASE_SIZE, handle=1):
+        """
+        :param client_rect: 客户区在屏幕上的位置 (left, top, width, height)
+        :param handle: 窗口句柄，非0表示窗口存在
+        """
+        self.handle = handle
+        self.client_rect = client_rect
+        self.is_foreground = True
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def refresh(self):
+        pass
+
+    def _fallback_rect(self):
+        return (0, 0) + BASE_SIZE
+
+    def to_screen(self, x, y) -> tuple[float, float]:
+        """将基于1920x1080客户区的坐标换算为屏幕坐标，未找到窗口时按全屏换算"""
+        left, top, width, height = self.client_rect or self._fallback_rect()
+        return left + x * width / BASE_SIZE[0], top + y * height / BASE_SIZE[1]
+
+    def rect_to_screen(self, x1, y1, x2, y2) -> tuple[int, int, int, int]:
+        sx1, sy1 = self.to_screen(x1, y1)
+        sx2, sy2 = self.to_screen(x2, y2)
+        return round(sx1), round(sy1), round(sx2), round(sy2)
+
+
+class WindowWatcher(WindowState):
+    """目标窗口的句柄、客户区位置与前台状态
+
+    优先监听系统的窗口事件，同时按poll_interval轮询作为兜底；读取属性不会调用任何Win32接口
+    """
+
+    def __init__(self, window_title, window_classname=None, poll_interval=0.5, handle=None):
+        """
+        :param window_title: 匹配窗口标题
+        :param window_classname: 匹配窗口类名
+        :param poll_interval: 轮询间隔秒数
+        :param handle: 绑定到指定的窗口，多开时使用；窗口关闭后不会再去查找同名的其他窗口
+        """
+        import win32gui
+
+        super().__init__(client_rect=None, handle=handle or 0)
+        self.__win32gui = win32gui
+        self.__bound = handle is not None
+        self.window_title = window_title
+        self.window_classname = window_classname
+        self.poll_interval = poll_interval
+        self.is_foreground = False
+
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__thread = None
+        self.refresh()
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name='window_watcher', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+
+    def refresh(self):
+        """重新查询窗口状态"""
+        win32gui = self.__win32gui
+        with self.__lock:
+            if not (self.handle and win32gui.IsWindow(self.handle)):
+                self.handle = 0 if self.__bound else win32gui.FindWindow(self.window_classname, self.window_title)
+                logger.info(f'句柄={self.handle}')
+            self.__refresh_rect()
+            self.is_foreground = bool(self.handle) and self.handle == win32gui.GetForegroundWindow()
+
+    def __refresh_rect(self):
+        if not self.handle:
+            self.client_rect = None
+            return
+        win32gui = self.__win32gui
+        try:
+            _, _, width, height = win32gui.GetClientRect(self.handle)
+            left, top = win32gui.ClientToScreen(self.handle, (0, 0))
+        except win32gui.error:
+            self.client_rect = None
+            return
+        # 最小化时客户区大小为0，保留之前的位置
+        if width and height and (left, top, width, height) != self.client_rect:
+            self.client_rect = left, top, width, height
+            logger.info('窗口客户区：(%d, %d) %dx%d' % self.client_rect)
+
+    def _fallback_rect(self):
+        user32 = ctypes.windll.user32
+        return 0, 0, user32.GetSystemMetrics(0), user32.GetSystemMetrics(1)
+
+    def __on_event(self, hook, event, hwnd, id_object, id_child, thread_id, timestamp):
+        if event == EVENT_SYSTEM_FOREGROUND:
+            self.is_foreground = bool(self.handle) and hwnd == self.handle
+        elif hwnd == self.handle and id_object == OBJID_WINDOW:
+            with self.__lock:
+                self.__refresh_rect()
+
+    def __process_id(self) -> int:
+        if not self.handle:
+            return 0
+        pid = ctypes.wintypes.DWORD()
+        ctypes.windll.user32.GetWindowThreadProcessId(self.handle, ctypes.byref(pid))
+        return pid.value
+
+    def __run(self):
+        user32 = ctypes.windll.user32
+        win_event_proc = ctypes.WINFUNCTYPE(None, ctypes.wintypes.HANDLE, ctypes.wintypes.DWORD,
+                                            ctypes.wintypes.HWND, ctypes.wintypes.LONG, ctypes.wintypes.LONG,
+                                            ctypes.wintypes.DWORD, ctypes.wintypes.DWORD)
+        # 回调需要保持引用，否则会被回收
+        callback = win_event_proc(self.__on_event)
+        hooks = [user32.SetWinEventHook(event, event, 0, callback, 0, 0, WINEVENT_OUTOFCONTEXT)
+                 for event in (EVENT_SYSTEM_FOREGROUND, EVENT_SYSTEM_MINIMIZEEND)]
+        if not all(hooks):
+            logger.warning('监听窗口事件失败，只使用轮询')
+        location_hook, hooked_pid = None, 0
+
+        msg = ctypes.wintypes.MSG()
+        next_poll = 0.0
+        try:
+            while not self.__stopped.is_set():
+                # 不论等待的结果如何，到时间就轮询一次，频繁的窗口事件不会让轮询停下
+                if time.monotonic() >= next_poll:
+                    self.refresh()
+                    next_poll = time.monotonic() + self.poll_interval
+                    # 位置变化事件只监听游戏进程，全局监听时光标与输入光标的移动都会触发；游戏重启后重新监听
+                    if (pid := self.__process_id()) != hooked_pid:
+                        if location_hook:
+                            user32.UnhookWinEvent(location_hook)
+                        location_hook = pid and user32.SetWinEventHook(
+                            EVENT_OBJECT_LOCATIONCHANGE, EVENT_OBJECT_LOCATIONCHANGE, 0, callback, pid, 0,
+                            WINEVENT_OUTOFCONTEXT)
+                        hooked_pid = pid
+
+                timeout = max(0, int((next_poll - time.monotonic()) * 1000))
+                if user32.MsgWaitForMultipleObjects(0, None, False, timeout, QS_ALLINPUT) == WAIT_TIMEOUT:
+                    continue
+                while user32.PeekMessageW(ctypes.byref(msg), None, 0, 0, PM_REMOVE):
+                    user32.TranslateMessage(ctypes.byref(msg))
+                    user32.DispatchMessageW(ctypes.byref(msg))
+        finally:
+            for hook in hooks + [location_hook]:
+                if hook:
+                    user32.UnhookWinEvent(hook)
@@ -0,0 +1,151 @@
+"""
+Author: iota
+Create: 2024.3.11 21:48
+Project: YuanShenTool
+Path: src/utils/cancel.py
+IDE: PyCharm
+Description: 统一的取消令牌，等待和阻塞调用都可以被及时打断
+"""
+import contextlib
+import contextvars
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import requests
+
+# 等待阻塞调用结束时检查取消状态的间隔秒数
+POLL_INTERVAL = 0.02
+# 执行阻塞调用的线程数上限
+BLOCKING_WORKERS = 8
+# HTTP请求的默认超时秒数 (连接, 读取)，取消后仍在进行的请求最迟在超时后结束
+HTTP_TIMEOUT = 5, 30
+
+
+class OperationCancelled(Exception):
+    """操作已被取消"""
+
+
+class CancelToken:
+    """取消令牌
+
+    令牌可以派生子令牌，父令牌取消时所有子令牌一起取消，子令牌取消不影响父令牌
+    """
+
+    __blocking_pool = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix='cancellable')
+
+    def __init__(self, parent=None):
+        self.__event = threading.Event()
+        self.__children = weakref.WeakSet()
+        self.__callbacks = []
+        self.__lock = threading.Lock()
+        if parent is not None:
+            parent.__adopt(self)
+
+    def __adopt(self, child):
+        with self.__lock:
+            self.__children.add(child)
+        if self.cancelled:
+            child.cancel()
+
+    def child(self) -> 'CancelToken':
+        return CancelToken(parent=self)
+
+    def cancel(self):
+        self.__event.set()
+        with self.__lock:
+            children = list(self.__children)
+            callbacks, self.__callbacks = self.__callbacks, []
+        for callback in callbacks:
+            callback()
+        for child in children:
+            child.cancel()
+
+    def on_cancel(self, callback):
+        """取消时调用callback，已取消时立即调用
+
+        :return: 取消注册的函数
+        """
+        with self.__lock:
+            if not self.__event.is_set():
+                self.__callbacks.append(callback)
+
+                def remove():
+                    with self.__lock:
+                        if callback in self.__callbacks:
+                            self.__callbacks.remove(callback)
+                return remove
+        callback()
+        return lambda: None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.__event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.__event.is_set():
+            raise OperationCancelled()
+
+    def wait(self, timeout) -> bool:
+        """等待一段时间，被取消时立即返回
+
+        :return: 是否已被取消
+        """
+        return self.__event.wait(timeout)
+
+    def sleep(self, seconds):
+        """可被打断的time.sleep，被取消时抛出OperationCancelled"""
+        if self.__event.wait(seconds):
+            raise OperationCancelled()
+
+    def run(self, func, *args, **kwargs):
+        """在后台线程执行阻塞调用（如HTTP请求），当前线程等待结果的同时检查取消状态
+
+        被取消时立即抛出OperationCancelled，后台调用的结果将被丢弃；后台调用在当前线程的上下文中执行，
+        耗时记录到当前的运行
+        """
+        self.raise_if_cancelled()
+        future = self.__blocking_pool.submit(contextvars.copy_context().run, func, *args, **kwargs)
+        while True:
+            try:
+                return future.result(timeout=POLL_INTERVAL)
+            except FutureTimeoutError:
+                if self.cancelled:
+                    # 还在排队的调用不再执行
+                    future.cancel()
+                    raise OperationCancelled()
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        """可取消的HTTP请求
+
+        每次请求使用独立的会话，取消时关闭会话释放连接；没有指定timeout时使用HTTP_TIMEOUT，
+        已经发出的请求最迟在超时后结束，不会一直占用执行阻塞调用的线程
+        """
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        session = requests.Session()
+        remove = self.on_cancel(session.close)
+        try:
+            return self.run(session.request, method, url, **kwargs)
+        finally:
+            remove()
+            session.close()
+
+
+__local = threading.local()
+__never_cancelled = CancelToken()
+
+
+def current_token() -> CancelToken:
+    """当前线程正在使用的取消令牌，不在cancel_scope中时返回一个永不取消的令牌"""
+    return getattr(__local, 'token', __never_cancelled)
+
+
+@contextlib.contextmanager
+def cancel_scope(token: CancelToken):
+    """在当前线程中使用指定的取消令牌，Automize的等待与OCR的请求都会响应它"""
+    previous = getattr(__local, 'token', None)
+    __local.token = token
+    try:
+        yield token
+    finally:
+        __local.token = previous if previous is not None else __never_cancelled
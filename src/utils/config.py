@@ -0,0 +1,262 @@
+"""
+Author: iota
+Create: 2024.3.29 20:18
+Project: YuanShenTool
+Path: src/utils/config.py
+IDE: PyCharm
+Description: 配置服务：按类型校验公共配置，文件修改后原地重新加载并通知使用方；私有配置按修改时间缓存
+"""
+import os
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import yaml
+
+from src.utils.common import read_config, save_config
+
+
+class ConfigError(ValueError):
+    """配置文件无法解析或取值不合法"""
+
+
+@dataclass
+class Field:
+    """配置项的类型与取值范围
+
+    schema为dict类型配置项中各键的校验，items为其中每个值的校验，用于键名不固定的配置项
+    """
+    type: type
+    default: Any = None
+    check: Callable[[Any], bool] | None = None
+    hint: str = ''
+    schema: dict[str, 'Field'] | None = None
+    items: 'Field | None' = None
+
+
+LOG_LEVELS = 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'
+
+# 以下为运行中修改后由订阅方读取的嵌套配置项
+BAIDU_OCR_SCHEMA = {
+    'max_retries': Field(int, 3, lambda v: 0 <= v <= 10, '0到10'),
+    'qps': Field(dict, items=Field(float, check=lambda v: v > 0, hint='大于0')),
+    'locate_apis': Field(list),
+    'basic_apis': Field(list),
+    'base_url': Field(str),
+}
+
+CLOUD_OCR_PREPROCESS_SCHEMA = {
+    'grayscale': Field(bool, False),
+    'scale': Field(bool, False),
+    'binarize': Field(bool, False),
+    'binarize_threshold': Field(int, 128, lambda v: 0 <= v <= 255, '0到255'),
+    'encoder': Field(str, 'png', lambda v: v in ('png', 'jpeg'), 'png/jpeg'),
+    'png_level': Field(int, 1, lambda v: 0 <= v <= 9, '0到9'),
+    'jpeg_quality': Field(int, 85, lambda v: 1 <= v <= 95, '1到95'),
+}
+
+PROFILE_SCHEMA = {
+    'enabled': Field(bool, False),
+    'operations': Field(list),
+    'mode': Field(str, 'sample', lambda v: v in ('sample', 'cprofile'), 'sample/cprofile'),
+    'interval': Field(float, 0.005, lambda v: 0 < v <= 1, '大于0且不超过1秒'),
+    'top': Field(int, 20, lambda v: v >= 1, '至少为1'),
+    'hotkey': Field(str),
+}
+
+# 需要校验类型与取值的公共配置项，其余配置项按原样保留
+PUBLIC_SCHEMA = {
+    'action_delay': Field(float, 0.3, lambda v: 0 < v <= 5, '大于0且不超过5秒'),
+    'burst_interval': Field(float, 0.08, lambda v: 0 <= v <= 1, '0到1秒'),
+    'window_poll_interval': Field(float, 0.5, lambda v: v > 0, '大于0'),
+    'foreground_quantum': Field(int, 8, lambda v: v >= 1, '至少为1'),
+    'foreground_grace': Field(float, 0.0, lambda v: v >= 0, '不小于0'),
+    'fetch_max_workers': Field(int, 4, lambda v: 1 <= v <= 32, '1到32'),
+    'ocr_platform': Field(str, None, lambda v: v in ('local_ocr', 'baidu_ocr', 'auto'), 'local_ocr/baidu_ocr/auto'),
+    'debug_mode': Field(bool, False),
+    'log_level': Field(str, 'INFO', lambda v: v in LOG_LEVELS, '/'.join(LOG_LEVELS)),
+    'log_format': Field(str),
+    'config_reload_interval': Field(float, 1.0, lambda v: v >= 0, '不小于0，为0时不自动重新加载'),
+    'baidu_ocr': Field(dict, schema=BAIDU_OCR_SCHEMA),
+    'cloud_ocr_preprocess': Field(dict, schema=CLOUD_OCR_PREPROCESS_SCHEMA),
+    'profile': Field(dict, schema=PROFILE_SCHEMA),
+}
+
+
+def _stamp(filepath):
+    """文件的修改时间与大小，同一秒内的多次修改也能区分"""
+    stat = os.stat(filepath)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def validate(data, schema: dict[str, Field]) -> dict:
+    """按schema检查并转换取值，缺少的配置项使用默认值
+
+    :return: 转换后的副本
+    :raise ConfigError: 列出所有不合法的配置项
+    """
+    if not isinstance(data, dict):
+        raise ConfigError('配置文件的顶层应为键值对')
+    problems = []
+    result = _validate_mapping(data, schema, '', problems)
+    if problems:
+        raise ConfigError('；'.join(problems))
+    return result
+
+
+def _validate_mapping(data: dict, schema: dict[str, Field], prefix, problems: list) -> dict:
+    result = dict(data)
+    for key, field in schema.items():
+        if key not in result or result[key] is None:
+            if field.default is not None:
+                result[key] = field.default
+            continue
+        result[key] = _validate_value(result[key], field, prefix + key, problems)
+    return result
+
+
+def _validate_value(value, field: Field, name, problems: list):
+    """不合法时记录到problems并返回原值"""
+    if field.type is float and isinstance(value, int) and not isinstance(value, bool):
+        value = float(value)
+    if not isinstance(value, field.type) or (field.type is not bool and isinstance(value, bool)):
+        problems.append(f'{name}应为{field.type.__name__}，实际为{value!r}')
+    elif field.check and not field.check(value):
+        problems.append(f'{name}={value!r}不合法，应为{field.hint}')
+    elif field.schema is not None:
+        value = _validate_mapping(value, field.schema, name + '.', problems)
+    elif field.items is not None:
+        value = {key: _validate_value(item, field.items, f'{name}.{key}', problems) for key, item in value.items()}
+    return value
+
+
+class LiveConfig(dict):
+    """公共配置，文件修改后原地更新，pub_config[...] 读到的总是最新值
+
+    保存了配置快照的对象（例如Automize的动作延迟）通过subscribe接收变化；
+    新的文件不合法时保留原来的配置
+    """
+
+    def __init__(self, filepath, schema: dict[str, Field] = None):
+        super().__init__()
+        self.filepath = filepath
+        self.schema = schema or {}
+        self.__mtime = None
+        self.__listeners = []
+        self.__lock = threading.Lock()
+        self.__watcher = None
+        self.reload()
+
+    def reload(self, force=False) -> dict:
+        """文件修改后重新加载
+
+        :param force: 不比较修改时间，直接重新加载
+        :return: 变化的配置项 {键: 新值}，被删除的键值为None
+        :raise ConfigError: 新的文件不合法
+        """
+        with self.__lock:
+            mtime = _stamp(self.filepath)
+            if not force and mtime == self.__mtime:
+                return {}
+            # 不合法的文件只报告一次，再次修改后重新检查
+            self.__mtime = mtime
+            try:
+                data = validate(read_config(self.filepath), self.schema)
+            except yaml.YAMLError as exc:
+                raise ConfigError(f'无法解析{self.filepath}：{exc}') from exc
+
+            changed = {key: value for key, value in data.items() if key not in self or self[key] != value}
+            for key in self.keys() - data.keys():
+                changed[key] = None
+                del self[key]
+            # 逐项更新，其他线程读取时不会遇到缺少的键
+            self.update(data)
+            callbacks = [ref() for ref in self.__listeners]
+            self.__listeners = [ref for ref, callback in zip(self.__listeners, callbacks) if callback is not None]
+
+        if changed:
+            for callback in callbacks:
+                if callback is not None:
+                    callback(changed)
+        return changed
+
+    def subscribe(self, callback: Callable[[dict], None]):
+        """配置变化时以 {键: 新值} 调用callback
+
+        绑定方法以弱引用保存，对象被回收后自动取消
+        """
+        ref = weakref.WeakMethod(callback) if hasattr(callback, '__self__') else (lambda: callback)
+        with self.__lock:
+            self.__listeners.append(ref)
+
+    def watch(self, interval, on_error=None, on_change=None):
+        """启动后台线程，每interval秒检查一次文件
+
+        :param on_error: 新的文件不合法时以ConfigError调用
+        :param on_change: 重新加载后以变化的配置项调用
+        """
+        if self.__watcher is not None or interval <= 0:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.get('config_reload_interval') or interval)
+                try:
+                    changed = self.reload()
+                except (ConfigError, OSError) as exc:
+                    if on_error:
+                        on_error(exc)
+                    continue
+                if changed and on_change:
+                    on_change(changed)
+
+        self.__watcher = threading.Thread(target=run, name='config_watcher', daemon=True)
+        self.__watcher.start()
+
+
+class PrivateConfig:
+    """私有配置（key与令牌），按文件修改时间缓存，文件未变化时不重新解析"""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.__data = {}
+        self.__mtime = None
+        self.__lock = threading.Lock()
+
+    def read(self) -> dict:
+        with self.__lock:
+            mtime = _stamp(self.filepath) if os.path.exists(self.filepath) else None
+            if mtime != self.__mtime:
+                data = read_config(self.filepath) if mtime is not None else None
+                self.__data = data if isinstance(data, dict) else {}
+                self.__mtime = mtime
+            return self.__data
+
+    def section(self, name) -> dict:
+        entry = self.read().get(name)
+        return dict(entry) if isinstance(entry, dict) else {}
+
+    def update_section(self, name, **fields):
+        """更新一节并写回文件"""
+        data = dict(self.read())
+        entry = data[name] = dict(data.get(name) or {})
+        entry.update(fields)
+        with self.__lock:
+            save_config(self.filepath, data)
+            self.__data = data
+            self.__mtime = _stamp(self.filepath)
+
+
+__private_configs: dict[str, PrivateConfig] = {}
+__private_lock = threading.Lock()
+
+
+def private_config(filepath) -> PrivateConfig:
+    """同一个文件共用一个缓存"""
+    key = os.path.abspath(filepath)
+    with __private_lock:
+        if key not in __private_configs:
+            __private_configs[key] = PrivateConfig(filepath)
+        return __private_configs[key]
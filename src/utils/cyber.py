@@ -7,8 +7,11 @@ IDE: PyCharm
 Description: 网络有关方法
 """
 import base64
+import random
 import re
 import socket
+import threading
+import time
 import urllib.parse
 
 UA = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 '
@@ -31,6 +34,66 @@ class DotDict(dict):
         self.__dict__ = self
 
 
+class TokenBucket:
+    """令牌桶限流器，线程安全"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: 每秒生成的令牌数，即允许的平均QPS
+        :param capacity: 桶容量，即允许的突发请求数，默认等于rate
+        """
+        self.rate = rate
+        self.capacity = max(1.0, rate if capacity is None else capacity)
+        self.__tokens = self.capacity
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self, tokens=1, sleep=time.sleep) -> float:
+        """取出令牌，令牌不足时阻塞等待
+
+        :param sleep: 等待使用的函数，可以传入能被打断的sleep
+        :return: 等待的秒数
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+            self.__updated = now
+            self.__tokens -= tokens
+            # 令牌数可以为负，表示已被预约，后来的调用方依次排队
+            wait = -self.__tokens / self.rate if self.__tokens < 0 else 0
+        if wait:
+            sleep(wait)
+        return wait
+
+    def set_rate(self, rate: float, capacity: float = None):
+        """修改生成速率与桶容量，已有的令牌不超过新的容量"""
+        with self.__lock:
+            self.rate = rate
+            self.capacity = max(1.0, rate if capacity is None else capacity)
+            self.__tokens = min(self.__tokens, self.capacity)
+
+    def try_acquire(self, tokens=1) -> bool:
+        """令牌足够时取出并返回True，否则不等待直接返回False"""
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+            self.__updated = now
+            if self.__tokens < tokens:
+                return False
+            self.__tokens -= tokens
+            return True
+
+
+def backoff_delay(attempt, base=0.5, cap=8.0) -> float:
+    """带随机抖动的指数退避时间
+
+    :param attempt: 第几次重试，从0开始
+    :param base: 首次重试的基础等待秒数
+    :param cap: 等待时间上限
+    """
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
 def get_my_ipv4_address() -> str:
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
         s.connect(('1.1.1.1', 1))
@@ -45,6 +108,16 @@ def bytes_to_base64str(bytes_data) -> str:
     return base64.b64encode(bytes_data).decode('ASCII')
 
 
+def base64_form_value(bytes_data) -> bytes:
+    """将字节编码为base64并转义成表单值，全程使用bytes，不经过str
+
+    base64中需要转义的只有 + / 和末尾的 =
+    """
+    encoded = base64.b64encode(bytes_data).replace(b'+', b'%2B').replace(b'/', b'%2F')
+    padding = len(encoded) - len(encoded.rstrip(b'='))
+    return encoded[:len(encoded) - padding] + b'%3D' * padding if padding else encoded
+
+
 def verify_base64str(string) -> bool:
     return not (len(string) % 4) and re.fullmatch(r'[\dA-Za-z+/]+={0,2}', string)
 
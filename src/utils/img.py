@@ -6,32 +6,30 @@ Path: src/utils/img.py
 IDE: PyCharm
 Description: 图像处理有关方法
 """
-import os
+import io
 import time
 
 import numpy as np
 from PIL import Image
 
-from src.utils.support import DEBUG_MODE
+from src.utils.recorder import frame_recorder
+from src.utils.trace import tracer
 
 
-class Debug:
-    __count = 0
-    __temp_dir = 'debug/img/'
-    if os.path.exists(__temp_dir):
-        for filename in os.listdir(__temp_dir):
-            os.remove(__temp_dir + filename)
-    else:
-        os.makedirs(__temp_dir)
+def encode_png(image: Image.Image, compress_level=1) -> bytes:
+    """快速编码为PNG，压缩等级越低越快"""
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', compress_level=compress_level)
+    return buffer.getvalue()
+
 
-    @classmethod
-    def record(cls, image, number):
-        image_path = '%s/%s-%03d[%d].png' % (cls.__temp_dir, time.strftime('%H%M%S'), cls.__count, number)
-        with open(image_path, 'wb') as image_file:
-            image.save(image_file)
-        cls.__count += 1
+def _render_matching_pixels(image_array, matching_pixels):
+    """供调试使用，将匹配的像素涂黑"""
+    image_array[matching_pixels] = [0, 0, 0]
+    return encode_png(Image.fromarray(image_array))
 
 
+@tracer.traced('img.count_pixels')
 def count_pixels_of_color(image: Image.Image, target_color: tuple, tolerance=0):
     """计算图片中给定颜色的像素数量
 
@@ -52,10 +50,8 @@ def count_pixels_of_color(image: Image.Image, target_color: tuple, tolerance=0):
     matching_pixels = np.all(diff_array, axis=-1)
     pixels_number = np.sum(matching_pixels)
 
-    if DEBUG_MODE:
-        image_array[matching_pixels] = [0, 0, 0]
-        result_image = Image.fromarray(image_array)
-        Debug.record(result_image, pixels_number)
+    if frame_recorder.enabled:
+        frame_recorder.record('img', '[%d].png' % pixels_number, _render_matching_pixels, image_array, matching_pixels)
     return pixels_number
 
 
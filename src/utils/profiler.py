@@ -0,0 +1,287 @@
+"""
+Author: iota
+Create: 2024.3.31 19:42
+Project: YuanShenTool
+Path: src/utils/profiler.py
+IDE: PyCharm
+Description: 按需的性能剖析，包裹一次完整的操作，结束时保存剖析文件并在日志中输出最耗时的函数与模块
+"""
+import contextlib
+import cProfile
+import os
+import pstats
+import re
+import sys
+import sysconfig
+import threading
+import time
+from collections import Counter
+
+from src.utils.support import logger, pub_config
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).replace('\\', '/')
+STDLIB_ROOT = sysconfig.get_paths()['stdlib'].replace('\\', '/')
+# 常驻后台、大部分时间在等待的线程，不参与采样
+IDLE_THREADS = 'profiler', 'config_watcher', 'window_watcher', 'refresh_token', 'frame_recorder', 'evict_'
+# 栈顶为这些函数时线程在空闲等待：线程池等待任务、日志线程等待记录、tkinter等待事件
+IDLE_FRAMES = (('concurrent/futures/thread.py', '_worker'), ('logging/handlers.py', 'QueueListener.dequeue'),
+               ('tkinter/__init__.py', 'Misc.mainloop'))
+
+
+def _module_of(filename, name='') -> str:
+    """函数所在的模块：项目内为完整模块名，第三方库为顶层包名，标准库为模块名"""
+    if filename == '~':
+        # cProfile中的内置函数，例如 <built-in method time.sleep>、<method 'acquire' of '_thread.lock' objects>
+        if match := re.fullmatch(r"<method '\w+' of '([\w.]+)' objects>", name):
+            qualified = match.group(1)
+        else:
+            qualified = name.removeprefix('<built-in method ').removesuffix('>')
+        return qualified.rsplit('.', 1)[0] if '.' in qualified else 'builtins'
+    path = filename.replace('\\', '/')
+    if '/site-packages/' in path:
+        return path.rsplit('/site-packages/', 1)[1].split('/', 1)[0].removesuffix('.py')
+    if path.startswith(PROJECT_ROOT + '/'):
+        return path[len(PROJECT_ROOT) + 1:].removesuffix('.py').replace('/', '.')
+    if path.startswith(STDLIB_ROOT + '/'):
+        return path[len(STDLIB_ROOT) + 1:].split('/', 1)[0].removesuffix('.py')
+    return path
+
+
+def _is_idle(frame) -> bool:
+    filename = frame.f_code.co_filename.replace('\\', '/')
+    return any(filename.endswith(suffix) and frame.f_code.co_qualname == name for suffix, name in IDLE_FRAMES)
+
+
+class _Sampler:
+    """定时采样调用栈的剖析器
+
+    采样除常驻后台线程之外的所有线程，包括执行HTTP请求与OCR推理的cancellable线程池；
+    线程池中等待任务的线程不计入。按墙钟时间采样，sleep、网络等待等不占CPU的时间也会出现在结果中
+    """
+
+    suffix = '.folded'
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.elapsed = 0.0
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name='profiler', daemon=True)
+
+    def start(self):
+        self.__start = time.perf_counter()
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        self.__thread.join()
+        self.elapsed = time.perf_counter() - self.__start
+
+    def __run(self):
+        while not self.__stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, str(ident))
+                if name.startswith(IDLE_THREADS) or _is_idle(frame):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_qualname))
+                    frame = frame.f_back
+                stack.append(('<thread>', name))
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def threads(self) -> dict:
+        """各线程的样本数"""
+        counts = Counter()
+        for stack, count in self.stacks.items():
+            counts[stack[0][1]] += count
+        return counts
+
+    def functions(self) -> tuple[dict, dict, float]:
+        """各函数自身与累计的样本数，以及每个样本代表的秒数"""
+        own, cumulative = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for frame in set(stack[1:]):
+                cumulative[frame] += count
+        return own, cumulative, self.elapsed / self.samples if self.samples else 0
+
+    def save(self, filepath):
+        """保存为折叠栈格式，可以用 speedscope 或 flamegraph.pl 查看"""
+        with open(filepath, 'w', encoding='UTF-8') as fp:
+            for stack, count in self.stacks.most_common():
+                frames = [stack[0][1]] + ['%s:%s' % (_module_of(filename), name) for filename, name in stack[1:]]
+                fp.write('%s %d\n' % (';'.join(frames), count))
+
+
+class _Deterministic:
+    """cProfile，记录每次函数调用，结果精确但会拖慢运行，只统计开始剖析的线程"""
+
+    suffix = '.prof'
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.elapsed = 0.0
+
+    def start(self):
+        self.__start = time.perf_counter()
+        self.profile.enable()
+
+    def threads(self) -> dict:
+        return {threading.current_thread().name: self.elapsed}
+
+    def stop(self):
+        self.profile.disable()
+        self.elapsed = time.perf_counter() - self.__start
+
+    def functions(self) -> tuple[dict, dict, float]:
+        own, cumulative = Counter(), Counter()
+        for (filename, _, name), (_, _, total_time, cumulative_time, _) in pstats.Stats(self.profile).stats.items():
+            own[(filename, name)] += total_time
+            cumulative[(filename, name)] += cumulative_time
+        return own, cumulative, 1
+
+    def save(self, filepath):
+        """保存为pstats格式，可以用 python -m pstats 或 snakeviz 查看"""
+        self.profile.dump_stats(filepath)
+
+
+class Profiler:
+    """操作级的性能剖析
+
+    operations中的操作在开启时被剖析，未开启时session()直接执行，没有额外开销
+    """
+
+    # 配置项及其默认值
+    DEFAULTS = {'enabled': False, 'operations': (), 'mode': 'sample', 'interval': 0.005, 'top': 20}
+
+    def __init__(self, enabled=False, operations=(), mode='sample', interval=0.005, top=20,
+                 profile_dir='debug/profile/'):
+        """
+        :param operations: 要剖析的操作名称，为空时剖析所有操作
+        :param mode: sample=定时采样，cprofile=确定性剖析
+        :param interval: 采样间隔秒数
+        :param top: 日志中输出的函数数量
+        """
+        self.__configured = enabled
+        # 快捷键切换后的开关，优先于配置，配置文件中的enabled修改后失效
+        self.__override = None
+        self.operations = set(operations or ())
+        self.mode = mode
+        self.interval = interval
+        self.top = top
+        self.profile_dir = profile_dir
+        self.last_summary = ''
+        self.__applied = {}
+        # 同一时间只能有一个cProfile在运行
+        self.__cprofile_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.__configured if self.__override is None else self.__override
+
+    @enabled.setter
+    def enabled(self, value):
+        self.__configured = bool(value)
+        self.__override = None
+
+    def configure(self, config: dict):
+        """只应用与上次相比变化的配置项，重新加载配置文件不会撤销快捷键的切换"""
+        for key, default in self.DEFAULTS.items():
+            value = config.get(key, default)
+            if key in self.__applied and self.__applied[key] == value:
+                continue
+            self.__applied[key] = value
+            if key == 'enabled':
+                self.enabled = value
+            elif key == 'operations':
+                self.operations = set(value or ())
+            else:
+                setattr(self, key, value)
+
+    def toggle(self):
+        """切换开关，供快捷键调用，正在运行的操作不受影响"""
+        self.__override = not self.enabled
+        logger.info('性能剖析已%s，下一次运行%s生效' % ('开启' if self.enabled else '关闭', '、'.join(self.operations) or '操作'))
+
+    def armed(self, name) -> bool:
+        return self.enabled and (not self.operations or name in self.operations)
+
+    @contextlib.contextmanager
+    def session(self, name):
+        """剖析一次完整的运行，也可以作为装饰器使用"""
+        if not self.armed(name):
+            yield
+            return
+
+        if self.mode == 'cprofile':
+            # 多开购买等同时运行的操作中，第二个cProfile启动时会抛出ValueError
+            if not self.__cprofile_lock.acquire(blocking=False):
+                logger.warning(f'[{name}] 已有操作正在使用cprofile剖析，本次运行不剖析')
+                yield
+                return
+            recorder = _Deterministic()
+            try:
+                recorder.start()
+            except ValueError as exc:
+                # Python 3.12起调试器等其他工具占用剖析接口时也无法启动
+                self.__cprofile_lock.release()
+                logger.warning(f'[{name}] 无法启动cprofile：{exc}，本次运行不剖析')
+                recorder = None
+            if recorder is None:
+                yield
+                return
+        else:
+            recorder = _Sampler(self.interval)
+            recorder.start()
+        try:
+            yield
+        finally:
+            recorder.stop()
+            if isinstance(recorder, _Deterministic):
+                self.__cprofile_lock.release()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            filepath = os.path.join(self.profile_dir, '%s-%s%s' % (name, time.strftime('%H%M%S'), recorder.suffix))
+            recorder.save(filepath)
+            self.last_summary = self.summary(recorder)
+            logger.info(f'[{name}] 性能剖析（{self.mode}）：\n{self.last_summary}\n剖析文件已保存：{filepath}')
+
+    def summary(self, recorder) -> str:
+        own, cumulative, seconds = recorder.functions()
+        # 多个线程同时运行，占比相对于所有线程的时间之和
+        total = sum(own.values()) * seconds or 1
+        modules = Counter()
+        for (filename, name), value in own.items():
+            modules[_module_of(filename, name)] += value
+
+        threads = Counter(recorder.threads()).most_common()
+        described = ['%s %.2fs' % (thread, value * seconds) for thread, value in threads[:5]]
+        if len(threads) > 5:
+            described.append('其余%d个线程 %.2fs' % (len(threads) - 5, sum(value for _, value in threads[5:]) * seconds))
+        lines = ['运行%.2f秒，线程：%s' % (recorder.elapsed, '，'.join(described))]
+        lines.append('自身耗时最多的模块：')
+        lines += ['  %-40s %8.2fs %5.1f%%' % (module, value * seconds, value * seconds / total * 100)
+                  for module, value in modules.most_common(self.top // 2 or 1)]
+        lines.append('%-64s %9s %9s' % ('函数', '自身s', '累计s'))
+        for (filename, name), value in own.most_common(self.top):
+            label = name if filename == '~' else '%s:%s' % (_module_of(filename), name)
+            label = label if len(label) <= 64 else '…' + label[-63:]
+            lines.append('%-64s %9.3f %9.3f' % (label, value * seconds, cumulative[(filename, name)] * seconds))
+        return '\n'.join(lines)
+
+
+profiler = Profiler()
+profiler.configure(pub_config.get('profile') or {})
+pub_config.subscribe(lambda changed: 'profile' in changed and profiler.configure(changed['profile'] or {}))
+
+if __name__ == '__main__':
+    profiler.enabled = True
+    with profiler.session('demo'):
+        for i in range(20):
+            sum(x * x for x in range(200000))
+            time.sleep(0.01)
+    print(profiler.last_summary)
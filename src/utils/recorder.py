@@ -0,0 +1,161 @@
+"""
+Author: iota
+Create: 2024.3.4 22:40
+Project: YuanShenTool
+Path: src/utils/recorder.py
+IDE: PyCharm
+Description: 调试帧记录器，图片的绘制、编码与写入都在后台线程完成
+"""
+import atexit
+import collections
+import os
+import queue
+import threading
+import time
+
+from src.utils.support import DEBUG_MODE, logger, pub_config
+
+
+class FrameRecorder:
+    """记录调试用的图片帧
+
+    mode=async：帧放入有界队列，由后台线程写入，队列满时丢弃新帧而不阻塞调用方
+    mode=flight：只在内存中保留最近的N帧，且总大小不超过flight_max_bytes，调用dump()时才写入磁盘
+
+    帧以 (渲染函数, 参数) 的形式保存，解码、标注和编码都推迟到写入时才执行
+    """
+
+    def __init__(self, enabled, mode='async', queue_size=64, flight_frames=120, flight_max_bytes=32 * 2 ** 20,
+                 root_dir='debug/'):
+        self.enabled = enabled
+        self.mode = mode
+        self.root_dir = root_dir
+        self.dropped = 0
+        self.flight_frames = flight_frames
+        self.flight_max_bytes = flight_max_bytes
+
+        self.__count = 0
+        self.__cleared_dirs = set()
+        self.__flight = collections.deque()
+        self.__flight_bytes = 0
+        self.__queue = queue.Queue(maxsize=queue_size)
+        self.__worker = None
+        self.__lock = threading.Lock()
+
+    def record(self, category, suffix, render, *args):
+        """记录一帧
+
+        :param category: 分类，同时作为保存目录名
+        :param suffix: 文件名后缀，如 "[12].png"
+        :param render: 渲染函数，调用 render(*args) 返回编码后的图片字节
+        :param args: 渲染函数的参数，调用方之后不能再修改它们
+        """
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.__count += 1
+            name = '%s-%03d%s' % (time.strftime('%H%M%S'), self.__count, suffix)
+
+        if self.mode == 'flight':
+            self.__keep_in_flight((category, name, render, args), _size_of(args))
+            return
+
+        self.__ensure_worker()
+        try:
+            self.__queue.put_nowait((self.root_dir + category, name, render, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def dump(self, reason):
+        """将内存中保留的帧写入 debug/flight/ 下的子目录，仅在flight模式下有效
+
+        :param reason: 触发原因，用作目录名
+        """
+        if not (self.enabled and self.mode == 'flight' and self.__flight):
+            return
+        with self.__lock:
+            frames = [frame for frame, _ in self.__flight]
+            self.__flight.clear()
+            self.__flight_bytes = 0
+
+        dump_dir = '%sflight/%s-%s/' % (self.root_dir, time.strftime('%H%M%S'), reason)
+        os.makedirs(dump_dir, exist_ok=True)
+        logger.info(f'写入最近的{len(frames)}帧到：{dump_dir}')
+        self.__ensure_worker()
+        for category, name, render, args in frames:
+            # dump时不丢帧
+            self.__queue.put((dump_dir + category, name, render, args))
+
+    def __keep_in_flight(self, frame, size):
+        """保留最近的帧，超过帧数或总大小时丢弃最早的帧，最新的一帧总是保留"""
+        with self.__lock:
+            self.__flight.append((frame, size))
+            self.__flight_bytes += size
+            while len(self.__flight) > 1 and (len(self.__flight) > self.flight_frames
+                                     or self.__flight_bytes > self.flight_max_bytes):
+                _, dropped_size = self.__flight.popleft()
+                self.__flight_bytes -= dropped_size
+
+    def close(self, timeout=5):
+        """等待队列中的帧写入完成"""
+        if self.__worker is not None:
+            self.__queue.put(None)
+            self.__worker.join(timeout)
+            self.__worker = None
+        if self.dropped:
+            logger.warning(f'记录队列已满，丢弃了{self.dropped}帧')
+
+    def __ensure_worker(self):
+        if self.__worker is None:
+            with self.__lock:
+                if self.__worker is None:
+                    self.__worker = threading.Thread(target=self.__run, name='frame_recorder', daemon=True)
+                    self.__worker.start()
+
+    def __run(self):
+        while (job := self.__queue.get()) is not None:
+            save_dir, name, render, args = job
+            try:
+                self.__prepare_dir(save_dir)
+                with open('%s/%s' % (save_dir, name), 'wb') as fp:
+                    fp.write(render(*args))
+            except Exception as exc:
+                logger.warning(f'记录帧失败：{name} {exc!r}')
+
+    def __prepare_dir(self, save_dir):
+        """首次写入时清空目录中上一次运行留下的文件"""
+        if save_dir in self.__cleared_dirs:
+            return
+        if os.path.exists(save_dir):
+            if not save_dir.startswith(self.root_dir + 'flight/'):
+                for filename in os.listdir(save_dir):
+                    os.remove('%s/%s' % (save_dir, filename))
+        else:
+            os.makedirs(save_dir)
+        self.__cleared_dirs.add(save_dir)
+
+
+def _size_of(args) -> int:
+    """帧参数占用的内存字节数，只计算图片数组与字节串"""
+    size = 0
+    for arg in args:
+        if isinstance(arg, (bytes, bytearray)):
+            size += len(arg)
+        else:
+            size += getattr(arg, 'nbytes', 0)
+    return size
+
+
+def __create_recorder() -> FrameRecorder:
+    config = pub_config.get('debug_recorder') or {}
+    mode = config.get('mode', 'async')
+    ret = FrameRecorder(enabled=bool(DEBUG_MODE) or mode == 'flight',
+                        mode=mode,
+                        queue_size=config.get('queue_size', 64),
+                        flight_frames=config.get('flight_frames', 120),
+                        flight_max_bytes=config.get('flight_max_mb', 32) * 2 ** 20)
+    atexit.register(ret.close)
+    return ret
+
+
+frame_recorder = __create_recorder()
@@ -6,35 +6,99 @@ Path: src/utils/support.py
 IDE: PyCharm
 Description: 
 """
+import atexit
 import logging
+import logging.handlers
 import os
 import platform
+import queue
 import sys
+import time
 
-from src.utils.common import read_config
+from src.utils.config import PUBLIC_SCHEMA, LiveConfig
 
-pub_config = read_config('config/public.yml')
+# 文件修改后由后台线程重新加载，其他模块读到的总是最新值
+pub_config = LiveConfig('config/public.yml', PUBLIC_SCHEMA)
 
 if not os.path.exists('debug/'):
     os.mkdir('debug/')
 
 
-def __get_logger() -> logging.Logger:
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """只把日志记录放入队列，格式化和写入都交给后台线程"""
+
+    def prepare(self, record):
+        return record
+
+
+class LogSampler:
+    """限制高频日志的输出频率，用于每帧都会执行的循环
+
+    用法：if sampler.ready(): logger.debug(...)
+    """
+
+    def __init__(self, interval: float = 1.0):
+        """
+        :param interval: 两次输出的最小间隔秒数
+        """
+        self.interval = interval
+        self.skipped = 0
+        self.__suppressed = 0
+        self.__next_time = 0
+
+    def ready(self) -> bool:
+        now = time.monotonic()
+        if now < self.__next_time:
+            self.__suppressed += 1
+            return False
+        self.__next_time = now + self.interval
+        self.skipped, self.__suppressed = self.__suppressed, 0
+        return True
+
+
+def __get_logger() -> tuple[logging.Logger, logging.StreamHandler]:
     ret = logging.getLogger(__file__)
     ret.setLevel(pub_config['log_level'])
     formatter = logging.Formatter(pub_config['log_format'], style='$')
 
-    file_handle = logging.FileHandler('debug/record.log', mode='w', encoding='UTF-8')
+    # 按大小轮转，保留之前运行的日志
+    file_handle = logging.handlers.RotatingFileHandler('debug/record.log', encoding='UTF-8',
+                                                       maxBytes=pub_config.get('log_max_bytes', 5 * 1024 * 1024),
+                                                       backupCount=pub_config.get('log_backup_count', 3))
     file_handle.setFormatter(formatter)
-    ret.addHandler(file_handle)
 
     stream_handle = logging.StreamHandler(sys.stdout)
     stream_handle.setFormatter(formatter)
-    ret.addHandler(stream_handle)
-    return ret
+
+    # 调用方只负责入队，不会被磁盘和控制台的写入阻塞
+    log_queue = queue.SimpleQueue()
+    ret.addHandler(_DeferredQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, file_handle, stream_handle, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return ret, stream_handle
+
+
+logger, __console_handle = __get_logger()
+
+
+def log_to_stderr():
+    """控制台日志改写到stderr，命令行以JSON输出结果时stdout只保留结果"""
+    __console_handle.setStream(sys.stderr)
+
+
+def __on_config_changed(changed: dict):
+    logger.info(f'配置已重新加载：{changed}')
+    if 'log_level' in changed:
+        logger.setLevel(pub_config['log_level'])
+    # 这些配置在启动时使用，修改后需要重新启动
+    if restart := [key for key in ('debug_mode', 'ocr_platform', 'log_format') if key in changed]:
+        logger.warning(f'{", ".join(restart)}的修改在重新启动后生效')
 
 
-logger = __get_logger()
+pub_config.watch(pub_config['config_reload_interval'],
+                 on_error=lambda exc: logger.warning(f'配置文件不合法，继续使用原来的配置：{exc}'),
+                 on_change=__on_config_changed)
 
 DEBUG_MODE = pub_config['debug_mode']
 SYSTEM_NAME = platform.system()
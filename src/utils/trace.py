@@ -0,0 +1,225 @@
+"""
+Author: iota
+Create: 2024.3.2 21:05
+Project: YuanShenTool
+Path: src/utils/trace.py
+IDE: PyCharm
+Description: 轻量级的操作耗时追踪，统计各操作的延迟分布，可导出Chrome trace文件
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+from src.utils.support import logger, pub_config
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args = dict(self.args or {}, error=exc_type.__name__)
+        self.tracer.add(self.name, self.start, end, self.args)
+        return False
+
+
+class _Buffer:
+    """一次运行记录的耗时与trace事件，嵌套运行的记录同时计入外层"""
+
+    __slots__ = ('lock', 'durations', 'events', 'origin', 'parent')
+
+    def __init__(self, parent=None):
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.events = []
+        self.origin = time.perf_counter_ns()
+        self.parent = parent
+
+
+class Tracer:
+    """记录每次操作的起止时间
+
+    未启用时，span()返回一个空的上下文管理器，traced()直接调用原函数，开销可以忽略；
+    每次session()使用独立的记录，同时运行的多个操作互不影响，不在session中的记录计入全局
+    """
+
+    def __init__(self, enabled=False, chrome_trace=False, trace_dir='debug/trace/'):
+        self.enabled = enabled
+        self.chrome_trace = chrome_trace
+        self.trace_dir = trace_dir
+        self.last_summary = ''
+
+        self.__global = _Buffer()
+        self.__current = contextvars.ContextVar('trace_session', default=self.__global)
+
+    def span(self, name, **args):
+        """追踪一段代码的耗时
+
+        :param name: 操作名称，同名操作会被合并统计
+        :param args: 附加到trace事件中的参数
+        :return: 上下文管理器
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return _Span(self, name, args)
+
+    def traced(self, name):
+        """函数装饰器，追踪每次调用的耗时"""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Span(self, name, None):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def add(self, name, start_ns, end_ns, args=None):
+        buffer = self.__current.get()
+        while buffer is not None:
+            with buffer.lock:
+                buffer.durations.setdefault(name, []).append(end_ns - start_ns)
+                if self.chrome_trace:
+                    buffer.events.append((name, start_ns, end_ns, threading.get_ident(), args))
+            buffer = buffer.parent
+
+    def reset(self):
+        """清空当前运行的记录"""
+        buffer = self.__current.get()
+        with buffer.lock:
+            buffer.durations = {}
+            buffer.events = []
+            buffer.origin = time.perf_counter_ns()
+
+    def bind(self, func):
+        """让func在其他线程中执行时记录到当前的运行，提交到线程池的函数需要先绑定"""
+        buffer = self.__current.get()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = self.__current.set(buffer)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.__current.reset(token)
+
+        return wrapper
+
+    @contextlib.contextmanager
+    def session(self, name):
+        """一次完整的运行，结束时输出统计摘要，并按需保存Chrome trace文件
+
+        也可以作为装饰器使用
+        """
+        if not self.enabled:
+            yield
+            return
+
+        parent = self.__current.get()
+        token = self.__current.set(_Buffer(None if parent is self.__global else parent))
+        try:
+            with _Span(self, name, None):
+                yield
+        finally:
+            self.last_summary = self.summary()
+            logger.info(f'[{name}] 耗时统计：\n{self.last_summary}')
+            if self.chrome_trace:
+                self.export_chrome_trace('%s/%s-%s.json' % (self.trace_dir, name, time.strftime('%H%M%S')))
+            self.__current.reset(token)
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """当前运行中各操作的调用次数、总耗时及延迟百分位数，单位毫秒"""
+        buffer = self.__current.get()
+        with buffer.lock:
+            durations = {k: sorted(v) for k, v in buffer.durations.items()}
+
+        ret = {}
+        for name, values in durations.items():
+            ret[name] = {
+                'count': len(values),
+                'total': sum(values) / 1e6,
+                'p50': percentile(values, 50) / 1e6,
+                'p95': percentile(values, 95) / 1e6,
+                'p99': percentile(values, 99) / 1e6,
+            }
+        return ret
+
+    def summary(self) -> str:
+        stats = self.stats()
+        lines = ['%-24s %6s %10s %9s %9s %9s' % ('操作', '次数', '总计ms', 'p50', 'p95', 'p99')]
+        for name, st in sorted(stats.items(), key=lambda kv: kv[1]['total'], reverse=True):
+            lines.append('%-24s %6d %10.1f %9.1f %9.1f %9.1f' % (
+                name, st['count'], st['total'], st['p50'], st['p95'], st['p99']))
+        return '\n'.join(lines)
+
+    def export_chrome_trace(self, filepath):
+        """导出当前运行的记录为Chrome trace-event格式，可在 chrome://tracing 或 Perfetto 中查看"""
+        buffer = self.__current.get()
+        with buffer.lock:
+            events = list(buffer.events)
+            origin = buffer.origin
+
+        pid = os.getpid()
+        trace_events = []
+        for name, start_ns, end_ns, tid, args in events:
+            event = {
+                'name': name,
+                'cat': name.split('.', 1)[0],
+                'ph': 'X',
+                'ts': (start_ns - origin) / 1e3,
+                'dur': (end_ns - start_ns) / 1e3,
+                'pid': pid,
+                'tid': tid,
+            }
+            if args:
+                event['args'] = args
+            trace_events.append(event)
+
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'w', encoding='UTF-8') as fp:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, fp, ensure_ascii=False)
+        logger.info(f'trace文件已保存：{filepath}')
+
+
+def percentile(sorted_values, pct):
+    """最近秩法计算百分位数
+
+    :param sorted_values: 已升序排列的数值
+    :param pct: 百分位 0~100
+    """
+    if not sorted_values:
+        return 0
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+__trace_config = pub_config.get('trace') or {}
+tracer = Tracer(enabled=bool(__trace_config.get('enabled')),
+                chrome_trace=bool(__trace_config.get('chrome_trace')))
+
+if __name__ == '__main__':
+    tracer.enabled = tracer.chrome_trace = True
+    with tracer.session('demo'):
+        for i in range(20):
+            with tracer.span('sleep', i=i):
+                time.sleep(0.001 * (i % 5))
+    print(tracer.last_summary)
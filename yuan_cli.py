@@ -0,0 +1,13 @@
+"""
+Author: iota
+Create: 2024.3.6 20:10
+Project: YuanShenTool
+Path: /yuan_cli.py
+IDE: PyCharm
+Description: 命令行入口，用法见 python yuan_cli.py --help
+"""
+import sys
+
+from src.modules.cli import main
+
+sys.exit(main())